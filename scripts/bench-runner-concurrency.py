@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+'''
+Measures the latency of execute requests to kernels whose runners are ready
+while the runners of other kernels are slow to start (e.g., connecting to
+containers still booting).
+
+It runs the agent's execution path with fake kernel runners, so neither
+Docker nor real kernels are required.  Pass --global-lock to emulate the
+former agent-wide runner lock for comparison.
+
+Usage: python scripts/bench-runner-concurrency.py [--global-lock]
+'''
+
+import argparse
+import asyncio
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import time
+
+# Reuse the fake runners of the test suite.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tests.fakes import FakeRunnerFactory, make_stub_agent  # noqa: E402
+
+
+async def bench(args):
+    slow_kernels = [f'slow-{idx}' for idx in range(args.num_slow)]
+    ready_kernels = [f'ready-{idx}' for idx in range(args.num_ready)]
+    fake_runners = FakeRunnerFactory()
+    fake_runners.start_delays = {k: args.start_delay for k in slow_kernels}
+    fake_runners.exec_time = 0.001  # the kernel's execution time
+    with tempfile.TemporaryDirectory() as tmpdir, fake_runners.patch():
+        agent = make_stub_agent(Path(tmpdir), slow_kernels + ready_kernels)
+        if args.global_lock:
+            global_lock = asyncio.Lock()
+            ensure_runner = agent._ensure_runner
+
+            async def _ensure_runner(kernel_id, **kwargs):
+                async with global_lock:
+                    return await ensure_runner(kernel_id, **kwargs)
+
+            agent._ensure_runner = _ensure_runner
+
+        # Warm up the runners of the ready kernels.
+        for kernel_id in ready_kernels:
+            await agent._ensure_runner(kernel_id)
+
+        latencies = []
+
+        async def execute(kernel_id):
+            begin = time.perf_counter()
+            await agent._execute(3, kernel_id, None, 'query', 'print(1)', {}, None)
+            latencies.append(time.perf_counter() - begin)
+
+        async def execute_repeatedly(kernel_id):
+            for _ in range(args.num_requests):
+                await execute(kernel_id)
+                await asyncio.sleep(0.01)
+
+        slow_tasks = [asyncio.ensure_future(agent._ensure_runner(kernel_id))
+                      for kernel_id in slow_kernels]
+        await asyncio.gather(*[execute_repeatedly(kernel_id)
+                               for kernel_id in ready_kernels])
+        await asyncio.gather(*slow_tasks)
+
+    latencies.sort()
+    print(f'lock: {"agent-wide" if args.global_lock else "per-kernel"}, '
+          f'{args.num_slow} kernels starting runners for {args.start_delay} sec')
+    print(f'execute latency of {args.num_ready} other kernels '
+          f'({len(latencies)} requests):')
+    print(f'  median: {statistics.median(latencies) * 1000:.2f} ms')
+    print(f'  p99:    {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms')
+    print(f'  max:    {latencies[-1] * 1000:.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--global-lock', action='store_true', default=False,
+                        help='Emulate the former agent-wide runner lock.')
+    parser.add_argument('--num-slow', type=int, default=4)
+    parser.add_argument('--num-ready', type=int, default=16)
+    parser.add_argument('--num-requests', type=int, default=50)
+    parser.add_argument('--start-delay', type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+'''
+A cache of the build outputs of batch-mode executions.
+
+The outputs of a build are stored per owner, image and build command, keyed
+by the content hash of all files in the kernel's work directory.
+'''
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import secrets
+import shutil
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.buildcache'))
+
+__all__ = (
+    'BuildCache',
+)
+
+
+def _scan_work_dir(root):
+    '''
+    Returns the relative paths of all files in the directory, including the
+    hidden ones, with their sizes and modification times.
+    '''
+    file_stats = {}
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, PermissionError):
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                rel = os.path.relpath(entry.path, root)
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except (FileNotFoundError, PermissionError):
+                    continue
+                file_stats[rel] = (stat.st_size, stat.st_mtime_ns)
+    return file_stats
+
+
+class BuildCache:
+    '''
+    Keeps the build outputs under *root* as
+    ``<owner, image and build command digest>/<input digest>/files/...``
+    with the list of the output paths of each entry in its ``outputs.json``.
+    Only the *max_entries* most recently used entries are kept.
+
+    Every file in the work directory is an input of the build, so the leftover
+    outputs of a previous build are part of the key of the next one.
+    '''
+
+    _chunk_size = 1048576  # 1 MBytes
+
+    def __init__(self, root: Path, *, max_entries=64,
+                 max_input_size=104857600):
+        self.root = root
+        self.max_entries = max_entries
+        self.max_input_size = max_input_size
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _prefix_dir(self, access_key, image, build_cmd):
+        digest = hashlib.sha256(
+            f'{access_key}\0{image}\0{build_cmd}'.encode('utf8'))
+        return self.root / digest.hexdigest()[:32]
+
+    def _read_output_paths(self, entry_dir):
+        try:
+            return json.loads((entry_dir / 'outputs.json').read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def compute_key(self, access_key, image, build_cmd, work_dir):
+        '''
+        Returns the cache key of the build and the stats of the work directory
+        files to be compared after the build.  The key is None if the inputs
+        are too large to cache.
+        '''
+        prefix_dir = self._prefix_dir(access_key, image, build_cmd)
+        file_stats = _scan_work_dir(work_dir)
+        input_paths = sorted(file_stats)
+        if sum(file_stats[rel][0] for rel in input_paths) > self.max_input_size:
+            return None, file_stats
+        digest = hashlib.sha256()
+        for rel in input_paths:
+            digest.update(rel.encode('utf8', 'surrogateescape') + b'\0')
+            try:
+                with open(work_dir / rel, 'rb') as f:
+                    while True:
+                        chunk = f.read(self._chunk_size)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+            except OSError:
+                return None, file_stats
+            digest.update(b'\0')
+        key = f'{prefix_dir.name}/{digest.hexdigest()}'
+        return key, file_stats
+
+    def restore(self, key, work_dir):
+        '''
+        Copies the cached outputs into the work directory.
+        Returns False if there is no such entry.
+        '''
+        entry_dir = self.root / key
+        output_paths = self._read_output_paths(entry_dir)
+        if output_paths is None:
+            return False
+        st = work_dir.stat()
+        for rel in output_paths:
+            dst = work_dir / rel
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(entry_dir / 'files' / rel, dst)
+            try:
+                # Let the kernel user own the restored files.
+                os.chown(dst, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        os.utime(entry_dir)  # mark as recently used
+        return True
+
+    def store(self, key, work_dir, initial_file_stats):
+        '''
+        Stores the files created or modified since *initial_file_stats* was
+        taken as the outputs of the build.  Returns the number of them.
+        '''
+        final_file_stats = _scan_work_dir(work_dir)
+        output_paths = sorted(rel for rel, stat in final_file_stats.items()
+                              if initial_file_stats.get(rel) != stat)
+        prefix_dir = self.root / key.split('/')[0]
+        prefix_dir.mkdir(exist_ok=True)
+        tmp_dir = prefix_dir / f'.tmp-{secrets.token_hex(8)}'
+        tmp_dir.mkdir()
+        try:
+            for rel in output_paths:
+                dst = tmp_dir / 'files' / rel
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(work_dir / rel, dst)
+            (tmp_dir / 'outputs.json').write_text(json.dumps(output_paths))
+            entry_dir = self.root / key
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.evict()
+        return len(output_paths)
+
+    def evict(self):
+        entries = []
+        for prefix_dir in self.root.iterdir():
+            if not prefix_dir.is_dir():
+                continue
+            for entry_dir in prefix_dir.iterdir():
+                if entry_dir.is_dir() and not entry_dir.name.startswith('.'):
+                    entries.append((entry_dir.stat().st_mtime, entry_dir))
+        entries.sort()
+        for _, entry_dir in entries[:max(0, len(entries) - self.max_entries)]:
+            log.debug('evicting the build cache entry {0}', entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
@@ -1,10 +1,14 @@
 import asyncio
 import codecs
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from dataclasses import dataclass
-import io
+import functools
 import json
 import logging
+import mmap
+import os
+from pathlib import Path
+import struct
 import time
 import secrets
 
@@ -12,6 +16,8 @@ from async_timeout import timeout
 import aiozmq
 import msgpack
 import zmq
+import zmq.asyncio
+from zmq.utils.monitor import parse_monitor_message
 
 from ai.backend.common.utils import StringSetFlag
 from ai.backend.common.logging import BraceStyleAdapter
@@ -23,6 +29,18 @@ log = BraceStyleAdapter(logging.getLogger(__name__))
 # since they are passed as separate status field.)
 outgoing_msg_types = {'stdout', 'stderr', 'media', 'html', 'log', 'completion'}
 
+# The socket event indicating that the REPL in the kernel is up.
+# (Handshake events are available since libzmq 4.3.)
+if zmq.zmq_version_info() >= (4, 3):
+    repl_ready_event = zmq.EVENT_HANDSHAKE_SUCCEEDED
+else:
+    repl_ready_event = zmq.EVENT_CONNECTED
+
+
+# The status msg types carrying structured payloads.
+status_payload_msg_types = {b'finished', b'clean-finished', b'build-finished',
+                            b'waiting-input'}
+
 
 class KernelFeatures(StringSetFlag):
     UID_MATCH = 'uid-match'
@@ -30,6 +48,7 @@ class KernelFeatures(StringSetFlag):
     BATCH_MODE = 'batch'
     QUERY_MODE = 'query'
     TTY_MODE = 'tty'
+    MSGPACK = 'msgpack'
 
 
 class ClientFeatures(StringSetFlag):
@@ -64,17 +83,277 @@ class ExecTimeout(RunEvent):
     pass
 
 
+def _pack_json(data):
+    return json.dumps(data).encode('utf8')
+
+
+def _pack_msgpack(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _unpack_msgpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# The encodings of the structured payloads exchanged with kernels.
+# Kernels having the "msgpack" feature use msgpack, and the others use JSON.
+payload_codecs = {
+    'json': (_pack_json, json.loads),
+    'msgpack': (_pack_msgpack, _unpack_msgpack),
+}
+
+
 @dataclass
 class ResultRecord:
     msg_type: str = None
-    data: str = None
+    data: str = None  # or the raw payload bytes for media records
+    # the decoded (type, data) of media records, unless restored from spills
+    media: tuple = None
+
+
+def _get_media(rec, unpack_payload):
+    if rec.media is not None:
+        return rec.media
+    # The records read back from spill files keep only the raw payloads.
+    o = unpack_payload(rec.data)
+    return (o['type'], o['data'])
+
+
+@dataclass
+class RunTimings:
+    received_at: float  # when the first request of the run is received
+    queued: float = 0.0  # secs waiting behind the other runs
+    first_output_at: float = None
+    finished_at: float = None
+
+
+class OutputBuffer:
+    '''
+    Keeps the console outputs of a run until the client fetches them.
+
+    Up to *memory_limit* bytes of records are kept in memory and the rest
+    overflows into a memory-mapped spill file at *spill_path*, if given.
+    Once the run has produced *max_size* bytes of outputs in total, further
+    outputs are dropped after a single "truncated" marker record.
+
+    Each record gets a sequence number so that the readers can take exactly
+    the records written before a given point.
+    '''
+
+    _rec_header = struct.Struct('!HBI')  # type length, is-bytes, data length
+    _initial_spill_size = 1048576  # 1 MBytes
+
+    def __init__(self, spill_path=None, *,
+                 memory_limit=1048576, max_size=104857600):
+        self.spill_path = spill_path
+        self.memory_limit = memory_limit
+        self.max_size = max_size
+        self.records = deque()
+        self.mem_size = 0
+        self.spill_created = False
+        self.spill_map = None
+        self.spill_roff = 0
+        self.spill_woff = 0
+        self.num_spilled = 0
+        self.end = 0       # the sequence number of the next record
+        self.consumed = 0  # the sequence number of the next record to read
+        self.total_size = 0
+        self.dropped_size = 0
+        self.truncated = False
+
+    def close(self, *, keep_spill=False):
+        if self.spill_map is not None:
+            self.spill_map.close()
+            self.spill_map = None
+        if self.spill_created and not keep_spill:
+            try:
+                os.unlink(self.spill_path)
+            except FileNotFoundError:
+                pass
+            self.spill_created = False
+        self.records.clear()
+
+    def persist(self):
+        '''
+        Moves the records kept in memory into the spill file and returns the
+        state to reopen the buffer later with restore().  The records in memory
+        are lost if there is no spill file.
+        '''
+        if self.records and self.spill_path is not None:
+            spilled = b''
+            num_spilled = self.num_spilled
+            if num_spilled > 0:
+                spilled = bytes(self.spill_map[self.spill_roff:self.spill_woff])
+            self.spill_roff = self.spill_woff = self.num_spilled = 0
+            try:
+                # The records in memory precede the spilled ones.
+                for rec in self.records:
+                    self._spill(rec)
+                if spilled:
+                    end = self.spill_woff + len(spilled)
+                    if end > len(self.spill_map):
+                        self.spill_map.resize(end)
+                    self.spill_map[self.spill_woff:end] = spilled
+                    self.spill_woff = end
+                    self.num_spilled += num_spilled
+            except OSError:
+                log.exception('cannot write to the output spill file {0}',
+                              self.spill_path)
+                self.num_spilled = 0
+                self.truncated = True
+            self.records.clear()
+            self.mem_size = 0
+        if self.spill_map is not None:
+            self.spill_map.flush()
+        return {
+            'spill_path': str(self.spill_path) if self.spill_path else None,
+            'spill_roff': self.spill_roff,
+            'spill_woff': self.spill_woff,
+            'num_spilled': self.num_spilled,
+            'end': self.end,
+            'consumed': self.consumed,
+            'total_size': self.total_size,
+            'dropped_size': self.dropped_size,
+            'truncated': self.truncated or bool(self.records),
+        }
+
+    @classmethod
+    def restore(cls, state, **kwargs):
+        spill_path = Path(state['spill_path']) if state['spill_path'] else None
+        buf = cls(spill_path, **kwargs)
+        buf.end = state['end']
+        buf.consumed = state['consumed']
+        buf.total_size = state['total_size']
+        buf.dropped_size = state['dropped_size']
+        buf.truncated = state['truncated']
+        if spill_path is not None and spill_path.exists():
+            buf.spill_created = True
+            if state['num_spilled'] > 0:
+                fd = os.open(spill_path, os.O_RDWR | os.O_CLOEXEC)
+                try:
+                    buf.spill_map = mmap.mmap(fd, os.fstat(fd).st_size)
+                finally:
+                    os.close(fd)
+                buf.spill_roff = state['spill_roff']
+                buf.spill_woff = state['spill_woff']
+                buf.num_spilled = state['num_spilled']
+        elif state['num_spilled'] > 0:
+            # The outputs are lost.
+            buf.truncated = True
+        return buf
+
+    def reserve(self, size):
+        '''
+        Checks if an output of the given size fits in the budget of the run.
+        If not, the output should be dropped without further processing.
+        '''
+        if not self.truncated and self.total_size + size <= self.max_size:
+            self.total_size += size
+            return True
+        if not self.truncated:
+            self.truncated = True
+            self._store(ResultRecord('truncated', None))
+        self.dropped_size += size
+        return False
+
+    def append(self, rec):
+        self._store(rec)
+
+    def _store(self, rec):
+        size = len(rec.data) if rec.data else 0
+        if self.num_spilled == 0 and (self.spill_path is None or
+                                      self.mem_size + size <= self.memory_limit):
+            # Without a spill file, the memory usage is still bounded by
+            # the output budget.
+            self.records.append(rec)
+            self.mem_size += size
+        else:
+            try:
+                self._spill(rec)
+            except OSError:
+                log.exception('cannot write to the output spill file {0}',
+                              self.spill_path)
+                # Drop the record and all further outputs.  The marker is
+                # yielded after all stored records by drain().
+                self.truncated = True
+        self.end += 1
+
+    def _spill(self, rec):
+        msg_type = rec.msg_type.encode('ascii')
+        is_bytes = isinstance(rec.data, bytes)
+        if is_bytes:
+            data = rec.data
+        else:
+            data = rec.data.encode('utf8') if rec.data else b''
+        header = self._rec_header.pack(len(msg_type), is_bytes, len(data))
+        size = len(header) + len(msg_type) + len(data)
+        if self.spill_map is None:
+            self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.spill_path,
+                         os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+            self.spill_created = True
+            try:
+                initial_size = max(self._initial_spill_size, size)
+                os.ftruncate(fd, initial_size)
+                self.spill_map = mmap.mmap(fd, initial_size)
+            finally:
+                os.close(fd)  # mmap keeps its own duplicate.
+        elif self.spill_woff + size > len(self.spill_map):
+            # This also extends the file.
+            self.spill_map.resize(max(len(self.spill_map) * 2,
+                                      self.spill_woff + size))
+        woff = self.spill_woff
+        self.spill_map[woff:woff + len(header)] = header
+        woff += len(header)
+        self.spill_map[woff:woff + len(msg_type)] = msg_type
+        woff += len(msg_type)
+        self.spill_map[woff:woff + len(data)] = data
+        self.spill_woff = woff + len(data)
+        self.num_spilled += 1
+
+    def _unspill(self):
+        roff = self.spill_roff
+        type_len, is_bytes, data_len = \
+            self._rec_header.unpack_from(self.spill_map, roff)
+        roff += self._rec_header.size
+        msg_type = self.spill_map[roff:roff + type_len].decode('ascii')
+        roff += type_len
+        data = self.spill_map[roff:roff + data_len]
+        if not is_bytes:
+            data = data.decode('utf8')
+        self.spill_roff = roff + data_len
+        self.num_spilled -= 1
+        if self.num_spilled == 0:
+            # Reuse the spill file from the beginning.
+            self.spill_roff = self.spill_woff = 0
+        return ResultRecord(msg_type, data if data_len else None)
+
+    def drain(self, upto=None):
+        '''
+        Iterates over and removes the records before the sequence number
+        *upto*, or all records if not given.
+        '''
+        if upto is None:
+            upto = self.end
+        while self.consumed < upto:
+            if self.records:
+                rec = self.records.popleft()
+                self.mem_size -= len(rec.data) if rec.data else 0
+            elif self.num_spilled > 0:
+                rec = self._unspill()
+            else:
+                # the marker after a failed spill
+                rec = ResultRecord('truncated', None)
+            self.consumed += 1
+            yield rec
 
 
 class KernelRunner:
 
     def __init__(self, kernel_id,
                  kernel_host, repl_in_port, repl_out_port,
-                 exec_timeout, client_features=None):
+                 exec_timeout, client_features=None, *,
+                 kernel_features=None, output_pub=None, spill_dir=None):
         self.started_at = None
         self.finished_at = None
         self.kernel_id = kernel_id
@@ -82,18 +361,58 @@ class KernelRunner:
         self.repl_in_port = repl_in_port
         self.repl_out_port = repl_out_port
         self.input_stream = None
-        self.output_stream = None
+        self.output_sock = None
         assert exec_timeout >= 0
         self.exec_timeout = exec_timeout
         self.max_record_size = 10485760  # 10 MBytes
-        self.completion_queue = asyncio.Queue(maxsize=128)
-        self.service_queue = asyncio.Queue(maxsize=128)
+        self.max_read_batch = 256  # frames
+        self.max_run_output_size = 104857600  # 100 MBytes
+        self.output_memory_limit = 1048576  # 1 MBytes
+        self.max_pending_requests = 128
+        self.completion_cache_ttl = 2.0  # secs
+        self.completion_cache_size = 64
+        self.finished_run_timings_size = 16
+        # The completion and service requests waiting for their replies
+        # in the order of being sent, keyed by their request IDs.
+        self.pending_completions = OrderedDict()  # req_id -> (key, future)
+        self.pending_services = OrderedDict()  # req_id -> future
+        # The futures of the completion requests in flight and the recent
+        # completion results, keyed by the request payloads.
+        self.inflight_completions = {}
+        self.completion_cache = OrderedDict()  # key -> (expire_at, result)
         self.read_task = None
+        self.watchdog_task = None
+        self.monitor_task = None
+        self.ready_event = asyncio.Event()
+        self.ready_at = None
         self.client_features = client_features or set()
+        self.kernel_features = kernel_features or set()
+        if KernelFeatures.MSGPACK in self.kernel_features:
+            self.payload_encoding = 'msgpack'
+        else:
+            self.payload_encoding = 'json'
+        self.pack_payload, self.unpack_payload = \
+            payload_codecs[self.payload_encoding]
 
         self.output_queue = None
+        self.output_buffer = None
+        self.output_run_id = None  # the run ID of output_queue
         self.pending_queues = OrderedDict()
+        # The directory to create the spill files of the output buffers.
+        self.spill_dir = spill_dir
         self.current_run_id = None
+        self.run_timings = {}  # run_id -> RunTimings of the ongoing runs
+        # The timings of the recently finished runs until taken by the callers
+        self.finished_run_timings = OrderedDict()
+        self.cached_build_runs = set()
+        # Set when the state is saved to be restored by the next agent,
+        # to keep the spill files after closing.
+        self.state_saved = False
+
+        # The PUB stream shared by all runners to publish the outputs of runs
+        # requested to be streamed, using their run IDs as the topics.
+        self.output_pub = output_pub
+        self.streaming_runs = set()
 
     async def start(self):
         self.started_at = time.monotonic()
@@ -102,9 +421,17 @@ class KernelRunner:
             zmq.PUSH, connect=f'tcp://{self.kernel_host}:{self.repl_in_port}')
         self.input_stream.transport.setsockopt(zmq.LINGER, 50)
 
-        self.output_stream = await aiozmq.create_zmq_stream(
-            zmq.PULL, connect=f'tcp://{self.kernel_host}:{self.repl_out_port}')
-        self.output_stream.transport.setsockopt(zmq.LINGER, 50)
+        # aiozmq streams deliver only one message per wakeup,
+        # so we read the outputs directly to drain them in batches.
+        self.output_sock = zmq.asyncio.Context.instance().socket(zmq.PULL)
+        self.output_sock.setsockopt(zmq.LINGER, 50)
+        # Retry connecting to a kernel still booting with backoff.
+        self.output_sock.setsockopt(zmq.RECONNECT_IVL, 100)
+        self.output_sock.setsockopt(zmq.RECONNECT_IVL_MAX, 2000)
+        monitor_sock = self.output_sock.get_monitor_socket(repl_ready_event)
+        self.monitor_task = asyncio.ensure_future(
+            self.watch_readiness(monitor_sock))
+        self.output_sock.connect(f'tcp://{self.kernel_host}:{self.repl_out_port}')
 
         self.read_task = asyncio.ensure_future(self.read_output())
         if self.exec_timeout > 0:
@@ -116,41 +443,76 @@ class KernelRunner:
         if self.watchdog_task and not self.watchdog_task.done():
             self.watchdog_task.cancel()
             await self.watchdog_task
+        if self.monitor_task and not self.monitor_task.done():
+            self.monitor_task.cancel()
+            await self.monitor_task
         if (self.input_stream and not self.input_stream.at_closing() and
             self.input_stream.transport):
             # only when really closable...
             self.input_stream.close()
-        if (self.output_stream and not self.output_stream.at_closing() and
-            self.output_stream.transport):
-            # only when really closable...
-            self.output_stream.close()
         if self.read_task and not self.read_task.done():
             self.read_task.cancel()
             await self.read_task
             self.read_task = None
+        if self.output_sock is not None:
+            self.output_sock.close()
+            self.output_sock = None
+        for _, _, buf in self.pending_queues.values():
+            buf.close(keep_spill=self.state_saved)
+        if self.output_buffer is not None:
+            self.output_buffer.close(keep_spill=self.state_saved)
+        self.run_timings.clear()
+        self.finished_run_timings.clear()
+        for _, fut in self.pending_completions.values():
+            fut.cancel()
+        self.pending_completions.clear()
+        for fut in self.pending_services.values():
+            fut.cancel()
+        self.pending_services.clear()
 
-    async def feed_batch(self, opts):
-        clean_cmd = opts.get('clean', '')
-        if clean_cmd is None:
-            clean_cmd = ''
-        self.input_stream.write([
-            b'clean',
-            clean_cmd.encode('utf8'),
-        ])
-        build_cmd = opts.get('build', '')
-        if build_cmd is None:
-            build_cmd = ''
-        self.input_stream.write([
-            b'build',
-            build_cmd.encode('utf8'),
-        ])
-        exec_cmd = opts.get('exec', '')
-        if exec_cmd is None:
-            exec_cmd = ''
-        self.input_stream.write([
-            b'exec',
-            exec_cmd.encode('utf8'),
-        ])
+    async def watch_readiness(self, monitor_sock):
+        try:
+            while True:
+                event = parse_monitor_message(await monitor_sock.recv_multipart())
+                if event['event'] == repl_ready_event:
+                    break
+            self.ready_at = time.monotonic()
+            self.ready_event.set()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.output_sock is not None:
+                self.output_sock.disable_monitor()
+            monitor_sock.close()
+
+    @property
+    def is_ready(self):
+        return self.ready_event.is_set()
+
+    async def wait_ready(self, timeout=None):
+        '''
+        Waits until the runner has connected to the REPL of the kernel.
+        Raises asyncio.TimeoutError if it is not ready within *timeout*
+        seconds.
+        '''
+        await asyncio.wait_for(self.ready_event.wait(), timeout)
+
+    async def feed_batch(self, opts, *, phases=('clean', 'build', 'exec')):
+        for phase in phases:
+            cmd = opts.get(phase, '')
+            if cmd is None:
+                cmd = ''
+            self.input_stream.write([
+                phase.encode('ascii'),
+                cmd.encode('utf8'),
+            ])
+
+    def mark_build_cached(self, run_id):
+        '''
+        Reports the build phase of the run as "build-cached" as its build
+        outputs are restored from the cache.
+        '''
+        self.cached_build_runs.add(run_id)
 
     async def feed_code(self, text):
         self.input_stream.write([b'code', text.encode('utf8')])
@@ -161,33 +523,88 @@ class KernelRunner:
     async def feed_interrupt(self):
         self.input_stream.write([b'interrupt', b''])
 
-    async def feed_and_get_completion(self, code_text, opts):
+    def send_request(self, msg_type, payload):
+        '''
+        Sends a request tagged with a new request ID as the ``reqId`` field.
+        The kernels echo it back as the third frame of the reply so that
+        the replies of concurrent requests are dispatched correctly.
+        Old kernels without the third frame reply in the request order.
+        '''
+        req_id = secrets.token_hex(8)
+        self.input_stream.write([
+            msg_type,
+            self.pack_payload({**payload, 'reqId': req_id}),
+        ])
+        return req_id
+
+    @staticmethod
+    def pop_pending_request(pending, req_id):
+        if req_id is None:
+            if not pending:
+                return None
+            return pending.popitem(last=False)[1]
+        return pending.pop(req_id.decode('ascii'), None)
+
+    def _forget_completion(self, key, fut):
+        if self.inflight_completions.get(key) is fut:
+            del self.inflight_completions[key]
+
+    async def feed_and_get_completion(self, code_text, opts, *, supersede=False):
+        '''
+        Returns the completion results of the code, or None if the request is
+        superseded by a later one.
+
+        Identical requests share a single request to the kernel and reuse its
+        result for a short time.  If *supersede* is set, the other completion
+        requests still in flight are resolved as superseded immediately.
+        '''
         payload = {
             'code': code_text,
         }
         payload.update(opts)
-        self.input_stream.write([
-            b'complete',
-            json.dumps(payload).encode('utf8'),
-        ])
+        key = json.dumps(payload, sort_keys=True)
+        cached = self.completion_cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                return cached[1]
+            del self.completion_cache[key]
+        if supersede:
+            for other_key, other_fut in self.inflight_completions.items():
+                if other_key != key and not other_fut.done():
+                    other_fut.set_result(None)
+        fut = self.inflight_completions.get(key)
+        if fut is None or fut.done():
+            if len(self.pending_completions) >= self.max_pending_requests:
+                log.warning('too many pending completion requests to kernel {0}',
+                            self.kernel_id)
+                return []
+            fut = asyncio.get_event_loop().create_future()
+            req_id = self.send_request(b'complete', payload)
+            self.pending_completions[req_id] = (key, fut)
+            self.inflight_completions[key] = fut
+            fut.add_done_callback(functools.partial(self._forget_completion, key))
         try:
-            result = await self.completion_queue.get()
-            self.completion_queue.task_done()
-            return json.loads(result)
+            # The other waiters of the same request are not affected
+            # when the caller is cancelled.
+            return await asyncio.shield(fut)
         except asyncio.CancelledError:
-            return []
+            if fut.cancelled():  # the runner is closed
+                return []
+            raise
 
     async def feed_start_service(self, service_info):
-        self.input_stream.write([
-            b'start-service',
-            json.dumps(service_info).encode('utf8'),
-        ])
+        if len(self.pending_services) >= self.max_pending_requests:
+            return {'status': 'failed', 'error': 'too many pending requests'}
+        fut = asyncio.get_event_loop().create_future()
+        req_id = self.send_request(b'start-service', service_info)
+        self.pending_services[req_id] = fut
         try:
-            result = await self.service_queue.get()
-            self.service_queue.task_done()
-            return json.loads(result)
+            # Keep it pending to skip its reply when the caller is cancelled.
+            return await asyncio.shield(fut)
         except asyncio.CancelledError:
-            return {'status': 'failed', 'error': 'cancelled'}
+            if fut.cancelled():  # the runner is closed
+                return {'status': 'failed', 'error': 'cancelled'}
+            raise
 
     async def watchdog(self):
         try:
@@ -199,7 +616,9 @@ class KernelRunner:
             pass
 
     @staticmethod
-    def aggregate_console(result, records, api_ver):
+    def aggregate_console(result, records, api_ver, unpack_payload=json.loads):
+
+        result['truncated'] = False
 
         if api_ver == 1:
 
@@ -214,10 +633,11 @@ class KernelRunner:
                 elif rec.msg_type == 'stderr':
                     stderr_items.append(rec.data)
                 elif rec.msg_type == 'media':
-                    o = json.loads(rec.data)
-                    media_items.append((o['type'], o['data']))
+                    media_items.append(_get_media(rec, unpack_payload))
                 elif rec.msg_type == 'html':
                     html_items.append(rec.data)
+                elif rec.msg_type == 'truncated':
+                    result['truncated'] = True
 
             result['stdout'] = ''.join(stdout_items)
             result['stderr'] = ''.join(stderr_items)
@@ -227,38 +647,33 @@ class KernelRunner:
         elif api_ver in (2, 3):
 
             console_items = []
-            last_stdout = io.StringIO()
-            last_stderr = io.StringIO()
+            # The stdout/stderr records are already merged while being read,
+            # but adjacent ones may still remain across the read batches.
+            text_items = []  # (index in console_items, text chunks)
+            last_text_type = None
 
             for rec in records:
-
-                if last_stdout.tell() and rec.msg_type != 'stdout':
-                    console_items.append(('stdout', last_stdout.getvalue()))
-                    last_stdout.seek(0)
-                    last_stdout.truncate(0)
-                if last_stderr.tell() and rec.msg_type != 'stderr':
-                    console_items.append(('stderr', last_stderr.getvalue()))
-                    last_stderr.seek(0)
-                    last_stderr.truncate(0)
-
-                if rec.msg_type == 'stdout':
-                    last_stdout.write(rec.data)
-                elif rec.msg_type == 'stderr':
-                    last_stderr.write(rec.data)
-                elif rec.msg_type == 'media':
-                    o = json.loads(rec.data)
-                    console_items.append((rec.msg_type, (o['type'], o['data'])))
+                if rec.msg_type in ('stdout', 'stderr'):
+                    if rec.msg_type == last_text_type:
+                        text_items[-1][1].append(rec.data)
+                    else:
+                        text_items.append((len(console_items), [rec.data]))
+                        console_items.append((rec.msg_type, None))
+                        last_text_type = rec.msg_type
+                    continue
+                if rec.msg_type == 'truncated':
+                    result['truncated'] = True
+                    continue
+                last_text_type = None
+                if rec.msg_type == 'media':
+                    console_items.append(
+                        (rec.msg_type, _get_media(rec, unpack_payload)))
                 elif rec.msg_type in outgoing_msg_types:
                     console_items.append((rec.msg_type, rec.data))
 
-            if last_stdout.tell():
-                console_items.append(('stdout', last_stdout.getvalue()))
-            if last_stderr.tell():
-                console_items.append(('stderr', last_stderr.getvalue()))
-
+            for idx, chunks in text_items:
+                console_items[idx] = (console_items[idx][0], ''.join(chunks))
             result['console'] = console_items
-            last_stdout.close()
-            last_stderr.close()
 
         else:
             raise AssertionError('Unrecognized API version')
@@ -266,36 +681,43 @@ class KernelRunner:
     async def get_next_result(self, api_ver=2, flush_timeout=2.0):
         # Context: per API request
         has_continuation = ClientFeatures.CONTINUATION in self.client_features
+        is_streaming = self.current_run_id in self.streaming_runs
+        if is_streaming:
+            # The outputs are already published, so there is nothing to flush
+            # until the run reaches its next status.
+            has_continuation = False
+        buf = self.output_buffer
         try:
-            records = []
+            records = ()
             with timeout(flush_timeout if has_continuation else None):
                 while True:
-                    rec = await self.output_queue.get()
-                    if rec.msg_type in outgoing_msg_types:
-                        records.append(rec)
+                    seq, rec = await self.output_queue.get()
                     self.output_queue.task_done()
+                    # The outputs produced before this status
+                    records = buf.drain(seq)
+                    # The payloads of status records are already decoded.
                     if rec.msg_type == 'finished':
-                        data = json.loads(rec.data) if rec.data else {}
-                        raise RunFinished(data)
+                        raise RunFinished(rec.data)
                     elif rec.msg_type == 'clean-finished':
-                        data = json.loads(rec.data) if rec.data else {}
-                        raise CleanFinished(data)
+                        raise CleanFinished(rec.data)
                     elif rec.msg_type == 'build-finished':
-                        data = json.loads(rec.data) if rec.data else {}
-                        raise BuildFinished(data)
+                        raise BuildFinished(rec.data)
                     elif rec.msg_type == 'waiting-input':
-                        opts = json.loads(rec.data) if rec.data else {}
-                        raise InputRequestPending(opts)
+                        raise InputRequestPending(rec.data)
                     elif rec.msg_type == 'exec-timeout':
                         raise ExecTimeout
         except asyncio.TimeoutError:
+            records = buf.drain()
             result = {
                 'runId': self.current_run_id,
                 'status': 'continued',
                 'exitCode': None,
                 'options': None,
             }
-            type(self).aggregate_console(result, records, api_ver)
+            type(self).aggregate_console(result, records, api_ver,
+                                         self.unpack_payload)
+            if is_streaming:
+                self.publish_result(result)
             self.resume_output_queue()
             return result
         except CleanFinished as e:
@@ -305,17 +727,28 @@ class KernelRunner:
                 'exitCode': e.data.get('exitCode'),
                 'options': None,
             }
-            type(self).aggregate_console(result, records, api_ver)
+            type(self).aggregate_console(result, records, api_ver,
+                                         self.unpack_payload)
+            if is_streaming:
+                self.publish_result(result)
             self.resume_output_queue()
             return result
         except BuildFinished as e:
+            if self.current_run_id in self.cached_build_runs:
+                self.cached_build_runs.discard(self.current_run_id)
+                status = 'build-cached'
+            else:
+                status = 'build-finished'
             result = {
                 'runId': self.current_run_id,
-                'status': 'build-finished',
+                'status': status,
                 'exitCode': e.data.get('exitCode'),
                 'options': None,
             }
-            type(self).aggregate_console(result, records, api_ver)
+            type(self).aggregate_console(result, records, api_ver,
+                                         self.unpack_payload)
+            if is_streaming:
+                self.publish_result(result)
             self.resume_output_queue()
             return result
         except RunFinished as e:
@@ -325,7 +758,10 @@ class KernelRunner:
                 'exitCode': e.data.get('exitCode'),
                 'options': None,
             }
-            type(self).aggregate_console(result, records, api_ver)
+            type(self).aggregate_console(result, records, api_ver,
+                                         self.unpack_payload)
+            if is_streaming:
+                self.publish_result(result)
             self.next_output_queue()
             return result
         except ExecTimeout:
@@ -337,7 +773,10 @@ class KernelRunner:
             }
             log.warning('Execution timeout detected on kernel '
                         f'{self.kernel_id}')
-            type(self).aggregate_console(result, records, api_ver)
+            type(self).aggregate_console(result, records, api_ver,
+                                         self.unpack_payload)
+            if is_streaming:
+                self.publish_result(result)
             self.next_output_queue()
             return result
         except InputRequestPending as e:
@@ -347,7 +786,10 @@ class KernelRunner:
                 'exitCode': None,
                 'options': e.data,
             }
-            type(self).aggregate_console(result, records, api_ver)
+            type(self).aggregate_console(result, records, api_ver,
+                                         self.unpack_payload)
+            if is_streaming:
+                self.publish_result(result)
             self.resume_output_queue()
             return result
         except asyncio.CancelledError:
@@ -357,19 +799,39 @@ class KernelRunner:
             log.exception('unexpected error')
             raise
 
-    async def attach_output_queue(self, run_id):
+    async def attach_output_queue(self, run_id, *, stream=False, received_at=None):
         # Context: per API request
+        if stream:
+            if self.output_pub is None:
+                raise RuntimeError('Output streaming is not enabled in this agent.')
+            if run_id is None:
+                raise ValueError('A run ID is required to stream the outputs.')
+            self.streaming_runs.add(run_id)
         if run_id is None:
             run_id = secrets.token_hex(16)
         assert run_id is not None
         if run_id not in self.pending_queues:
-            q = asyncio.Queue(maxsize=4096)
+            # Only the status records go through the queue while the outputs
+            # are kept in the buffer.
+            q = asyncio.Queue()
+            spill_path = None
+            if self.spill_dir is not None:
+                spill_path = self.spill_dir / f'{secrets.token_hex(8)}.spill'
+            buf = OutputBuffer(spill_path,
+                               memory_limit=self.output_memory_limit,
+                               max_size=self.max_run_output_size)
             activated = asyncio.Event()
-            self.pending_queues[run_id] = (activated, q)
+            self.pending_queues[run_id] = (activated, q, buf)
         else:
-            activated, q = self.pending_queues[run_id]
+            activated, q, buf = self.pending_queues[run_id]
+        timings = self.run_timings.get(run_id)
+        if timings is None:
+            timings = RunTimings(received_at or time.monotonic())
+            self.run_timings[run_id] = timings
         if self.output_queue is None:
             self.output_queue = q
+            self.output_buffer = buf
+            self.output_run_id = run_id
         else:
             if self.current_run_id == run_id:
                 # No need to wait if we are continuing.
@@ -377,8 +839,15 @@ class KernelRunner:
             else:
                 # If there is an outstanding ongoning execution,
                 # wait until it has "finished".
-                await activated.wait()
+                wait_begin = time.monotonic()
+                try:
+                    await activated.wait()
+                except asyncio.CancelledError:
+                    # The caller is gone; a retry starts measuring again.
+                    self.run_timings.pop(run_id, None)
+                    raise
                 activated.clear()
+                timings.queued += time.monotonic() - wait_begin
         self.current_run_id = run_id
         assert self.output_queue is q
 
@@ -399,81 +868,319 @@ class KernelRunner:
         '''
         assert self.current_run_id is not None
         self.pending_queues.pop(self.current_run_id, None)
+        self.streaming_runs.discard(self.current_run_id)
+        self.cached_build_runs.discard(self.current_run_id)
+        timings = self.run_timings.pop(self.current_run_id, None)
+        if timings is not None:
+            timings.finished_at = time.monotonic()
+            self.finished_run_timings[self.current_run_id] = timings
+            while len(self.finished_run_timings) > self.finished_run_timings_size:
+                self.finished_run_timings.popitem(last=False)
         self.current_run_id = None
+        if self.output_buffer is not None:
+            self.output_buffer.close()
         if len(self.pending_queues) > 0:
             # Make the next waiting API request handler to proceed.
-            _, (activated, q) = self.pending_queues.popitem(last=False)
+            run_id, (activated, q, buf) = self.pending_queues.popitem(last=False)
             self.output_queue = q
+            self.output_buffer = buf
+            self.output_run_id = run_id
             activated.set()
         else:
             # If there is no pending request, just ignore all outputs
             # from the kernel.
             self.output_queue = None
+            self.output_buffer = None
+            self.output_run_id = None
+        # Forget the runs detached without finishing, e.g., interrupted ones.
+        for run_id in [run_id for run_id in self.run_timings
+                       if run_id != self.output_run_id and
+                       run_id not in self.pending_queues]:
+            del self.run_timings[run_id]
+
+    async def save_state(self, path):
+        '''
+        Writes the states of the ongoing runs to the journal at *path*, so that
+        the runner created by the next agent process can resume them via
+        restore_state().  The outputs buffered in memory are moved to the spill
+        files, which are kept after closing the runner.
+        Returns False if there is nothing to save.
+        '''
+        # Stop receiving outputs to take a consistent snapshot.
+        if self.read_task and not self.read_task.done():
+            self.read_task.cancel()
+            await self.read_task
+            self.read_task = None
+        runs = []
+        if self.output_queue is not None:
+            runs.append((self.output_run_id, self.output_queue, self.output_buffer))
+        for run_id, (_, q, buf) in self.pending_queues.items():
+            if run_id != self.output_run_id:
+                runs.append((run_id, q, buf))
+        if not runs:
+            return False
+        journal = {
+            'version': 2,
+            'current_run_id': self.current_run_id,
+            'output_run_id': self.output_run_id,
+            'runs': [],
+        }
+        for run_id, q, buf in runs:
+            statuses = []
+            while not q.empty():
+                statuses.append(q.get_nowait())
+            for item in statuses:
+                q.put_nowait(item)
+            journal['runs'].append({
+                'run_id': run_id,
+                'pending': run_id in self.pending_queues,
+                'streamed': run_id in self.streaming_runs,
+                'statuses': [(seq, rec.msg_type, rec.data) for seq, rec in statuses],
+                'buffer': buf.persist(),
+            })
+        # The status payloads of msgpack kernels may contain bytes.
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_bytes(_pack_msgpack(journal))
+        os.rename(tmp_path, path)
+        self.state_saved = True
+        return True
+
+    def restore_state(self, path):
+        '''
+        Restores the states of the runs saved by save_state() and removes the
+        journal.  Returns False if there is no journal.
+        '''
+        try:
+            journal = _unpack_msgpack(path.read_bytes())
+        except FileNotFoundError:
+            return False
+        finally:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        for item in journal['runs']:
+            run_id = item['run_id']
+            q = asyncio.Queue()
+            for seq, msg_type, data in item['statuses']:
+                q.put_nowait((seq, ResultRecord(msg_type, data)))
+            buf = OutputBuffer.restore(item['buffer'],
+                                       memory_limit=self.output_memory_limit,
+                                       max_size=self.max_run_output_size)
+            if item['pending']:
+                self.pending_queues[run_id] = (asyncio.Event(), q, buf)
+            if run_id == journal['output_run_id']:
+                self.output_queue = q
+                self.output_buffer = buf
+                self.output_run_id = run_id
+            if item['streamed'] and self.output_pub is not None:
+                self.streaming_runs.add(run_id)
+        self.current_run_id = journal['current_run_id']
+        return True
+
+    def pop_run_timings(self, run_id):
+        '''
+        Takes the timings of a finished run.
+        '''
+        return self.finished_run_timings.pop(run_id, None)
+
+    def publish_record(self, run_id, rec):
+        if isinstance(rec.data, bytes):
+            data = rec.data
+        else:
+            data = rec.data.encode('utf8') if rec.data is not None else b''
+        self.output_pub.write([
+            run_id.encode('utf8'),
+            rec.msg_type.encode('ascii'),
+            data,
+        ])
+
+    def publish_result(self, result):
+        '''
+        Publishes the status of a streamed run after all its outputs so that
+        the subscribers can tell where the outputs of each call end.
+        '''
+        self.publish_record(self.current_run_id, ResultRecord(
+            'result', json.dumps({
+                'status': result['status'],
+                'exitCode': result['exitCode'],
+                'options': result['options'],
+            })))
+
+    async def read_frames(self):
+        '''
+        Waits for the next output frame and takes all the frames already
+        received together (up to *max_read_batch*) without further waiting.
+        '''
+        frames = [await self.output_sock.recv_multipart()]
+        while len(frames) < self.max_read_batch:
+            try:
+                # This does not yield to the event loop.
+                frames.append(await self.output_sock.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        return frames
 
     async def read_output(self):
         # We should use incremental decoder because some kernels may
         # send us incomplete UTF-8 byte sequences (e.g., Julia).
-        decoders = (
-            codecs.getincrementaldecoder('utf8')(errors='replace'),
-            codecs.getincrementaldecoder('utf8')(errors='replace'),
-        )
+        decoders = {
+            b'stdout': codecs.getincrementaldecoder('utf8')(errors='replace'),
+            b'stderr': codecs.getincrementaldecoder('utf8')(errors='replace'),
+        }
         while True:
             try:
-                msg_type, msg_data = await self.output_stream.read()
-                # TODO: test if save-load runner states is working
-                #       by printing received messages here
-                if len(msg_data) > self.max_record_size:
-                    msg_data = msg_data[:self.max_record_size]
-                try:
-                    if msg_type == b'status':
-                        msgpack.unpackb(msg_data, encoding='utf8')
-                        # TODO: not implemented yet
-                    elif msg_type == b'completion':
-                        # As completion is processed asynchronously
-                        # to the main code execution, we directly
-                        # put the result into a separate queue.
-                        await self.completion_queue.put(msg_data)
-                    elif msg_type == b'service-result':
-                        await self.service_queue.put(msg_data)
-                    elif msg_type == b'stdout':
-                        if self.output_queue is None:
-                            continue
-                        await self.output_queue.put(
-                            ResultRecord(
-                                'stdout',
-                                decoders[0].decode(msg_data),
-                            ))
-                    elif msg_type == b'stderr':
-                        if self.output_queue is None:
-                            continue
-                        await self.output_queue.put(
-                            ResultRecord(
-                                'stderr',
-                                decoders[1].decode(msg_data),
-                            ))
-                    else:
-                        # Normal outputs should go to the current
-                        # output queue.
-                        if self.output_queue is None:
-                            continue
-                        await self.output_queue.put(
-                            ResultRecord(
-                                msg_type.decode('ascii'),
-                                msg_data.decode('utf8'),
-                            ))
-                except asyncio.QueueFull:
-                    pass
-                if msg_type == b'build-finished':
-                    # finalize incremental decoder
-                    decoders[0].decode(b'', True)
-                    decoders[1].decode(b'', True)
-                elif msg_type == b'finished':
-                    # finalize incremental decoder
-                    decoders[0].decode(b'', True)
-                    decoders[1].decode(b'', True)
-                    self.finished_at = time.monotonic()
-            except (asyncio.CancelledError, aiozmq.ZmqStreamClosed, GeneratorExit):
+                frames = await self.read_frames()
+            except (asyncio.CancelledError, zmq.ZMQError, GeneratorExit):
                 break
+            try:
+                self.process_frames(frames, decoders)
             except Exception:
                 log.exception('unexpected error')
                 break
+
+    def resolve_completion(self, req_id, data):
+        entry = self.pop_pending_request(self.pending_completions, req_id)
+        if entry is None:
+            log.warning('dropping an unknown completion result of kernel {0}',
+                        self.kernel_id)
+            return
+        key, fut = entry
+        try:
+            result = self.unpack_payload(data)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        # Cache the result even if the request is superseded.
+        self.completion_cache[key] = (
+            time.monotonic() + self.completion_cache_ttl, result)
+        self.completion_cache.move_to_end(key)
+        while len(self.completion_cache) > self.completion_cache_size:
+            self.completion_cache.popitem(last=False)
+        if not fut.done():
+            fut.set_result(result)
+
+    def resolve_service(self, req_id, data):
+        fut = self.pop_pending_request(self.pending_services, req_id)
+        if fut is None:
+            log.warning('dropping an unknown service result of kernel {0}',
+                        self.kernel_id)
+            return
+        if fut.done():
+            return
+        try:
+            fut.set_result(self.unpack_payload(data))
+        except Exception as e:
+            fut.set_exception(e)
+
+    def decode_status_payload(self, rec_type, msg_data):
+        if not msg_data:
+            return {}
+        try:
+            return self.unpack_payload(msg_data)
+        except Exception:
+            log.warning('invalid {0} payload from kernel {1}',
+                        rec_type, self.kernel_id)
+            return {}
+
+    def decode_media_payload(self, msg_data):
+        try:
+            o = self.unpack_payload(msg_data)
+            return (o['type'], o['data'])
+        except Exception:
+            log.warning('invalid media payload from kernel {0}', self.kernel_id)
+            return None
+
+    def process_frames(self, frames, decoders):
+        # Adjacent stdout/stderr fragments of a batch are merged into
+        # a single record.
+        text_type = None
+        text_chunks = []
+        has_output = False
+
+        def flush_text():
+            nonlocal text_type
+            if text_chunks:
+                self.output_buffer.append(
+                    ResultRecord(text_type.decode('ascii'), ''.join(text_chunks)))
+                text_chunks.clear()
+            text_type = None
+
+        for msg_type, msg_data, *msg_extra in frames:
+            # TODO: test if save-load runner states is working
+            #       by printing received messages here
+            if len(msg_data) > self.max_record_size:
+                msg_data = msg_data[:self.max_record_size]
+            if msg_type == b'status':
+                msgpack.unpackb(msg_data, encoding='utf8')
+                # TODO: not implemented yet
+            elif msg_type == b'completion':
+                # As completion is processed asynchronously
+                # to the main code execution, we directly
+                # resolve the future of the request.
+                self.resolve_completion(msg_extra[0] if msg_extra else None,
+                                        msg_data)
+            elif msg_type == b'service-result':
+                self.resolve_service(msg_extra[0] if msg_extra else None,
+                                     msg_data)
+            elif self.output_queue is None:
+                continue
+            else:
+                rec_type = msg_type.decode('ascii')
+                is_output = rec_type in outgoing_msg_types
+                is_streamed = self.output_run_id in self.streaming_runs
+                if is_output:
+                    has_output = True
+                if (is_output and not is_streamed and
+                        not self.output_buffer.reserve(len(msg_data))):
+                    # Skip decoding the outputs over the budget of the run.
+                    continue
+                media = None
+                if msg_type in decoders:
+                    data = decoders[msg_type].decode(msg_data)
+                    if not is_streamed:
+                        if msg_type != text_type:
+                            flush_text()
+                            text_type = msg_type
+                        text_chunks.append(data)
+                        continue
+                elif msg_type in status_payload_msg_types:
+                    data = self.decode_status_payload(rec_type, msg_data)
+                elif msg_type == b'media':
+                    # The raw payload is kept for spilling and publishing.
+                    data = msg_data
+                    if not is_streamed:
+                        media = self.decode_media_payload(msg_data)
+                        if media is None:
+                            continue
+                else:
+                    data = msg_data.decode('utf8')
+                rec = ResultRecord(rec_type, data, media)
+                if not is_output:
+                    # Status records mark the end of the outputs to be
+                    # returned together.
+                    flush_text()
+                    self.output_queue.put_nowait((self.output_buffer.end, rec))
+                elif is_streamed:
+                    # Streamed outputs are published immediately
+                    # instead of being aggregated in the results.
+                    if rec.data:
+                        self.publish_record(self.output_run_id, rec)
+                else:
+                    flush_text()
+                    self.output_buffer.append(rec)
+            if msg_type == b'build-finished':
+                # finalize incremental decoder
+                decoders[b'stdout'].decode(b'', True)
+                decoders[b'stderr'].decode(b'', True)
+            elif msg_type == b'finished':
+                # finalize incremental decoder
+                decoders[b'stdout'].decode(b'', True)
+                decoders[b'stderr'].decode(b'', True)
+                self.finished_at = time.monotonic()
+        flush_text()
+        if has_output:
+            timings = self.run_timings.get(self.output_run_id)
+            if timings is not None and timings.first_output_at is None:
+                timings.first_output_at = time.monotonic()
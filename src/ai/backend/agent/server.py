@@ -46,7 +46,10 @@ from .files import scandir, upload_output_files_to_s3
 from .accelerator import accelerator_types, AbstractAccelerator
 from .stats import (
     get_preferred_stat_type, collect_agent_live_stats,
-    spawn_stat_collector, StatCollectorState,
+    StatBuffer, StatCollector, StatCollectorState, StatHistory,
+    LiveStatAggregator, HostCPUSampler, ProcessStatSampler, RunLatencyStats,
+    decode_stat_message, summarize_stat_history,
+    STAT_MSG_OOM,
 )
 from .resources import (
     KernelResourceSpec,
@@ -55,6 +58,7 @@ from .resources import (
     CPUAllocMap,
     AcceleratorAllocMap,
 )
+from .buildcache import BuildCache
 from .kernel import KernelRunner, KernelFeatures
 from .utils import update_nested_dict
 from .vendor.linux import libnuma
@@ -63,6 +67,8 @@ log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.server'))
 
 max_upload_size = 100 * 1024 * 1024  # 100 MB
 stat_cache_lifespan = 30.0  # 30 secs
+runner_journal_name = 'runner-state.msgpack'
+runner_ready_timeout = 60.0  # 60 secs
 
 
 @attr.s(auto_attribs=True, slots=True)
@@ -192,13 +198,22 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         'docker', 'container_registry', 'container_cpu_map',
         'redis_stat_pool',
         'etcd', 'config', 'slots', 'images',
-        'rpc_server', 'event_sock',
-        'monitor_fetch_task', 'monitor_handle_task', 'stat_collector_task',
+        'rpc_server', 'event_sock', 'stream_sock',
+        'monitor_fetch_task', 'monitor_handle_task',
+        'stat_collector', 'stat_collector_task',
+        'stat_buffer', 'stat_flush_timer',
+        'live_stats', 'host_cpu_sampler',
+        'proc_stat_sampler', 'proc_stat_timer',
+        'run_latency', 'build_cache',
         'hb_timer', 'clean_timer',
         'stats_monitor', 'error_monitor',
         'restarting_kernels', 'blocking_cleans',
     )
 
+    # The stat collector checks the liveness of containers every 10 seconds
+    # in case the "die" events are missed.
+    stat_terminate_timeout = 15.0
+
     def __init__(self, config, loop=None):
         self.loop = loop if loop else asyncio.get_event_loop()
         self.config = config
@@ -218,12 +233,22 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
 
         self.rpc_server = None
         self.event_sock = None
+        self.stream_sock = None
         self.scan_images_timer = None
         self.monitor_fetch_task = None
         self.monitor_handle_task = None
         self.hb_timer = None
         self.clean_timer = None
+        self.stat_collector = None
         self.stat_collector_task = None
+        self.stat_buffer = None
+        self.stat_flush_timer = None
+        self.live_stats = LiveStatAggregator()
+        self.host_cpu_sampler = None
+        self.proc_stat_sampler = None
+        self.proc_stat_timer = None
+        self.run_latency = RunLatencyStats()
+        self.build_cache = None
 
         self.port_pool = set(range(
             config.container_port_range[0],
@@ -233,8 +258,6 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         self.stats_monitor = DummyStatsMonitor()
         self.error_monitor = DummyErrorMonitor()
 
-        self.runner_lock = asyncio.Lock()
-
         plugins = [
             'stats_monitor',
             'error_monitor'
@@ -343,6 +366,8 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                 self.container_registry[kernel_id] = {
                     'lang': ImageRef(image),
                     'version': int(get_label(labels, 'version', '1')),
+                    'kernel_features':
+                        set(get_label(labels, 'features', '').split()),
                     'container_id': container._id,
                     'kernel_host': kernel_host,
                     'repl_in_port': port_map[2000],
@@ -352,9 +377,12 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                     'exec_timeout': int(get_label(labels, 'timeout', '10')),
                     'last_used': time.monotonic(),
                     'runner_tasks': set(),
+                    'runner_lock': asyncio.Lock(),
                     'host_ports': [*port_map.values()],
                     'resource_spec': resource_spec,
                     'service_ports': service_ports,
+                    'owner_access_key':
+                        get_label(labels, 'owner-access-key', None),
                 }
             elif status in {'exited', 'dead', 'removing'}:
                 log.info('detected terminated kernel: {0}', kernel_id)
@@ -403,46 +431,101 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             return
         log.debug('interrupting & cleaning up runner for {0}', kernel_id)
         item = self.container_registry[kernel_id]
+        # Let the runners being started discard themselves.
+        item['runner_generation'] = item.get('runner_generation', 0) + 1
         tasks = item['runner_tasks'].copy()
         for t in tasks:  # noqa: F402
             if not t.done():
                 t.cancel()
-                await t
+                try:
+                    await t
+                except asyncio.CancelledError:
+                    pass  # cancelled before reaching its own handler
+        # The pending build-cache lookups are never continued after this.
+        item.pop('build_cache_runs', None)
         runner = item.pop('runner', None)
         if runner is not None:
             await runner.close()
 
-    async def collect_stats(self):
+    async def save_runner_state(self, kernel_id):
+        runner = self.container_registry[kernel_id].get('runner')
+        if runner is None:
+            return
+        journal_path = self.config.scratch_root / kernel_id / runner_journal_name
+        try:
+            if await runner.save_state(journal_path):
+                log.debug('saved the runner state of kernel {0}', kernel_id)
+        except Exception:
+            log.exception('cannot save the runner state of kernel {0}', kernel_id)
+
+    async def collect_stats(self, stat_path):
         context = zmq.asyncio.Context()
         stats_sock = context.socket(zmq.PULL)
         stats_sock.setsockopt(zmq.LINGER, 1000)
-        stats_sock.bind(f'tcp://127.0.0.1:{self.config.stat_port}')
-        log.info('collecting stats at port tcp://127.0.0.1:{0}',
-                 self.config.stat_port)
+        stats_sock.bind('ipc://' + str(stat_path))
+        log.info('collecting stats at ipc://{0}', stat_path)
         try:
-            recv = functools.partial(stats_sock.recv_serialized,
-                                     lambda vs: [msgpack.unpackb(v) for v in vs])
-            async for msg in aiotools.aiter(lambda: recv(), None):
-                cid = msg[0]['cid']
-                status = msg[0]['status']
-                if cid not in self.stats:
-                    # If the agent has restarted, the events dict may be empty.
-                    container = self.docker.containers.container(cid)
-                    kernel_id = await get_kernel_id_from_container(container)
-                    self.stats[cid] = StatCollectorState(kernel_id)
-                self.stats[cid].last_stat = msg[0]['data']
-                kernel_id = self.stats[cid].kernel_id
-                pipe = self.redis_stat_pool.pipeline()
-                pipe.hmset_dict(kernel_id, msg[0]['data'])
-                pipe.expire(kernel_id, stat_cache_lifespan)
-                await pipe.execute()
-                if status == 'terminated':
-                    self.stats[cid].terminated.set()
+            async for data in aiotools.aiter(lambda: stats_sock.recv(), None):
+                # The collector daemon sends the stats of all containers
+                # as a single batch on each tick.
+                try:
+                    msg_type, records = decode_stat_message(data)
+                except ValueError as e:
+                    log.warning('dropping malformed stat message: {0}', e)
+                    continue
+                if msg_type == STAT_MSG_OOM:
+                    await self.handle_oom(records)
+                    continue
+                now = time.time()
+                for record in records:
+                    cid = self.stat_collector.get_cid(record.handle)
+                    if record.terminated:
+                        self.stat_collector.release(record.handle)
+                    state = self.stats.get(cid)
+                    if state is None:
+                        continue
+                    # The records are decoded only when they are actually read.
+                    state.last_stat = record
+                    if self.config.stat_history_size > 0:
+                        if state.history is None:
+                            state.history = StatHistory(
+                                self.config.stat_history_size)
+                        state.history.append(now, record)
+                    self.stat_buffer.put(state.kernel_id, record)
+                    if record.terminated:
+                        self.live_stats.remove(cid)
+                        state.terminated.set()
+                    else:
+                        self.live_stats.update(cid, record)
         except asyncio.CancelledError:
             pass
         finally:
             stats_sock.close()
             context.term()
+            try:
+                stat_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def handle_oom(self, records):
+        for record in records:
+            cid = self.stat_collector.get_cid(record.handle)
+            state = self.stats.get(cid)
+            if state is None:
+                continue
+            state.oom_killed = True
+            state.last_stat = record
+            self.live_stats.update(cid, record)
+            log.warning('OOM kill in kernel {0} (container {1})',
+                        state.kernel_id, cid[:7])
+            await self.send_event('kernel_oom', state.kernel_id, record.to_dict())
+
+    async def sample_process_stats(self, interval):
+        cids = [cid for cid, state in self.stats.items()
+                if not state.terminated.is_set()]
+        # Reading procfs for all processes may take a while with many kernels.
+        await self.loop.run_in_executor(
+            None, self.proc_stat_sampler.sample, cids)
 
     async def init(self, *, skip_detect_manager=False):
         # Show Docker version info.
@@ -483,21 +566,53 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             zmq.PUSH, connect=f'tcp://{self.config.event_addr}')
         self.event_sock.transport.setsockopt(zmq.LINGER, 50)
 
+        if self.config.stream_port is not None:
+            stream_addr = f'tcp://*:{self.config.stream_port}'
+            self.stream_sock = await aiozmq.create_zmq_stream(
+                zmq.PUB, bind=stream_addr)
+            self.stream_sock.transport.setsockopt(zmq.LINGER, 50)
+            log.info('publishing streamed outputs at {0}', stream_addr)
+
+        if self.config.build_cache_dir is not None:
+            self.build_cache = BuildCache(self.config.build_cache_dir)
+
         # Spawn image scanner task.
         self.scan_images_timer = aiotools.create_timer(self.scan_images, 60.0)
 
         # Spawn stat collector task.
         self.stats = dict()
-        self.stat_collector_task = self.loop.create_task(self.collect_stats())
-
-        # Start container stats collector for existing containers.
-        stat_addr = f'tcp://{self.config.agent_host}:{self.config.stat_port}'
+        try:
+            self.host_cpu_sampler = HostCPUSampler()
+        except OSError:
+            log.warning('cannot read /proc/stat; host CPU usage is not reported.')
+        self.stat_buffer = StatBuffer(self.redis_stat_pool, stat_cache_lifespan,
+                                      stats_monitor=self.stats_monitor)
+        self.stat_flush_timer = aiotools.create_timer(
+            self.stat_buffer.flush, self.config.stat_flush_interval)
+        ipc_base_path = Path('/tmp/backend.ai/ipc')
+        ipc_base_path.mkdir(parents=True, exist_ok=True)
+        stat_path = ipc_base_path / f'stats-{os.getpid()}.sock'
+        self.stat_collector_task = self.loop.create_task(
+            self.collect_stats(stat_path))
+
+        # Spawn the stat collector daemon and register existing containers.
         stat_type = get_preferred_stat_type()
+        self.stat_collector = StatCollector('ipc://' + str(stat_path), stat_type)
+        await self.stat_collector.start()
         for kernel_id, info in self.container_registry.items():
             cid = info['container_id']
             self.stats[cid] = StatCollectorState(kernel_id)
-            async with spawn_stat_collector(stat_addr, stat_type, cid):
+            scratch_dir = self.config.scratch_root / kernel_id
+            async with self.stat_collector.register(cid, scratch_dir):
                 pass
+        if self.config.proc_stat_interval > 0:
+            if stat_type == 'cgroup':
+                self.proc_stat_sampler = ProcessStatSampler()
+                self.proc_stat_timer = aiotools.create_timer(
+                    self.sample_process_stats, self.config.proc_stat_interval)
+            else:
+                log.warning('per-process stats require cgroup access; '
+                            'disabled.')
 
         # Spawn docker monitoring tasks.
         self.monitor_fetch_task  = self.loop.create_task(self.fetch_docker_events())
@@ -533,7 +648,12 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
 
         # Close all pending kernel runners.
         for kernel_id in self.container_registry.keys():
+            if stop_signal != signal.SIGTERM:
+                # The kernels survive, so let the next agent resume the runs.
+                await self.save_runner_state(kernel_id)
             await self.clean_runner(kernel_id)
+        if self.stream_sock is not None:
+            self.stream_sock.close()
 
         if stop_signal == signal.SIGTERM:
             await self.clean_all_kernels(blocking=True)
@@ -561,10 +681,21 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             pass
         await self.docker.close()
 
-        # Stop stat collector task.
+        # Stop the stat collector daemon and its receiver task.
+        if self.stat_collector is not None:
+            await self.stat_collector.close()
         if self.stat_collector_task is not None:
             self.stat_collector_task.cancel()
             await self.stat_collector_task
+        if self.stat_flush_timer is not None:
+            self.stat_flush_timer.cancel()
+            await self.stat_flush_timer
+            await self.stat_buffer.flush()
+        if self.host_cpu_sampler is not None:
+            self.host_cpu_sampler.close()
+        if self.proc_stat_timer is not None:
+            self.proc_stat_timer.cancel()
+            await self.proc_stat_timer
 
         if self.redis_stat_pool is not None:
             self.redis_stat_pool.close()
@@ -623,7 +754,7 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                               text: str, opts: dict):
         log.debug('rpc::get_completions({0})', kernel_id)
         async with self.handle_rpc_exception():
-            await self._get_completions(kernel_id, text, opts)
+            return await self._get_completions(kernel_id, text, opts)
 
     @aiozmq.rpc.method
     @update_last_used
@@ -632,6 +763,34 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         async with self.handle_rpc_exception():
             return await self._get_logs(kernel_id)
 
+    @aiozmq.rpc.method
+    @update_last_used
+    async def wait_kernel_ready(self, kernel_id: str,
+                                timeout: float = 10.0) -> dict:
+        log.debug('rpc::wait_kernel_ready({0})', kernel_id)
+        async with self.handle_rpc_exception():
+            return await self._wait_kernel_ready(kernel_id, timeout)
+
+    @aiozmq.rpc.method
+    async def get_stat_history(self, kernel_id: str,
+                               duration: float = 60.0,
+                               step: float = 5.0) -> dict:
+        log.debug('rpc::get_stat_history({0})', kernel_id)
+        async with self.handle_rpc_exception():
+            return self._get_stat_history(kernel_id, duration, step)
+
+    @aiozmq.rpc.method
+    async def get_process_stats(self, kernel_id: str, limit: int = 10) -> dict:
+        log.debug('rpc::get_process_stats({0})', kernel_id)
+        async with self.handle_rpc_exception():
+            return self._get_process_stats(kernel_id, limit)
+
+    @aiozmq.rpc.method
+    async def get_run_latency_stats(self, image: str = None) -> dict:
+        log.debug('rpc::get_run_latency_stats({0})', image)
+        async with self.handle_rpc_exception():
+            return self.run_latency.summarize(image, detail=True)
+
     @aiozmq.rpc.method
     @update_last_used
     async def restart_kernel(self, kernel_id: str, new_config: dict):
@@ -743,6 +902,8 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                'The manager should have resolved the image reference!'
 
         environ: dict = kernel_config.get('environ', {})
+        # The build cache is shared only among the kernels of the same owner.
+        owner_access_key = kernel_config.get('owner_access_key')
         extra_mount_list = await get_extra_volumes(self.docker, image_ref.short)
 
         try:
@@ -970,6 +1131,8 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                 f'{port}/tcp': {} for port in exposed_ports
             },
             'Env': [f'{k}={v}' for k, v in environ.items()],
+            'Labels': ({'ai.backend.owner-access-key': owner_access_key}
+                       if owner_access_key is not None else {}),
             'HostConfig': {
                 'MemorySwap': 0,
                 'Memory': resource_spec.memory_limit,
@@ -996,11 +1159,10 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                 config=container_config, name=kernel_name)
             cid = container._id
 
-            stat_addr = f'tcp://{self.config.agent_host}:{self.config.stat_port}'
-            stat_type = get_preferred_stat_type()
             self.stats[cid] = StatCollectorState(kernel_id)
-            async with spawn_stat_collector(stat_addr, stat_type, cid):
+            async with self.stat_collector.register(cid, scratch_dir):
                 await container.start()
+            started_at = time.monotonic()
         except Exception:
             # Oops, we have to restore the allocated resources!
             shutil.rmtree(scratch_dir)
@@ -1035,6 +1197,7 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         self.container_registry[kernel_id] = {
             'lang': image_ref,
             'version': version,
+            'kernel_features': kernel_features,
             'container_id': container._id,
             'kernel_host': kernel_host,
             'repl_in_port': repl_in_port,
@@ -1046,12 +1209,16 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             'exec_timeout': exec_timeout,
             'last_used': time.monotonic(),
             'runner_tasks': set(),
+            'runner_lock': asyncio.Lock(),
             'resource_spec': resource_spec,
+            'owner_access_key': owner_access_key,
         }
         log.debug('kernel repl-in address: {0}:{1}', kernel_host, repl_in_port)
         log.debug('kernel repl-out address: {0}:{1}', kernel_host, repl_out_port)
         for service_port in service_ports.values():
             log.debug('service port: {!r}', service_port)
+        if self.config.eager_runner:
+            self.loop.create_task(self._warm_up_runner(kernel_id, started_at))
         return {
             'id': kernel_id,
             'kernel_host': kernel_host,
@@ -1082,9 +1249,20 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             # Collect the last-moment statistics.
             last_stat = None
             if cid in self.stats:
-                await self.stats[cid].terminated.wait()
+                try:
+                    with timeout(self.stat_terminate_timeout):
+                        await self.stats[cid].terminated.wait()
+                except asyncio.TimeoutError:
+                    log.warning('_destroy_kernel({0}) the final stat has not '
+                                'arrived in time', kernel_id)
+                finally:
+                    # No-ops if the terminated record has been handled.
+                    self.live_stats.remove(cid)
+                    await self.stat_collector.unregister(cid)
                 last_stat = self.stats[cid].last_stat
                 del self.stats[cid]
+                if last_stat is not None:
+                    last_stat = last_stat.to_dict()
             # The container will be deleted in the docker monitoring coroutine.
             return last_stat
         except DockerError as e:
@@ -1111,31 +1289,104 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             self.error_monitor.capture_exception()
 
     async def _ensure_runner(self, kernel_id, *, api_version=3):
-        # TODO: clean up
-        async with self.runner_lock:
-            runner = self.container_registry[kernel_id].get('runner')
-            if runner is not None:
-                log.debug('_execute_code:v{0}({1}) use '
-                          'existing runner', api_version, kernel_id)
-            else:
-                client_features = {'input', 'continuation'}
-                runner = KernelRunner(
-                    kernel_id,
-                    self.container_registry[kernel_id]['kernel_host'],
-                    self.container_registry[kernel_id]['repl_in_port'],
-                    self.container_registry[kernel_id]['repl_out_port'],
-                    self.container_registry[kernel_id]['exec_timeout'],
-                    client_features)
-                log.debug('_execute:v{0}({1}) start new runner',
-                          api_version, kernel_id)
-                self.container_registry[kernel_id]['runner'] = runner
-                # TODO: restoration of runners after agent restarts
-                await runner.start()
-            return runner
+        kernel_info = self.container_registry[kernel_id]
+        runner = kernel_info.get('runner')
+        if runner is None:
+            # Only the first request creates the runner while the concurrent
+            # requests to the same kernel wait for it.  Requests to other
+            # kernels are not blocked even when this takes long.
+            async with kernel_info['runner_lock']:
+                runner = kernel_info.get('runner')
+                if runner is None:
+                    generation = kernel_info.get('runner_generation', 0)
+                    client_features = {'input', 'continuation'}
+                    spill_dir = self.config.scratch_root / kernel_id / 'output-spill'
+                    runner = KernelRunner(
+                        kernel_id,
+                        kernel_info['kernel_host'],
+                        kernel_info['repl_in_port'],
+                        kernel_info['repl_out_port'],
+                        kernel_info['exec_timeout'],
+                        client_features,
+                        kernel_features=kernel_info['kernel_features'],
+                        output_pub=self.stream_sock,
+                        spill_dir=spill_dir)
+                    log.debug('_execute:v{0}({1}) start new runner',
+                              api_version, kernel_id)
+                    # Resume the runs of the runner of the previous agent.
+                    journal_path = (self.config.scratch_root / kernel_id /
+                                    runner_journal_name)
+                    try:
+                        if runner.restore_state(journal_path):
+                            log.info('restored the runner state of kernel {0}',
+                                     kernel_id)
+                    except Exception:
+                        log.exception('cannot restore the runner state of '
+                                      'kernel {0}', kernel_id)
+                    try:
+                        await runner.start()
+                    except BaseException:
+                        await runner.close()
+                        raise
+                    if (self.container_registry.get(kernel_id) is not kernel_info or
+                            kernel_info.get('runner_generation', 0) != generation):
+                        # The kernel has been cleaned or destroyed meanwhile.
+                        await runner.close()
+                        raise RuntimeError(
+                            f'The runner for kernel {kernel_id} has been cleaned '
+                            'up while starting (try it again)')
+                    # Register it only after starting so that other requests
+                    # taking the fast path above never see a half-started one.
+                    kernel_info['runner'] = runner
+                    return runner
+        log.debug('_execute_code:v{0}({1}) use '
+                  'existing runner', api_version, kernel_id)
+        return runner
+
+    async def _warm_up_runner(self, kernel_id, started_at):
+        myself = asyncio.Task.current_task()
+        kernel_info = None
+        try:
+            kernel_info = self.container_registry.get(kernel_id)
+            if kernel_info is None:
+                return  # destroyed before this task has started
+            # Let clean_runner() cancel it.
+            kernel_info['runner_tasks'].add(myself)
+            runner = await self._ensure_runner(kernel_id)
+            await runner.wait_ready(runner_ready_timeout)
+        except asyncio.CancelledError:
+            return
+        except asyncio.TimeoutError:
+            log.warning('the runner of kernel {0} is not ready in {1} sec',
+                        kernel_id, runner_ready_timeout)
+            return
+        except Exception:
+            log.exception('failed to warm up the runner of kernel {0}', kernel_id)
+            self.error_monitor.capture_exception()
+            return
+        finally:
+            if kernel_info is not None:
+                kernel_info['runner_tasks'].discard(myself)
+        time_to_ready = runner.ready_at - started_at
+        image_key = re.sub(r'[^\w-]', '_', kernel_info['lang'].short)
+        log.debug('the runner of kernel {0} is ready in {1:.3f} sec',
+                  kernel_id, time_to_ready)
+        self.stats_monitor.report_stats(
+            'timing', f'ai.backend.agent.runner.time_to_ready.{image_key}',
+            time_to_ready * 1000)
+
+    async def _wait_kernel_ready(self, kernel_id, timeout):
+        runner = await self._ensure_runner(kernel_id)
+        try:
+            await runner.wait_ready(timeout)
+        except asyncio.TimeoutError:
+            return {'status': 'starting'}
+        return {'status': 'ready'}
 
     async def _execute(self, api_version, kernel_id,
                        run_id, mode, text, opts,
                        flush_timeout):
+        received_at = time.monotonic()
         # Save kernel-generated output files in a separate sub-directory
         # (to distinguish from user-uploaded files)
         output_dir = self.config.scratch_root / kernel_id / 'work' / '.output'
@@ -1160,13 +1411,28 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             myself = asyncio.Task.current_task()
             kernel_info['runner_tasks'].add(myself)
 
-            await runner.attach_output_queue(run_id)
+            await runner.attach_output_queue(
+                run_id, stream=bool(opts.get('stream', False)),
+                received_at=received_at)
 
             if mode == 'batch' or mode == 'query':
                 kernel_info['initial_file_stats'] \
                     = scandir(output_dir, max_upload_size)
             if mode == 'batch':
-                await runner.feed_batch(opts)
+                if (self.build_cache is not None and
+                        kernel_info.get('owner_access_key') is not None and
+                        opts.get('build_cache', False) and opts.get('build')):
+                    # Send the build command after the clean phase to look up
+                    # the cache with the cleaned work directory.
+                    build_cache_runs = kernel_info.setdefault('build_cache_runs', {})
+                    build_cache_runs[runner.current_run_id] = {
+                        'opts': opts,
+                        'key': None,
+                        'file_stats': None,
+                    }
+                    await runner.feed_batch(opts, phases=('clean',))
+                else:
+                    await runner.feed_batch(opts)
             elif mode == 'query':
                 await runner.feed_code(text)
             elif mode == 'input':
@@ -1187,21 +1453,33 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             if runner_tasks is not None:
                 runner_tasks.remove(myself)
 
+        build_cache_runs = kernel_info.get('build_cache_runs')
+        if build_cache_runs and result['runId'] in build_cache_runs:
+            await self._proceed_cached_build(kernel_id, runner,
+                                             build_cache_runs, result)
+
         output_files = []
 
         if result['status'] in ('finished', 'exec-timeout'):
 
             log.debug('_execute({0}) {1}', kernel_id, result['status'])
 
+            upload_time = None
             final_file_stats = scandir(output_dir, max_upload_size)
             if utils.nmget(result, 'options.upload_output_files', True):
                 # TODO: separate as a new task
                 initial_file_stats = \
                     kernel_info['initial_file_stats']
+                upload_begin = time.monotonic()
                 output_files = await upload_output_files_to_s3(
                     initial_file_stats, final_file_stats, output_dir, kernel_id)
+                upload_time = time.monotonic() - upload_begin
 
             kernel_info.pop('initial_file_stats', None)
+            timings = runner.pop_run_timings(result['runId'])
+            if timings is not None:
+                self.record_run_latency(kernel_info['lang'].short,
+                                        timings, upload_time)
 
         if (result['status'] == 'exec-timeout' and
                 kernel_id in self.container_registry):
@@ -1214,9 +1492,67 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             'files': output_files,
         }
 
+    async def _proceed_cached_build(self, kernel_id, runner,
+                                    build_cache_runs, result):
+        loop = asyncio.get_event_loop()
+        run_id = result['runId']
+        state = build_cache_runs[run_id]
+        opts = state['opts']
+        work_dir = self.config.scratch_root / kernel_id / 'work'
+        if result['status'] == 'clean-finished':
+            kernel_info = self.container_registry[kernel_id]
+            access_key = kernel_info['owner_access_key']
+            image = kernel_info['lang'].canonical
+            build_cmd = opts['build']
+            try:
+                key, file_stats = await loop.run_in_executor(
+                    None, self.build_cache.compute_key,
+                    access_key, image, build_cmd, work_dir)
+                state['key'], state['file_stats'] = key, file_stats
+                if key is not None and await loop.run_in_executor(
+                        None, self.build_cache.restore, key, work_dir):
+                    log.debug('_execute({0}) restored the build outputs', kernel_id)
+                    runner.mark_build_cached(run_id)
+                    build_cmd = ''  # skip the build
+                    state['key'] = None
+            except OSError:
+                log.exception('cannot look up the build cache')
+                state['key'] = None
+            await runner.feed_batch({'build': build_cmd}, phases=('build',))
+        elif result['status'] in ('build-finished', 'build-cached'):
+            if state['key'] is not None and result['exitCode'] == 0:
+                try:
+                    num_outputs = await loop.run_in_executor(
+                        None, self.build_cache.store,
+                        state['key'], work_dir, state['file_stats'])
+                    log.debug('_execute({0}) cached {1} build outputs',
+                              kernel_id, num_outputs)
+                except OSError:
+                    log.exception('cannot store the build outputs')
+            # Send the exec command only after taking the build outputs.
+            await runner.feed_batch(opts, phases=('exec',))
+            del build_cache_runs[run_id]
+
+    def record_run_latency(self, image, timings, upload_time):
+        first_output = None
+        if timings.first_output_at is not None:
+            first_output = timings.first_output_at - timings.received_at
+        self.run_latency.record(
+            image,
+            queue=timings.queued,
+            first_output=first_output,
+            run=timings.finished_at - timings.received_at,
+            upload=upload_time,
+            total=time.monotonic() - timings.received_at)
+
     async def _get_completions(self, kernel_id, text, opts):
         runner = await self._ensure_runner(kernel_id)
-        result = await runner.feed_and_get_completion(text, opts)
+        opts = dict(opts)
+        supersede = opts.pop('supersede', False)
+        result = await runner.feed_and_get_completion(text, opts,
+                                                      supersede=supersede)
+        if result is None:
+            return {'status': 'cancelled', 'completions': []}
         return {'status': 'finished', 'completions': result}
 
     async def _get_logs(self, kernel_id):
@@ -1225,6 +1561,26 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         logs = await container.log(stdout=True, stderr=True)
         return {'logs': ''.join(logs)}
 
+    def _get_stat_history(self, kernel_id, duration, step):
+        if duration <= 0 or step <= 0:
+            raise ValueError('duration and step must be positive.')
+        container_id = self.container_registry[kernel_id]['container_id']
+        state = self.stats.get(container_id)
+        history = state.history if state is not None else None
+        if history is None:
+            history = StatHistory(1)  # no samples yet
+        return summarize_stat_history(history, now=time.time(),
+                                      duration=duration, step=step)
+
+    def _get_process_stats(self, kernel_id, limit):
+        if limit <= 0:
+            raise ValueError('limit must be positive.')
+        container_id = self.container_registry[kernel_id]['container_id']
+        if self.proc_stat_sampler is None:
+            # per-process stats are disabled
+            return {'sampled_at': None, 'processes': []}
+        return self.proc_stat_sampler.get_top(container_id, limit)
+
     async def _interrupt_kernel(self, kernel_id):
         runner = await self._ensure_runner(kernel_id)
         await runner.feed_interrupt()
@@ -1346,7 +1702,11 @@ print(json.dumps(files))''' % {'path': path}
             'cpu_slots': self.slots['cpu'],
             'gpu_slots': self.slots['gpu'],  # TODO: generalize
             'images': snappy.compress(msgpack.packb(list(self.images))),
+            'run_latency': self.run_latency.summarize(),
         }
+        if self.config.stream_port is not None:
+            agent_info['stream_addr'] = \
+                f'tcp://{self.config.agent_host}:{self.config.stream_port}'
         try:
             await self.send_event('instance_heartbeat', agent_info)
         except asyncio.TimeoutError:
@@ -1400,6 +1760,10 @@ print(json.dumps(files))''' % {'path': path}
             if evdata['Action'] == 'die':
                 # When containers die, we immediately clean up them.
                 container_id = evdata['Actor']['ID']
+                if self.stat_collector is not None:
+                    # Let the collector report the final stat right now
+                    # so that _destroy_kernel() does not wait for a tick.
+                    await self.stat_collector.notify_died(container_id)
                 container_name = evdata['Actor']['Attributes']['name']
                 kernel_id = await get_kernel_id_from_container(container_name)
                 if kernel_id is None:
@@ -1411,8 +1775,15 @@ print(json.dumps(files))''' % {'path': path}
                 log.debug('docker-event: container-terminated: '
                           '{0} with exit code {1} ({2})',
                           container_id[:7], exit_code, kernel_id)
+                state = self.stats.get(container_id)
+                if (state is not None and state.oom_killed and
+                        str(exit_code) == '137'):
+                    # The main process has been killed by the OOM killer.
+                    reason = 'oom-killed'
+                else:
+                    reason = 'self-terminated'
                 await self.send_event('kernel_terminated',
-                                      kernel_id, 'self-terminated',
+                                      kernel_id, reason,
                                       None)
                 asyncio.ensure_future(self.clean_kernel(kernel_id))
 
@@ -1548,10 +1919,30 @@ def main():
     parser.add('--agent-port', type=port_no, default=6001,
                env_var='BACKEND_AGENT_PORT',
                help='The port number to listen on.')
+    parser.add('--stream-port', type=port_no, default=None,
+               env_var='BACKEND_STREAM_PORT',
+               help='The port number to publish the execution outputs of runs '
+                    'requested to be streamed, using their run IDs as the topics. '
+                    '(default: disabled)')
     parser.add('--stat-port', type=port_no, default=6002,
                env_var='BACKEND_STAT_PORT',
-               help='The port number to receive statistics reports from '
-                    'local containers.')
+               help='(deprecated) No longer used since the statistics reports '
+                    'are now delivered via a local IPC socket.')
+    parser.add('--stat-history-size', type=non_negative_int, default=300,
+               env_var='BACKEND_STAT_HISTORY_SIZE',
+               help='The number of recent stat samples kept in memory for each '
+                    'kernel (default: 300, i.e., 5 minutes at the default '
+                    'sampling interval).  Set zero to disable the stat history.')
+    parser.add('--stat-flush-interval', type=float, default=1.0,
+               env_var='BACKEND_STAT_FLUSH_INTERVAL',
+               help='The interval in seconds to write the latest container '
+                    'statistics to Redis in a batch. (default: 1.0)')
+    parser.add('--proc-stat-interval', type=float, default=0.0,
+               env_var='BACKEND_PROC_STAT_INTERVAL',
+               help='The interval in seconds to sample the per-process CPU and '
+                    'memory usage inside kernels, served via the '
+                    'get_process_stats RPC.  It requires the cgroup stat '
+                    'collection.  (default: 0, i.e., disabled)')
     parser.add('--container-port-range', type=port_range, default=(30000, 31000),
                env_var='BACKEND_CONTAINER_PORT_RANGE',
                help='The range of host public ports to be used by containers '
@@ -1580,6 +1971,16 @@ def main():
                     'If set, the agent mounts it into the containers '
                     'so that you can test and debug the latest hook code '
                     'with immediate changes.')
+    parser.add('--build-cache-dir', type=Path, default=None,
+               env_var='BACKEND_BUILD_CACHE_DIR',
+               help='If set, the build outputs of batch-mode executions with the '
+                    '"build_cache" option are cached in this directory and '
+                    'reused when the same owner builds the same inputs again.')
+    parser.add('--eager-runner', action='store_true', default=False,
+               env_var='BACKEND_EAGER_RUNNER',
+               help='If specified, starts the kernel runners in the background '
+                    'right after creating the kernels, so that the first '
+                    'executions do not wait for connecting to them.')
     parser.add('--debug-skip-container-deletion', action='store_true', default=False,
                help='If specified, skips container deletion when container is dead '
                     'or killed.  You may check the container logs for additional '
@@ -6,13 +6,16 @@ Reference: https://www.datadoghq.com/blog/how-to-collect-docker-metrics/
 
 import asyncio
 import argparse
-from contextlib import closing, contextmanager
-from ctypes import CDLL, get_errno
-from dataclasses import asdict, dataclass, field
+from array import array
+import bisect
+from contextlib import closing
+from dataclasses import dataclass, field, fields, replace
 import functools
+import inspect
 import logging
 import os
 from pathlib import Path
+import struct
 import sys
 import time
 
@@ -20,34 +23,36 @@ import aiohttp
 from aiodocker.docker import Docker, DockerContainer
 from aiodocker.exceptions import DockerError
 import aiotools
+from async_timeout import timeout
 from setproctitle import setproctitle
 import zmq
 import zmq.asyncio
 
-from ai.backend.common import msgpack
 from ai.backend.common.utils import nmget
 from ai.backend.common.logging import Logger, BraceStyleAdapter
 from ai.backend.common.identity import is_containerized
+from .vendor.linux import eventfd, inotify, libnuma
 
 __all__ = (
     'ContainerStat',
     'StatCollectorState',
+    'StatRecord', 'encode_stat_batch', 'decode_stat_batch', 'decode_stat_message',
+    'StatHistory', 'summarize_stat_history',
+    'StatBuffer', 'LiveStatAggregator', 'HostCPUSampler',
     'check_cgroup_available',
     'get_preferred_stat_type',
-    'spawn_stat_collector',
+    'StatCollector',
     'numeric_list', 'read_sysfs',
+    'SysfsFile', 'get_host_veth_names',
+    'CgroupSampler', 'CgroupV1Sampler', 'CgroupV2Sampler',
+    'get_cgroup_version',
+    'ScratchUsageIndex',
+    'ProcessStatSampler',
+    'LatencyHistogram', 'RunLatencyStats',
 )
 
 log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.stats'))
 
-CLONE_NEWNET = 0x40000000
-
-
-def _errcheck(ret, func, args):
-    if ret == -1:
-        e = get_errno()
-        raise OSError(e, os.strerror(e))
-
 
 def check_cgroup_available():
     '''
@@ -67,10 +72,10 @@ def get_preferred_stat_type():
 
 @dataclass(frozen=False)
 class ContainerStat:
-    precpu_used: int = 0
-    cpu_used: int = 0
-    precpu_system_used: int = 0
-    cpu_system_used: int = 0
+    precpu_used: float = 0
+    cpu_used: float = 0
+    precpu_system_used: float = 0
+    cpu_system_used: float = 0
     mem_max_bytes: int = 0
     mem_cur_bytes: int = 0
     net_rx_bytes: int = 0
@@ -79,6 +84,23 @@ class ContainerStat:
     io_write_bytes: int = 0
     io_max_scratch_size: int = 0
     io_cur_scratch_size: int = 0
+    # CPU throttling by the CFS quota (cumulative)
+    cpu_nr_throttled: int = 0
+    cpu_throttled_time: float = 0  # msec
+    # pressure stall information (avg10, in percent)
+    cpu_pressure_some: float = 0
+    mem_pressure_some: float = 0
+    mem_pressure_full: float = 0
+    io_pressure_some: float = 0
+    io_pressure_full: float = 0
+    # memory breakdown
+    mem_rss_bytes: int = 0
+    mem_cache_bytes: int = 0
+    mem_mapped_file_bytes: int = 0
+    mem_swap_bytes: int = 0
+    # resident memory on the NUMA nodes in/out of the container's cpuset.mems
+    mem_numa_local_bytes: int = 0
+    mem_numa_remote_bytes: int = 0
 
     def update(self, stat: 'ContainerStat'):
         if stat is None:
@@ -96,180 +118,1899 @@ class ContainerStat:
         self.io_max_scratch_size = max(self.io_max_scratch_size,
                                        stat.io_cur_scratch_size)
         self.io_cur_scratch_size = stat.io_cur_scratch_size
+        self.cpu_nr_throttled = max(self.cpu_nr_throttled, stat.cpu_nr_throttled)
+        self.cpu_throttled_time = max(self.cpu_throttled_time,
+                                      stat.cpu_throttled_time)
+        self.cpu_pressure_some = stat.cpu_pressure_some
+        self.mem_pressure_some = stat.mem_pressure_some
+        self.mem_pressure_full = stat.mem_pressure_full
+        self.io_pressure_some = stat.io_pressure_some
+        self.io_pressure_full = stat.io_pressure_full
+        self.mem_rss_bytes = stat.mem_rss_bytes
+        self.mem_cache_bytes = stat.mem_cache_bytes
+        self.mem_mapped_file_bytes = stat.mem_mapped_file_bytes
+        self.mem_swap_bytes = stat.mem_swap_bytes
+        self.mem_numa_local_bytes = stat.mem_numa_local_bytes
+        self.mem_numa_remote_bytes = stat.mem_numa_remote_bytes
 
 
 @dataclass(frozen=False)
 class StatCollectorState:
     kernel_id: str
     last_stat: ContainerStat = None
+    history: 'StatHistory' = None
+    oom_killed: bool = False
     terminated: asyncio.Event = field(default_factory=lambda: asyncio.Event())
 
 
+# The collector sends each batch as a single fixed-layout binary message:
+# a header (version, message type, record count) followed by the records,
+# each of which is a container handle, a status code, and the ContainerStat
+# fields in their declaration order.
+# Bump STAT_WIRE_VERSION whenever the layout changes.
+STAT_WIRE_VERSION = 3
+STAT_MSG_BATCH = 1
+STAT_MSG_OOM = 2  # the memory stats taken right after OOM kills
+STAT_STATUS_RUNNING = 0
+STAT_STATUS_TERMINATED = 1
+
+_stat_fields = tuple(f.name for f in fields(ContainerStat))
+_stat_header = struct.Struct('!BBH')
+_stat_record_head = struct.Struct('!IB')
+_stat_record = struct.Struct('!IB' + ''.join(
+    'd' if f.type is float else 'q' for f in fields(ContainerStat)))
+
+
+def _stat_record_view(names):
+    '''
+    Builds a struct which unpacks only the given fields from a packed record,
+    skipping over the others, and the field names in the unpacked order.
+    '''
+    fmt = [f'!{_stat_record_head.size}x']
+    picked = []
+    for f in fields(ContainerStat):
+        if f.name in names:
+            fmt.append('d' if f.type is float else 'q')
+            picked.append(f.name)
+        else:
+            fmt.append('8x')  # both 'd' and 'q' are 8 bytes wide
+    return struct.Struct(''.join(fmt)), tuple(picked)
+
+
+def encode_stat_batch(records, msg_type=STAT_MSG_BATCH):
+    '''
+    Packs a list of (handle, status, ContainerStat) tuples into a batch message.
+    '''
+    buf = bytearray(_stat_header.size + _stat_record.size * len(records))
+    _stat_header.pack_into(buf, 0, STAT_WIRE_VERSION, msg_type, len(records))
+    offset = _stat_header.size
+    for handle, status, stat in records:
+        _stat_record.pack_into(buf, offset, handle, status,
+                               *(getattr(stat, name) for name in _stat_fields))
+        offset += _stat_record.size
+    return buf
+
+
+def decode_stat_message(data):
+    '''
+    Splits a message into its type and StatRecord objects without unpacking
+    the counters.
+    '''
+    if len(data) < _stat_header.size:
+        raise ValueError('truncated stat message')
+    version, msg_type, count = _stat_header.unpack_from(data, 0)
+    if version != STAT_WIRE_VERSION:
+        raise ValueError(f'unsupported stat wire version: {version}')
+    if msg_type not in (STAT_MSG_BATCH, STAT_MSG_OOM):
+        raise ValueError(f'unknown stat message type: {msg_type}')
+    if len(data) != _stat_header.size + _stat_record.size * count:
+        raise ValueError('stat message length mismatch')
+    offset = _stat_header.size
+    records = []
+    for _ in range(count):
+        records.append(StatRecord(data, offset))
+        offset += _stat_record.size
+    return msg_type, records
+
+
+def decode_stat_batch(data):
+    msg_type, records = decode_stat_message(data)
+    if msg_type != STAT_MSG_BATCH:
+        raise ValueError(f'not a stat batch message: {msg_type}')
+    return records
+
+
+class StatRecord:
+    '''
+    A lazily decoded stat record of a container.
+    Only the handle and the status are unpacked up front; the counters are
+    unpacked on the first access.
+    '''
+
+    __slots__ = ('handle', 'status', '_buf', '_offset', '_data')
+
+    def __init__(self, buf, offset):
+        self.handle, self.status = _stat_record_head.unpack_from(buf, offset)
+        self._buf = buf
+        self._offset = offset
+        self._data = None
+
+    @property
+    def terminated(self):
+        return self.status == STAT_STATUS_TERMINATED
+
+    def to_dict(self):
+        if self._data is None:
+            values = _stat_record.unpack_from(self._buf, self._offset)
+            self._data = dict(zip(_stat_fields, values[2:]))
+            self._buf = None  # release the batch buffer
+        return self._data
+
+    def __getitem__(self, key):
+        return self.to_dict()[key]
+
+    def pick(self, view):
+        '''
+        Unpacks only the fields of a view from _stat_record_view() as a dict,
+        without decoding the whole record.
+        '''
+        view_struct, names = view
+        if self._buf is not None:
+            return dict(zip(names, view_struct.unpack_from(self._buf, self._offset)))
+        return {name: self._data[name] for name in names}
+
+    def raw(self):
+        '''
+        Returns the packed bytes of the record without decoding it.
+        '''
+        if self._buf is not None:
+            return self._buf[self._offset:self._offset + _stat_record.size]
+        return _stat_record.pack(self.handle, self.status,
+                                 *(self._data[name] for name in _stat_fields))
+
+
+# The cumulative fields reported as per-second rates in the stat history.
+# The other fields are gauges reported as they are.
+_counter_fields = ('cpu_used', 'net_rx_bytes', 'net_tx_bytes',
+                   'io_read_bytes', 'io_write_bytes',
+                   'cpu_nr_throttled', 'cpu_throttled_time')
+_gauge_fields = ('mem_max_bytes', 'mem_cur_bytes',
+                 'io_max_scratch_size', 'io_cur_scratch_size',
+                 'cpu_pressure_some', 'mem_pressure_some', 'mem_pressure_full',
+                 'io_pressure_some', 'io_pressure_full',
+                 'mem_rss_bytes', 'mem_cache_bytes', 'mem_mapped_file_bytes',
+                 'mem_swap_bytes', 'mem_numa_local_bytes',
+                 'mem_numa_remote_bytes')
+
+
+class StatHistory:
+    '''
+    A fixed-size ring buffer of the recent stat samples of a kernel.
+
+    The samples are kept as the packed StatRecord bytes and decoded only
+    when they are read by snapshot().
+    '''
+
+    __slots__ = ('capacity', 'timestamps', 'records', 'head', 'size')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.records = bytearray(_stat_record.size * capacity)
+        self.head = 0  # the next slot to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, ts, record):
+        pos = self.head
+        rec_size = _stat_record.size
+        self.timestamps[pos] = ts
+        self.records[pos * rec_size:(pos + 1) * rec_size] = record.raw()
+        self.head = (pos + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def _ordered(self, buf, unit=1):
+        if self.size < self.capacity:
+            return buf[:self.size * unit]
+        return buf[self.head * unit:] + buf[:self.head * unit]
+
+    def snapshot(self, since=None):
+        '''
+        Returns the timestamps and the field values of the samples taken
+        at or after *since* in the chronological order.
+        '''
+        timestamps = self._ordered(self.timestamps)
+        begin = 0
+        if since is not None:
+            begin = bisect.bisect_left(timestamps, since)
+        rec_size = _stat_record.size
+        records = self._ordered(self.records, rec_size)[begin * rec_size:]
+        values = list(zip(*_stat_record.iter_unpack(records)))
+        if not values:
+            values = [()] * (len(_stat_fields) + 2)
+        columns = dict(zip(_stat_fields, values[2:]))
+        return timestamps[begin:], columns
+
+
+def _percentile(sorted_values, pct):
+    # nearest-rank method
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize_stat_history(history, *, now, duration=60.0, step=5.0,
+                           percentiles=(50, 95, 99)):
+    '''
+    Downsamples the recent samples of a StatHistory into *step*-second buckets
+    and calculates the percentiles and peaks of them.
+
+    The counter fields are converted to per-second rates (``cpu_used`` becomes
+    ``cpu_pct``), which are averaged within each bucket, while the gauge
+    fields take the maximum of each bucket.
+    Percentiles are calculated from the full-resolution samples.
+    '''
+    timestamps, columns = history.snapshot(since=now - duration)
+    rates = {}
+    for name in _counter_fields:
+        values = columns[name]
+        series = []
+        for i in range(1, len(timestamps)):
+            dt = timestamps[i] - timestamps[i - 1]
+            delta = values[i] - values[i - 1]
+            series.append(max(delta, 0) / dt if dt > 0 else 0.0)
+        if name == 'cpu_used':
+            # msec per sec -> percent of a single core
+            rates['cpu_pct'] = [v / 10 for v in series]
+        else:
+            rates[name] = series
+    gauges = {name: list(columns[name][1:]) for name in _gauge_fields}
+    sample_ts = timestamps[1:]
+
+    num_buckets = max(1, int(-(-duration // step)))
+    bucket_begin = now - duration
+    buckets = [[] for _ in range(num_buckets)]
+    for i, ts in enumerate(sample_ts):
+        # Each bucket covers (begin, end] and is labeled by its end.
+        idx = int(-(-(ts - bucket_begin) // step)) - 1
+        buckets[min(max(idx, 0), num_buckets - 1)].append(i)
+    series = {}
+    for name, values in rates.items():
+        series[name] = [(sum(values[i] for i in b) / len(b)) if b else None
+                        for b in buckets]
+    for name, values in gauges.items():
+        series[name] = [max(values[i] for i in b) if b else None
+                        for b in buckets]
+    summary = {}
+    for name, values in {**rates, **gauges}.items():
+        ordered = sorted(values)
+        item = {f'p{p}': _percentile(ordered, p) for p in percentiles}
+        item['max'] = ordered[-1] if ordered else None
+        summary[name] = item
+    return {
+        'timestamps': [bucket_begin + (i + 1) * step for i in range(num_buckets)],
+        'series': series,
+        'summary': summary,
+        'num_samples': len(sample_ts),
+    }
+
+
+class LatencyHistogram:
+    '''
+    Counts latencies (in msec) into fixed exponential buckets, so that its
+    size stays constant regardless of the number of observations.
+    '''
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    # The upper bounds of the buckets, followed by the overflow bucket.
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500,
+              1000, 2000, 5000, 10000, 30000, 60000, 300000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, msec):
+        self.counts[bisect.bisect_left(self.bounds, msec)] += 1
+        self.count += 1
+        self.sum += msec
+        if msec > self.max:
+            self.max = msec
+
+    def percentile(self, pct):
+        '''
+        Returns the upper bound of the bucket having the given percentile,
+        capped by the maximum observed.
+        '''
+        if self.count == 0:
+            return None
+        rank = max(1, int(-(-pct * self.count // 100)))
+        for idx, count in enumerate(self.counts):
+            rank -= count
+            if rank <= 0:
+                break
+        if idx < len(self.bounds):
+            return min(self.bounds[idx], self.max)
+        return self.max
+
+    def summarize(self, percentiles=(50, 95, 99)):
+        item = {f'p{p}': self.percentile(p) for p in percentiles}
+        item['count'] = self.count
+        item['avg'] = self.sum / self.count if self.count else None
+        item['max'] = self.max if self.count else None
+        return item
+
+    def to_dict(self):
+        return {
+            'bounds': [*self.bounds, None],  # None for the overflow bucket
+            'counts': list(self.counts),
+            **self.summarize(),
+        }
+
+
+class RunLatencyStats:
+    '''
+    Keeps the latency histograms of the execution runs per kernel image.
+
+    The phases are:
+
+    * queue: the time waiting behind the other runs of the same kernel
+    * first_output: from receiving the request to the first output of the run
+    * run: from receiving the request to the completion of the run
+    * upload: the time to upload the output files after the completion
+    * total: from receiving the request to returning the final result
+    '''
+
+    phases = ('queue', 'first_output', 'run', 'upload', 'total')
+
+    def __init__(self):
+        self.histograms = {}  # image -> phase -> LatencyHistogram
+
+    def record(self, image, **durations):
+        histograms = self.histograms.get(image)
+        if histograms is None:
+            histograms = {phase: LatencyHistogram() for phase in self.phases}
+            self.histograms[image] = histograms
+        for phase, secs in durations.items():
+            if secs is not None:
+                histograms[phase].observe(secs * 1000)
+
+    def summarize(self, image=None, *, detail=False):
+        '''
+        Returns the percentiles of each phase per image, or the full
+        histograms if *detail* is set.
+        '''
+        if image is not None:
+            images = [image] if image in self.histograms else []
+        else:
+            images = list(self.histograms)
+        return {
+            image: {
+                phase: hist.to_dict() if detail else hist.summarize()
+                for phase, hist in self.histograms[image].items()
+            }
+            for image in images
+        }
+
+
+# The avg10 pressure (in percent) over which a kernel is regarded as contended.
+contention_threshold = 10.0
+
+
+class LiveStatAggregator:
+    '''
+    Maintains the agent-wide aggregates of the latest stats of running kernels.
+
+    update() replaces the previous contribution of the kernel with the one of
+    the new record, unpacking only the fields needed here, so that each record
+    costs O(1) and the heartbeat only reads the running totals.
+    '''
+
+    _pressure_keys = ('cpu', 'mem', 'io')
+    _view = _stat_record_view({
+        'cpu_used', 'precpu_used', 'cpu_system_used', 'precpu_system_used',
+        'mem_cur_bytes', 'cpu_throttled_time',
+        'cpu_pressure_some', 'mem_pressure_some', 'io_pressure_some',
+    })
+
+    def __init__(self):
+        self.contribs = {}  # cid -> contribution tuple
+        self.cpu_delta = 0.0
+        self.system_delta = 0.0
+        self.mem_cur_bytes = 0
+        self.cpu_throttled_time = 0.0
+        self.num_contended_kernels = 0
+        self.pressure_max = {key: 0.0 for key in self._pressure_keys}
+        self.pressure_holder = {key: None for key in self._pressure_keys}
+
+    @classmethod
+    def _contribution(cls, record):
+        values = record.pick(cls._view)
+        pressures = tuple(values[f'{key}_pressure_some']
+                          for key in cls._pressure_keys)
+        return (
+            values['cpu_used'] - values['precpu_used'],
+            values['cpu_system_used'] - values['precpu_system_used'],
+            values['mem_cur_bytes'],
+            values['cpu_throttled_time'],
+            any(p >= contention_threshold for p in pressures),
+            pressures,
+        )
+
+    def _apply(self, contrib, sign):
+        cpu_delta, system_delta, mem_cur_bytes, throttled_time, contended, _ = \
+            contrib
+        self.cpu_delta += sign * cpu_delta
+        self.system_delta += sign * system_delta
+        self.mem_cur_bytes += sign * mem_cur_bytes
+        self.cpu_throttled_time += sign * throttled_time
+        self.num_contended_kernels += sign * int(contended)
+
+    def _update_pressure_max(self, cid, pressures):
+        for idx, key in enumerate(self._pressure_keys):
+            value = pressures[idx] if pressures is not None else None
+            if value is not None and value >= self.pressure_max[key]:
+                self.pressure_max[key] = value
+                self.pressure_holder[key] = cid
+            elif self.pressure_holder[key] == cid:
+                # The maximum has decreased; rescan the kernels only in this case.
+                holder, peak = None, 0.0
+                for other_cid, contrib in self.contribs.items():
+                    if contrib[5][idx] >= peak:
+                        holder, peak = other_cid, contrib[5][idx]
+                self.pressure_max[key] = peak
+                self.pressure_holder[key] = holder
+
+    def update(self, cid, record):
+        contrib = self._contribution(record)
+        prev = self.contribs.get(cid)
+        if prev is not None:
+            self._apply(prev, -1)
+        self._apply(contrib, 1)
+        self.contribs[cid] = contrib
+        self._update_pressure_max(cid, contrib[5])
+
+    def remove(self, cid):
+        prev = self.contribs.pop(cid, None)
+        if prev is None:
+            return
+        self._apply(prev, -1)
+        self._update_pressure_max(cid, None)
+
+    def get_cpu_pct(self, num_cores):
+        # CPU usage calculation ref: https://bit.ly/2rrfrFF
+        if self.system_delta > 0 and self.cpu_delta > 0:
+            return (self.cpu_delta / self.system_delta) * num_cores * 100
+        return 0
+
+
+class HostCPUSampler:
+    '''
+    Calculates the CPU utilization of the whole host from /proc/stat
+    between consecutive calls.
+    '''
+
+    def __init__(self, path='/proc/stat'):
+        self.file = SysfsFile(path)
+        self.last_busy = self.last_total = None
+
+    def close(self):
+        self.file.close()
+
+    def sample(self):
+        # The first line is the sum of all CPUs:
+        #   cpu  user nice system idle iowait irq softirq steal guest guest_nice
+        line = self.file.read().split(b'\n', 1)[0]
+        values = [int(v) for v in line.split()[1:9]]
+        total = sum(values)
+        busy = total - values[3] - values[4]  # excluding idle and iowait
+        pct = 0.0
+        if self.last_total is not None and total > self.last_total:
+            pct = (busy - self.last_busy) / (total - self.last_total) * 100
+        self.last_busy, self.last_total = busy, total
+        return pct
+
+
 async def collect_agent_live_stats(agent):
     """Store agent live stats in redis stats server.
     """
     from .server import stat_cache_lifespan
+    live_stats = agent.live_stats
     num_cores = agent.container_cpu_map.num_cores
-    precpu_used = cpu_used = mem_cur_bytes = 0
-    precpu_sys_used = cpu_sys_used = 0
-    for cid, cstate in agent.stats.items():
-        if not cstate.terminated.is_set() and cstate.last_stat is not None:
-            precpu_used += float(cstate.last_stat['precpu_used'])
-            cpu_used += float(cstate.last_stat['cpu_used'])
-            precpu_sys_used += float(cstate.last_stat['precpu_system_used'])
-            cpu_sys_used += float(cstate.last_stat['cpu_system_used'])
-            mem_cur_bytes += int(cstate.last_stat['mem_cur_bytes'])
-
-    # CPU usage calculation ref: https://bit.ly/2rrfrFF
-    cpu_delta = cpu_used - precpu_used
-    system_delta = cpu_sys_used - precpu_sys_used
-    cpu_pct = 0
-    if system_delta > 0 and cpu_delta > 0:
-        cpu_pct = (cpu_delta / system_delta) * num_cores * 100
-
     agent_live_info = {
-        'cpu_pct': round(cpu_pct, 1),
-        'mem_cur_bytes': mem_cur_bytes,
+        'cpu_pct': round(live_stats.get_cpu_pct(num_cores), 1),
+        'mem_cur_bytes': live_stats.mem_cur_bytes,
+        'cpu_throttled_time': round(live_stats.cpu_throttled_time, 1),
+        'cpu_pressure_max': live_stats.pressure_max['cpu'],
+        'mem_pressure_max': live_stats.pressure_max['mem'],
+        'io_pressure_max': live_stats.pressure_max['io'],
+        'num_contended_kernels': live_stats.num_contended_kernels,
     }
+    if agent.host_cpu_sampler is not None:
+        agent_live_info['host_cpu_pct'] = round(agent.host_cpu_sampler.sample(), 1)
     pipe = agent.redis_stat_pool.pipeline()
     pipe.hmset_dict(agent.config.instance_id, agent_live_info)
     pipe.expire(agent.config.instance_id, stat_cache_lifespan)
     await pipe.execute()
 
 
-@aiotools.actxmgr
-async def spawn_stat_collector(stat_addr, stat_type, cid, *,
-                               exec_opts=None):
-    # Spawn high-perf stats collector process for Linux native setups.
-    # NOTE: We don't have to keep track of this process,
-    #       as they will self-terminate when the container terminates.
-    if exec_opts is None:
-        exec_opts = {}
+class StatBuffer:
+    '''
+    Keeps only the latest stat sample of each kernel and writes them to Redis
+    as a single pipeline per flush.
+    '''
 
-    context = zmq.asyncio.Context()
-    ipc_base_path = Path('/tmp/backend.ai/ipc')
-    ipc_base_path.mkdir(parents=True, exist_ok=True)
+    def __init__(self, redis_pool, lifespan, *, stats_monitor=None):
+        self.redis_pool = redis_pool
+        self.lifespan = lifespan
+        self.stats_monitor = stats_monitor
+        self.pending = {}
+        self.num_flushes = 0
+        self.num_dropped = 0
+        self.last_flush_latency = None
 
-    proc = await asyncio.create_subprocess_exec(*[
-        'python', '-m', 'ai.backend.agent.stats',
-        stat_addr, cid, '--type', stat_type,
-    ], **exec_opts)
+    def put(self, kernel_id, record):
+        if kernel_id in self.pending:
+            # The previous sample is superseded before being flushed.
+            self.num_dropped += 1
+            if self.stats_monitor is not None:
+                self.stats_monitor.report_stats(
+                    'increment', 'ai.backend.agent.stats.dropped_samples')
+        self.pending[kernel_id] = record
+
+    async def flush(self, interval=None):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        begin = time.monotonic()
+        pipe = self.redis_pool.pipeline()
+        for kernel_id, record in pending.items():
+            # Superseded records are never decoded.
+            pipe.hmset_dict(kernel_id, record.to_dict())
+            pipe.expire(kernel_id, self.lifespan)
+        try:
+            await pipe.execute()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('failed to write stats of {} kernels', len(pending))
+            return
+        self.last_flush_latency = time.monotonic() - begin
+        self.num_flushes += 1
+        if self.stats_monitor is not None:
+            self.stats_monitor.report_stats(
+                'timing', 'ai.backend.agent.stats.flush_latency',
+                self.last_flush_latency * 1000)
 
-    signal_path = 'ipc://' + str(ipc_base_path / f'stat-start-{proc.pid}.sock')
-    signal_sock = context.socket(zmq.PAIR)
-    signal_sock.connect(signal_path)
-    try:
-        await signal_sock.recv_multipart()
-        yield proc
-    finally:
-        await signal_sock.send_multipart([b''])
-        signal_sock.close()
-        context.term()
 
+class StatCollector:
+    '''
+    The agent-side handle of the stat collector daemon.
 
-def _collect_stats_sysfs(container_id):
-    cpu_prefix = f'/sys/fs/cgroup/cpuacct/docker/{container_id}/'
-    mem_prefix = f'/sys/fs/cgroup/memory/docker/{container_id}/'
-    io_prefix = f'/sys/fs/cgroup/blkio/docker/{container_id}/'
+    A single collector process samples the statistics of all containers
+    on this host and sends them in batches to the agent.
+    Each container is registered via a lightweight control message
+    instead of spawning a separate collector process per container,
+    and is identified by a small integer handle in the stat messages.
 
-    try:
-        cpu_used = read_sysfs(cpu_prefix + 'cpuacct.usage') / 1e6
-        cpu_system_used = read_sysfs('/sys/fs/cgroup/cpuacct/cpuacct.usage') / 1e6
-        mem_max_bytes = read_sysfs(mem_prefix + 'memory.max_usage_in_bytes')
-        mem_cur_bytes = read_sysfs(mem_prefix + 'memory.usage_in_bytes')
-
-        io_stats = Path(io_prefix + 'blkio.throttle.io_service_bytes').read_text()
-        # example data:
-        #   8:0 Read 13918208
-        #   8:0 Write 0
-        #   8:0 Sync 0
-        #   8:0 Async 13918208
-        #   8:0 Total 13918208
-        #   Total 13918208
-        io_read_bytes = 0
-        io_write_bytes = 0
-        for line in io_stats.splitlines():
-            if line.startswith('Total '):
+    If the daemon terminates unexpectedly, it is restarted and all the
+    containers registered so far are registered again with the same handles.
+    '''
+
+    ack_timeout = 5.0
+    restart_delay = 1.0
+
+    def __init__(self, stat_addr, stat_type, *, exec_opts=None):
+        self.stat_addr = stat_addr
+        self.stat_type = stat_type
+        self.exec_opts = exec_opts if exec_opts is not None else {}
+        self.proc = None
+        self.context = None
+        self.ctrl_sock = None
+        self.ctrl_path = None
+        self.ctrl_task = None
+        self.watch_task = None
+        self.pending_acks = {}
+        self.handles = {}  # cid -> handle
+        self.cids = {}     # handle -> cid
+        self.scratch_dirs = {}  # cid -> scratch directory
+        self.started = set()
+        self._next_handle = 1
+
+    def get_cid(self, handle):
+        return self.cids.get(handle)
+
+    def release(self, handle):
+        cid = self.cids.pop(handle, None)
+        if cid is not None and self.handles.get(cid) == handle:
+            del self.handles[cid]
+            self.scratch_dirs.pop(cid, None)
+            self.started.discard(cid)
+
+    async def start(self):
+        ipc_base_path = Path('/tmp/backend.ai/ipc')
+        ipc_base_path.mkdir(parents=True, exist_ok=True)
+        self.context = zmq.asyncio.Context()
+        await self._spawn()
+        self.watch_task = asyncio.ensure_future(self._watch_daemon())
+
+    async def _spawn(self):
+        ipc_base_path = Path('/tmp/backend.ai/ipc')
+        self.proc = await asyncio.create_subprocess_exec(*[
+            'python', '-m', 'ai.backend.agent.stats',
+            self.stat_addr, '--type', self.stat_type,
+        ], **self.exec_opts)
+        self.ctrl_path = ipc_base_path / f'stat-ctrl-{self.proc.pid}.sock'
+        self.ctrl_sock = self.context.socket(zmq.DEALER)
+        self.ctrl_sock.setsockopt(zmq.LINGER, 1000)
+        self.ctrl_sock.connect('ipc://' + str(self.ctrl_path))
+        self.ctrl_task = asyncio.ensure_future(self._read_ctrl())
+
+    async def _close_ctrl(self):
+        if self.ctrl_task is not None and not self.ctrl_task.done():
+            self.ctrl_task.cancel()
+            try:
+                await self.ctrl_task
+            except asyncio.CancelledError:
+                # It was cancelled before reaching its own handler.
+                pass
+        if self.ctrl_sock is not None:
+            self.ctrl_sock.close()
+            self.ctrl_sock = None
+
+    async def _watch_daemon(self):
+        while True:
+            try:
+                returncode = await self.proc.wait()
+                log.error('stat collector daemon has terminated unexpectedly '
+                          '(exit code: {}); restarting it.', returncode)
+                await self._close_ctrl()
+                try:
+                    self.ctrl_path.unlink()  # left behind if it was killed
+                except FileNotFoundError:
+                    pass
+                # Let the pending registrations proceed; they are sent again below.
+                for fut in self.pending_acks.values():
+                    if not fut.done():
+                        fut.set_result(None)
+                self.pending_acks.clear()
+                await asyncio.sleep(self.restart_delay)
+                await self._spawn()
+                for cid, handle in list(self.handles.items()):
+                    await self._send_register(cid, handle)
+                    if cid in self.started:
+                        await self.ctrl_sock.send_multipart(
+                            [b'start', cid.encode('ascii')])
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception('cannot restart the stat collector daemon')
+                try:
+                    await asyncio.sleep(self.restart_delay)
+                except asyncio.CancelledError:
+                    break
+
+    async def close(self):
+        if self.watch_task is not None and not self.watch_task.done():
+            self.watch_task.cancel()
+            try:
+                await self.watch_task
+            except asyncio.CancelledError:
+                # It was cancelled before reaching its own handler.
+                pass
+        if self.ctrl_sock is not None:
+            await self.ctrl_sock.send_multipart([b'shutdown', b''])
+        if self.proc is not None:
+            try:
+                with timeout(3.0):
+                    await self.proc.wait()
+            except asyncio.TimeoutError:
+                log.warning('stat collector did not terminate in time; killing it.')
+                self.proc.kill()
+                await self.proc.wait()
+        await self._close_ctrl()
+        if self.context is not None:
+            self.context.term()
+            self.context = None
+
+    async def _read_ctrl(self):
+        while True:
+            try:
+                reply, cid = await self.ctrl_sock.recv_multipart()
+                if reply == b'ack':
+                    fut = self.pending_acks.pop(cid.decode('ascii'), None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(None)
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception('unexpected error')
+
+    async def _send_register(self, cid, handle):
+        scratch_dir = self.scratch_dirs.get(cid)
+        await self.ctrl_sock.send_multipart([
+            b'register', cid.encode('ascii'), struct.pack('!I', handle),
+            os.fsencode(scratch_dir) if scratch_dir is not None else b'',
+        ])
+
+    @aiotools.actxmgr
+    async def register(self, cid, scratch_dir=None):
+        '''
+        Registers the given container to the collector daemon.
+        The container should be started inside the context so that the
+        collector can begin sampling from its very first moment.
+        If *scratch_dir* is given, its disk usage is reported as the scratch
+        size of the container.
+        '''
+        handle = self._next_handle
+        self._next_handle = (handle % 0xffff_ffff) + 1
+        self.handles[cid] = handle
+        self.cids[handle] = cid
+        if scratch_dir is not None:
+            self.scratch_dirs[cid] = scratch_dir
+        ack = asyncio.get_event_loop().create_future()
+        self.pending_acks[cid] = ack
+        await self._send_register(cid, handle)
+        try:
+            with timeout(self.ack_timeout):
+                await ack
+        except asyncio.TimeoutError:
+            # Do not block the kernel creation on an unresponsive daemon.
+            log.warning('stat collector did not acknowledge the registration '
+                        'of container {} in time', cid[:7])
+            self.pending_acks.pop(cid, None)
+        except asyncio.CancelledError:
+            self.pending_acks.pop(cid, None)
+            self.release(handle)
+            raise
+        try:
+            yield
+        except Exception:
+            await self.ctrl_sock.send_multipart([b'unregister',
+                                                 cid.encode('ascii')])
+            self.release(handle)
+            raise
+        else:
+            self.started.add(cid)
+            await self.ctrl_sock.send_multipart([b'start', cid.encode('ascii')])
+
+    async def unregister(self, cid):
+        '''
+        Stops sampling the given container and releases its handle, for the
+        containers whose final stat is no longer awaited.
+        '''
+        handle = self.handles.get(cid)
+        if handle is None:
+            return
+        self.release(handle)
+        if self.ctrl_sock is not None:
+            await self.ctrl_sock.send_multipart([b'unregister',
+                                                 cid.encode('ascii')])
+
+    async def notify_died(self, cid):
+        '''
+        Lets the collector daemon report the final stat of the given container
+        immediately, without waiting for its own termination check.
+        '''
+        if self.ctrl_sock is None:
+            return
+        await self.ctrl_sock.send_multipart([b'died', cid.encode('ascii')])
+
+
+_has_preadv = hasattr(os, 'preadv')
+_page_size = os.sysconf('SC_PAGE_SIZE')
+_clock_ticks = os.sysconf('SC_CLK_TCK')
+
+
+class SysfsFile:
+    '''
+    Keeps a sysfs/procfs file open and rereads its content from the beginning
+    with a single pread syscall into a reused buffer.
+    '''
+
+    __slots__ = ('path', 'fd', 'buf')
+
+    def __init__(self, path, bufsize=4096):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buf = bytearray(bufsize)
+
+    def read(self):
+        while True:
+            if _has_preadv:
+                n = os.preadv(self.fd, [self.buf], 0)
+                data = self.buf[:n]
+            else:
+                data = os.pread(self.fd, len(self.buf), 0)
+                n = len(data)
+            if n < len(self.buf):
+                return data
+            # The content may have been truncated; retry with a larger buffer.
+            self.buf = bytearray(len(self.buf) * 2)
+
+    def read_int(self):
+        return int(self.read())
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def parse_blkio_bytes(data):
+    # example data:
+    #   8:0 Read 13918208
+    #   8:0 Write 0
+    #   8:0 Sync 0
+    #   8:0 Async 13918208
+    #   8:0 Total 13918208
+    #   Total 13918208
+    io_read_bytes = 0
+    io_write_bytes = 0
+    for line in data.splitlines():
+        if line.startswith(b'Total '):
+            continue
+        dev, op, nbytes = line.split()
+        if op == b'Read':
+            io_read_bytes += int(nbytes)
+        elif op == b'Write':
+            io_write_bytes += int(nbytes)
+    return io_read_bytes, io_write_bytes
+
+
+def parse_net_dev(data):
+    # example data:
+    #   Inter-|   Receive                                                |  Transmit                                                  # noqa: E501
+    #    face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed    # noqa: E501
+    #     eth0:     1296     16    0    0    0     0          0         0      816      10    0    0    0     0       0          0    # noqa: E501
+    #       lo:        0      0    0    0    0     0          0         0        0       0    0    0    0     0       0          0    # noqa: E501
+    net_rx_bytes = 0
+    net_tx_bytes = 0
+    for line in data.splitlines():
+        if b'|' in line:
+            continue
+        fields = line.replace(b':', b' ', 1).split()
+        if fields[0].startswith(b'eth'):
+            net_rx_bytes += int(fields[1])
+            net_tx_bytes += int(fields[9])
+    return net_rx_bytes, net_tx_bytes
+
+
+def is_host_netns(pid):
+    return (os.stat(f'/proc/{pid}/ns/net').st_ino ==
+            os.stat('/proc/self/ns/net').st_ino)
+
+
+def get_host_veth_names(pid, *, procfs_root='/proc', sysfs_root='/sys'):
+    '''
+    Resolves the names of the host-side veth peers of the ethernet interfaces
+    of the container where the given process runs.
+
+    The "iflink" of an in-container interface is the ifindex of its peer
+    interface in the host network namespace.
+    '''
+    container_net_path = Path(f'{procfs_root}/{pid}/root/sys/class/net')
+    host_net_path = Path(f'{sysfs_root}/class/net')
+    peer_indices = set()
+    for dev in container_net_path.iterdir():
+        if dev.name.startswith('eth'):
+            peer_indices.add(int((dev / 'iflink').read_text()))
+    names = []
+    if not peer_indices:
+        return names
+    for dev in host_net_path.iterdir():
+        try:
+            if int((dev / 'ifindex').read_text()) in peer_indices:
+                names.append(dev.name)
+        except (IOError, ValueError):
+            continue
+    return names
+
+
+def parse_keyed_values(data):
+    # example data (cpu.stat of cgroup v2):
+    #   usage_usec 3154251
+    #   user_usec 2416563
+    #   system_usec 737688
+    return {key: int(value) for key, value in
+            (line.split() for line in data.splitlines() if line)}
+
+
+def parse_io_stat(data):
+    # example data (io.stat of cgroup v2):
+    #   8:0 rbytes=13918208 wbytes=0 rios=340 wios=0 dbytes=0 dios=0
+    #   8:16 rbytes=2048 wbytes=4096 rios=1 wios=1 dbytes=0 dios=0
+    io_read_bytes = 0
+    io_write_bytes = 0
+    for line in data.splitlines():
+        for item in line.split()[1:]:
+            key, _, value = item.partition(b'=')
+            if key == b'rbytes':
+                io_read_bytes += int(value)
+            elif key == b'wbytes':
+                io_write_bytes += int(value)
+    return io_read_bytes, io_write_bytes
+
+
+def parse_pressure(data):
+    # example data (cpu.pressure, memory.pressure, io.pressure):
+    #   some avg10=1.53 avg60=0.87 avg300=0.23 total=3274187
+    #   full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    # Returns the avg10 values in percent.
+    result = {}
+    for line in data.splitlines():
+        kind, *items = line.split()
+        for item in items:
+            key, _, value = item.partition(b'=')
+            if key == b'avg10':
+                result[kind] = float(value)
+                break
+    return result
+
+
+def parse_numa_stat(data):
+    # example data (memory.numa_stat of cgroup v1, in pages):
+    #   total=5120 N0=4096 N1=1024
+    #   hierarchical_total=5120 N0=4096 N1=1024
+    # example data (memory.numa_stat of cgroup v2, in bytes):
+    #   anon N0=16777216 N1=4194304
+    #   file N0=8388608 N1=0
+    result = {}
+    for line in data.splitlines():
+        key, *items = line.split()
+        key = key.partition(b'=')[0]
+        per_node = {}
+        for item in items:
+            node, _, value = item.partition(b'=')
+            if node.startswith(b'N'):
+                per_node[int(node[1:])] = int(value)
+        result[key] = per_node
+    return result
+
+
+def parse_cpuset_list(data):
+    # example data (cpuset.mems): 0-1,3
+    nodes = set()
+    for item in data.strip().split(b','):
+        if not item:
+            continue
+        begin, _, end = item.partition(b'-')
+        nodes.update(range(int(begin), int(end or begin) + 1))
+    return nodes
+
+
+def split_numa_usage(per_node, local_nodes):
+    '''
+    Returns the sums of the given per-node values on the local nodes
+    and the other nodes.
+    '''
+    local = remote = 0
+    for node, value in per_node.items():
+        if local_nodes is None or node in local_nodes:
+            local += value
+        else:
+            remote += value
+    return local, remote
+
+
+@functools.lru_cache(maxsize=1)
+def get_cgroup_version():
+    '''
+    Returns the cgroup version used by the host: 2 if the unified hierarchy is
+    mounted as the main cgroup filesystem, otherwise 1 (including the "hybrid"
+    setups where the unified hierarchy coexists with v1 controllers).
+    '''
+    if Path('/sys/fs/cgroup/cgroup.controllers').exists():
+        return 2
+    return 1
+
+
+class CgroupSampler:
+    '''
+    Samples the cgroup statistics of a container using the file descriptors
+    opened once and kept during the container's lifetime.
+
+    Subclasses implement the version-specific file layouts while producing
+    the same ContainerStat shape.
+    '''
+
+    def __init__(self, cid):
+        self.cid = cid
+        self.files = {}
+        self.veth_files = []
+        self.local_nodes = None  # the NUMA nodes in cpuset.mems
+
+    def get_cpuset_mems_path(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def open_system_usage():
+        raise NotImplementedError
+
+    @staticmethod
+    def read_system_usage(f):
+        raise NotImplementedError
+
+    def get_pids(self):
+        raise NotImplementedError
+
+    def get_paths(self):
+        raise NotImplementedError
+
+    def get_optional_paths(self):
+        '''
+        Returns the paths of the files which may not exist depending on
+        the kernel version and configuration, such as PSI.
+        '''
+        return {}
+
+    def is_running(self):
+        raise NotImplementedError
+
+    def read_oom_kills(self):
+        '''
+        Returns the number of processes killed by the OOM killer in the cgroup,
+        or None if the kernel does not count it.
+        '''
+        raise NotImplementedError
+
+    def is_under_oom(self):
+        '''
+        Returns whether the cgroup is under OOM right now.  Used to confirm
+        the OOM notifications when read_oom_kills() returns None.
+        '''
+        return False
+
+    def open_oom_eventfd(self):
+        '''
+        Returns an eventfd signaled upon OOM events, if the cgroup version
+        supports it.
+        '''
+        return None
+
+    def get_oom_watch_path(self):
+        '''
+        Returns the path of a file modified upon OOM events, if the cgroup
+        version supports it.
+        '''
+        return None
+
+    def sample_cgroup(self, stat):
+        '''
+        Fills the CPU, memory, block I/O and CPU throttling fields of the given
+        ContainerStat.
+        '''
+        raise NotImplementedError
+
+    def open(self):
+        pids = self.get_pids()
+        if not pids:
+            raise ProcessLookupError(f'no processes in container {self.cid[:7]}')
+        pid = pids[0]
+        try:
+            for key, path in self.get_paths().items():
+                self.files[key] = SysfsFile(path)
+            for key, path in self.get_optional_paths().items():
+                try:
+                    self.files[key] = SysfsFile(path)
+                except FileNotFoundError:
+                    pass
+            if 'mem_numa' in self.files:
+                # The memory binding does not change during the lifetime.
+                try:
+                    self.local_nodes = parse_cpuset_list(
+                        Path(self.get_cpuset_mems_path()).read_bytes())
+                except (IOError, ValueError):
+                    self.local_nodes = None
+            try:
+                if is_host_netns(pid):
+                    # e.g., containers using the host networking mode
+                    veth_names = []
+                else:
+                    veth_names = get_host_veth_names(pid)
+            except (IOError, ValueError):
+                veth_names = []
+            for name in veth_names:
+                prefix = f'/sys/class/net/{name}/statistics/'
+                self.veth_files.append((SysfsFile(prefix + 'rx_bytes'),
+                                        SysfsFile(prefix + 'tx_bytes')))
+            if not self.veth_files:
+                # Fallback for containers without veth interfaces:
+                # /proc/<pid>/net/dev shows the network devices as seen inside
+                # the network namespace of the given process.
+                self.files['net'] = SysfsFile(f'/proc/{pid}/net/dev')
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        for rx_file, tx_file in self.veth_files:
+            rx_file.close()
+            tx_file.close()
+        self.veth_files.clear()
+
+    def sample_net(self):
+        try:
+            if self.veth_files:
+                net_rx_bytes = 0
+                net_tx_bytes = 0
+                for rx_file, tx_file in self.veth_files:
+                    # The host-side peer receives what the container transmits.
+                    net_rx_bytes += tx_file.read_int()
+                    net_tx_bytes += rx_file.read_int()
+                return net_rx_bytes, net_tx_bytes
+            return parse_net_dev(self.files['net'].read())
+        except OSError:
+            # The network interfaces may be removed slightly earlier than
+            # the cgroup when the container terminates.
+            # ContainerStat.update() keeps the last known values for zeros.
+            return 0, 0
+
+    def sample_pressure(self, stat):
+        for key in ('cpu_pressure', 'mem_pressure', 'io_pressure'):
+            f = self.files.get(key)
+            if f is None:
                 continue
-            dev, op, nbytes = line.strip().split()
-            if op == 'Read':
-                io_read_bytes += int(nbytes)
-            elif op == 'Write':
-                io_write_bytes += int(nbytes)
-        io_max_scratch_size = 0
-        io_cur_scratch_size = 0
-
-        net_dev_stats = Path('/proc/net/dev').read_text()
-        # example data:
-        #   Inter-|   Receive                                                |  Transmit                                                  # noqa: E501
-        #    face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed    # noqa: E501
-        #     eth0:     1296     16    0    0    0     0          0         0      816      10    0    0    0     0       0          0    # noqa: E501
-        #       lo:        0      0    0    0    0     0          0         0        0       0    0    0    0     0       0          0    # noqa: E501
-        net_rx_bytes = 0
-        net_tx_bytes = 0
-        for line in net_dev_stats.splitlines():
-            if '|' in line:
+            try:
+                pressure = parse_pressure(f.read())
+            except OSError:
+                # PSI is disabled (e.g., "psi=0" in the kernel command line)
+                # even though the file exists.
+                f.close()
+                del self.files[key]
                 continue
-            data = line.strip().split()
-            if data[0].startswith('eth'):
-                net_rx_bytes += int(data[1])
-                net_tx_bytes += int(data[9])
-    except IOError as e:
-        short_cid = container_id[:7]
-        log.warning('cannot read stats: '
-                    f'sysfs unreadable for container {short_cid}!'
-                    f'\n{e!r}')
-        return None
+            setattr(stat, key + '_some', pressure.get(b'some', 0.0))
+            if key != 'cpu_pressure':
+                setattr(stat, key + '_full', pressure.get(b'full', 0.0))
 
-    return ContainerStat(
-        0,  # precpu_used calculated automatically
-        cpu_used,
-        0,  # precpu_system_used calculated autmatically
-        cpu_system_used,
-        mem_max_bytes,
-        mem_cur_bytes,
-        net_rx_bytes,
-        net_tx_bytes,
-        io_read_bytes,
-        io_write_bytes,
-        io_max_scratch_size,
-        io_cur_scratch_size,
+    def sample(self, cpu_system_used):
+        # precpu_used and precpu_system_used are calculated automatically
+        # by ContainerStat.update().
+        stat = ContainerStat(cpu_system_used=cpu_system_used)
+        try:
+            self.sample_cgroup(stat)
+        except OSError as e:
+            short_cid = self.cid[:7]
+            log.warning('cannot read stats: '
+                        f'sysfs unreadable for container {short_cid}!'
+                        f'\n{e!r}')
+            return None
+        self.sample_pressure(stat)
+        stat.net_rx_bytes, stat.net_tx_bytes = self.sample_net()
+        return stat
+
+
+class CgroupV1Sampler(CgroupSampler):
+
+    @staticmethod
+    def open_system_usage():
+        return SysfsFile('/sys/fs/cgroup/cpuacct/cpuacct.usage')
+
+    @staticmethod
+    def read_system_usage(f):
+        return f.read_int() / 1e6
+
+    def get_pids(self):
+        return get_cgroup_pids(self.cid)
+
+    def get_paths(self):
+        cpu_prefix = f'/sys/fs/cgroup/cpuacct/docker/{self.cid}/'
+        mem_prefix = f'/sys/fs/cgroup/memory/docker/{self.cid}/'
+        io_prefix = f'/sys/fs/cgroup/blkio/docker/{self.cid}/'
+        return {
+            'cpu_used': cpu_prefix + 'cpuacct.usage',
+            'mem_max_bytes': mem_prefix + 'memory.max_usage_in_bytes',
+            'mem_cur_bytes': mem_prefix + 'memory.usage_in_bytes',
+            'io': io_prefix + 'blkio.throttle.io_service_bytes',
+            'mem_stat': mem_prefix + 'memory.stat',
+        }
+
+    def get_cpuset_mems_path(self):
+        return f'/sys/fs/cgroup/cpuset/docker/{self.cid}/cpuset.mems'
+
+    def get_optional_paths(self):
+        # The cpu controller is usually co-mounted with cpuacct, but not always.
+        # The pressure files exist only if the kernel exposes PSI for
+        # the v1 hierarchies.
+        cpu_prefix = f'/sys/fs/cgroup/cpu/docker/{self.cid}/'
+        mem_prefix = f'/sys/fs/cgroup/memory/docker/{self.cid}/'
+        io_prefix = f'/sys/fs/cgroup/blkio/docker/{self.cid}/'
+        paths = {
+            'oom_control': mem_prefix + 'memory.oom_control',
+            'cpu_throttle': cpu_prefix + 'cpu.stat',
+            'cpu_pressure': cpu_prefix + 'cpu.pressure',
+            'mem_pressure': mem_prefix + 'memory.pressure',
+            'io_pressure': io_prefix + 'io.pressure',
+        }
+        if libnuma.num_nodes() > 1:
+            paths['mem_numa'] = mem_prefix + 'memory.numa_stat'
+        return paths
+
+    def is_running(self):
+        # NOTE: cgroup.procs is not kept open because the kernel caches
+        #       the pid list per open file and rereading it returns stale
+        #       results for a while after the processes have exited.
+        return is_cgroup_running(self.cid)
+
+    def read_oom_kills(self):
+        # "oom_kill" exists since Linux 4.13.
+        if 'oom_control' not in self.files:
+            return None
+        return parse_keyed_values(self.files['oom_control'].read()).get(b'oom_kill')
+
+    def is_under_oom(self):
+        if 'oom_control' not in self.files:
+            return False
+        return bool(parse_keyed_values(
+            self.files['oom_control'].read()).get(b'under_oom'))
+
+    def open_oom_eventfd(self):
+        # The memory cgroup signals the eventfd upon OOM events and also when
+        # the cgroup is removed.
+        mem_prefix = f'/sys/fs/cgroup/memory/docker/{self.cid}/'
+        efd = eventfd.create(0, eventfd.EFD_NONBLOCK | eventfd.EFD_CLOEXEC)
+        try:
+            ctrl_fd = os.open(mem_prefix + 'memory.oom_control',
+                              os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                with open(mem_prefix + 'cgroup.event_control', 'w') as f:
+                    f.write(f'{efd} {ctrl_fd}')
+            finally:
+                os.close(ctrl_fd)
+        except OSError:
+            os.close(efd)
+            raise
+        return efd
+
+    def sample_cgroup(self, stat):
+        files = self.files
+        stat.cpu_used = files['cpu_used'].read_int() / 1e6
+        stat.mem_max_bytes = files['mem_max_bytes'].read_int()
+        stat.mem_cur_bytes = files['mem_cur_bytes'].read_int()
+        stat.io_read_bytes, stat.io_write_bytes = \
+            parse_blkio_bytes(files['io'].read())
+        if 'cpu_throttle' in files:
+            cpu_stat = parse_keyed_values(files['cpu_throttle'].read())
+            stat.cpu_nr_throttled = cpu_stat.get(b'nr_throttled', 0)
+            stat.cpu_throttled_time = cpu_stat.get(b'throttled_time', 0) / 1e6
+        # The "total_" values include the descendant cgroups.
+        mem_stat = parse_keyed_values(files['mem_stat'].read())
+        stat.mem_rss_bytes = mem_stat.get(b'total_rss', 0)
+        stat.mem_cache_bytes = mem_stat.get(b'total_cache', 0)
+        stat.mem_mapped_file_bytes = mem_stat.get(b'total_mapped_file', 0)
+        stat.mem_swap_bytes = mem_stat.get(b'total_swap', 0)
+        if 'mem_numa' in files:
+            numa_stat = parse_numa_stat(files['mem_numa'].read())
+            per_node = numa_stat.get(b'hierarchical_total',
+                                     numa_stat.get(b'total', {}))
+            local, remote = split_numa_usage(per_node, self.local_nodes)
+            stat.mem_numa_local_bytes = local * _page_size
+            stat.mem_numa_remote_bytes = remote * _page_size
+
+
+class CgroupV2Sampler(CgroupSampler):
+    '''
+    Reads all metrics from the container's directory in the unified hierarchy.
+    '''
+
+    def __init__(self, cid):
+        super().__init__(cid)
+        self.cgroup_path = None
+        self.mem_peak = 0
+
+    @staticmethod
+    def open_system_usage():
+        return SysfsFile('/sys/fs/cgroup/cpu.stat')
+
+    @staticmethod
+    def read_system_usage(f):
+        return parse_keyed_values(f.read())[b'usage_usec'] / 1e3
+
+    def get_cgroup_path(self):
+        if self.cgroup_path is None:
+            candidates = [
+                # with the cgroupfs driver
+                Path(f'/sys/fs/cgroup/docker/{self.cid}'),
+                # with the systemd driver
+                Path(f'/sys/fs/cgroup/system.slice/docker-{self.cid}.scope'),
+            ]
+            for path in candidates:
+                if path.is_dir():
+                    self.cgroup_path = path
+                    break
+            else:
+                raise FileNotFoundError(f'no cgroup for container {self.cid[:7]}')
+        return self.cgroup_path
+
+    def get_pids(self):
+        try:
+            pids = (self.get_cgroup_path() / 'cgroup.procs').read_text()
+            return numeric_list(pids)
+        except IOError:
+            return []
+
+    def get_paths(self):
+        cgroup_path = self.get_cgroup_path()
+        paths = {
+            'cpu_stat': cgroup_path / 'cpu.stat',
+            'mem_cur_bytes': cgroup_path / 'memory.current',
+            'io': cgroup_path / 'io.stat',
+            'events': cgroup_path / 'cgroup.events',
+            'mem_stat': cgroup_path / 'memory.stat',
+            'mem_events': cgroup_path / 'memory.events',
+        }
+        # memory.peak is available since Linux 5.19.
+        if (cgroup_path / 'memory.peak').exists():
+            paths['mem_max_bytes'] = cgroup_path / 'memory.peak'
+        return {key: str(path) for key, path in paths.items()}
+
+    def get_optional_paths(self):
+        # The pressure files are missing if the kernel is built without PSI.
+        cgroup_path = self.get_cgroup_path()
+        paths = {
+            'cpu_pressure': str(cgroup_path / 'cpu.pressure'),
+            'mem_pressure': str(cgroup_path / 'memory.pressure'),
+            'io_pressure': str(cgroup_path / 'io.pressure'),
+            # missing if swap accounting is disabled
+            'mem_swap': str(cgroup_path / 'memory.swap.current'),
+        }
+        if libnuma.num_nodes() > 1:
+            paths['mem_numa'] = str(cgroup_path / 'memory.numa_stat')
+        return paths
+
+    def get_cpuset_mems_path(self):
+        return str(self.get_cgroup_path() / 'cpuset.mems.effective')
+
+    def is_running(self):
+        # Unlike cgroup.procs, cgroup.events is safe to reread
+        # from the same file descriptor.
+        try:
+            events = parse_keyed_values(self.files['events'].read())
+        except OSError:
+            return False
+        return events.get(b'populated', 0) == 1
+
+    def read_oom_kills(self):
+        return parse_keyed_values(self.files['mem_events'].read()).get(b'oom_kill')
+
+    def get_oom_watch_path(self):
+        # memory.events generates a modification event when its values change.
+        return str(self.get_cgroup_path() / 'memory.events')
+
+    def sample_cgroup(self, stat):
+        files = self.files
+        cpu_stat = parse_keyed_values(files['cpu_stat'].read())
+        stat.cpu_used = cpu_stat[b'usage_usec'] / 1e3
+        # nr_throttled and throttled_usec exist only if the cpu controller
+        # is enabled for the cgroup.
+        stat.cpu_nr_throttled = cpu_stat.get(b'nr_throttled', 0)
+        stat.cpu_throttled_time = cpu_stat.get(b'throttled_usec', 0) / 1e3
+        stat.mem_cur_bytes = files['mem_cur_bytes'].read_int()
+        if 'mem_max_bytes' in files:
+            stat.mem_max_bytes = files['mem_max_bytes'].read_int()
+        else:
+            # Track the peak by ourselves at the sampling resolution.
+            self.mem_peak = max(self.mem_peak, stat.mem_cur_bytes)
+            stat.mem_max_bytes = self.mem_peak
+        stat.io_read_bytes, stat.io_write_bytes = \
+            parse_io_stat(files['io'].read())
+        mem_stat = parse_keyed_values(files['mem_stat'].read())
+        stat.mem_rss_bytes = mem_stat.get(b'anon', 0)
+        stat.mem_cache_bytes = mem_stat.get(b'file', 0)
+        stat.mem_mapped_file_bytes = mem_stat.get(b'file_mapped', 0)
+        if 'mem_swap' in files:
+            stat.mem_swap_bytes = files['mem_swap'].read_int()
+        if 'mem_numa' in files:
+            numa_stat = parse_numa_stat(files['mem_numa'].read())
+            per_node = {}
+            for key in (b'anon', b'file'):
+                for node, value in numa_stat.get(key, {}).items():
+                    per_node[node] = per_node.get(node, 0) + value
+            stat.mem_numa_local_bytes, stat.mem_numa_remote_bytes = \
+                split_numa_usage(per_node, self.local_nodes)
+
+
+def get_cgroup_sampler_class():
+    if get_cgroup_version() == 2:
+        return CgroupV2Sampler
+    return CgroupV1Sampler
+
+
+def parse_proc_pid_stat(data):
+    '''
+    Parses /proc/<pid>/stat and returns a tuple of the command name, state,
+    parent pid, number of threads, consumed CPU time in clock ticks
+    (user + system) and start time in clock ticks since boot.
+    '''
+    # The command name may contain spaces and parentheses.
+    lpar = data.index(b'(')
+    rpar = data.rindex(b')')
+    comm = data[lpar + 1:rpar].decode('utf8', 'replace')
+    # fields[0] is the third field (state) in proc(5).
+    fields = data[rpar + 2:].split()
+    return (
+        comm,
+        fields[0].decode('ascii'),
+        int(fields[1]),                     # ppid
+        int(fields[17]),                    # num_threads
+        int(fields[11]) + int(fields[12]),  # utime + stime
+        int(fields[19]),                    # starttime
     )
 
 
-async def _collect_stats_api(container):
-    try:
-        ret = await container.stats(stream=False)
-    except (DockerError, aiohttp.ClientResponseError):
-        short_cid = container._id[:7]
-        log.warning(f'cannot read stats: Docker stats API error for {short_cid}.')
+class ProcessStatSampler:
+    '''
+    Breaks down the resource usage of containers into their processes by
+    reading ``/proc/<pid>/stat`` and ``/proc/<pid>/statm`` of all processes
+    in a batch.
+
+    Enumerating the processes from cgroup.procs is relatively expensive, so
+    the process list of each container is cached and refreshed only every
+    *enum_interval* seconds.  Processes spawned in the meantime show up after
+    the next enumeration.
+    '''
+
+    def __init__(self, *, enum_interval=30.0, procfs_root='/proc'):
+        self.enum_interval = enum_interval
+        self.procfs_root = procfs_root
+        self.sampler_cls = get_cgroup_sampler_class()
+        self.pid_cache = {}   # cid -> (enumerated_at, pids)
+        self.prev_ticks = {}  # cid -> {(pid, starttime): cpu ticks}
+        self.last_sampled_at = {}  # cid -> monotonic timestamp
+        self.results = {}     # cid -> the latest result
+
+    def get_pids(self, cid):
+        return self.sampler_cls(cid).get_pids()
+
+    def _read(self, pid, name):
+        # Processes come and go, so their files are opened on every read
+        # instead of keeping a potentially large number of descriptors.
+        with open(f'{self.procfs_root}/{pid}/{name}', 'rb') as f:
+            return f.read()
+
+    def forget(self, cid):
+        self.pid_cache.pop(cid, None)
+        self.prev_ticks.pop(cid, None)
+        self.last_sampled_at.pop(cid, None)
+        self.results.pop(cid, None)
+
+    def sample_container(self, cid, now):
+        cached = self.pid_cache.get(cid)
+        if cached is None or now - cached[0] >= self.enum_interval:
+            cached = (now, self.get_pids(cid))
+        enumerated_at, pids = cached
+        last_sampled_at = self.last_sampled_at.get(cid)
+        elapsed_ticks = None
+        if last_sampled_at is not None and now > last_sampled_at:
+            elapsed_ticks = (now - last_sampled_at) * _clock_ticks
+        prev_ticks = self.prev_ticks.get(cid, {})
+        ticks = {}
+        alive_pids = []
+        processes = []
+        for pid in pids:
+            try:
+                comm, state, ppid, num_threads, cpu_ticks, starttime = \
+                    parse_proc_pid_stat(self._read(pid, 'stat'))
+                statm = self._read(pid, 'statm').split()
+                rss_pages, shared_pages = int(statm[1]), int(statm[2])
+            except (OSError, ValueError, IndexError):
+                # The process has exited.
+                continue
+            alive_pids.append(pid)
+            # Distinguish reused pids by their start times.
+            key = (pid, starttime)
+            ticks[key] = cpu_ticks
+            prev = prev_ticks.get(key)
+            cpu_pct = None
+            if prev is not None and elapsed_ticks:
+                cpu_pct = round((cpu_ticks - prev) / elapsed_ticks * 100, 1)
+            processes.append({
+                'pid': pid,
+                'ppid': ppid,
+                'name': comm,
+                'state': state,
+                'num_threads': num_threads,
+                'cpu_used': cpu_ticks * 1000 // _clock_ticks,  # msec
+                'cpu_pct': cpu_pct,
+                'mem_rss_bytes': rss_pages * _page_size,
+                'mem_shared_bytes': shared_pages * _page_size,
+            })
+        processes.sort(key=lambda p: (p['cpu_pct'] or 0.0, p['mem_rss_bytes']),
+                       reverse=True)
+        self.pid_cache[cid] = (enumerated_at, alive_pids)
+        self.prev_ticks[cid] = ticks
+        self.last_sampled_at[cid] = now
+        self.results[cid] = {
+            'sampled_at': time.time(),
+            'processes': processes,
+        }
+
+    def sample(self, cids):
+        '''
+        Samples the processes of the given containers and forgets the others.
+        '''
+        cids = set(cids)
+        for cid in [cid for cid in self.results if cid not in cids]:
+            self.forget(cid)
+        now = time.monotonic()
+        for cid in cids:
+            self.sample_container(cid, now)
+
+    def get_top(self, cid, limit=10):
+        '''
+        Returns the latest sample of up to *limit* processes of the given
+        container consuming the most CPU (and then memory).
+        '''
+        result = self.results.get(cid)
+        if result is None:
+            return {'sampled_at': None, 'processes': []}
+        return {
+            'sampled_at': result['sampled_at'],
+            'processes': result['processes'][:limit],
+        }
+
+
+def _disk_usage(st):
+    return st.st_blocks * 512
+
+
+class _ScratchTree:
+
+    __slots__ = ('root', 'sizes', 'total', 'dirty', 'dirs',
+                 'rescan', 'last_scan')
+
+    def __init__(self, root):
+        self.root = root
+        self.sizes = {}     # file path -> bytes
+        self.total = 0
+        self.dirty = set()  # the file paths to re-examine
+        self.dirs = {}      # directory path -> watch descriptor
+        self.rescan = False
+        self.last_scan = 0.0
+
+    def set_size(self, path, size):
+        self.total += size - self.sizes.get(path, 0)
+        self.sizes[path] = size
+
+    def discard(self, path):
+        self.total -= self.sizes.pop(path, 0)
+        self.dirty.discard(path)
+
+    def discard_subtree(self, path):
+        prefix = path + os.sep
+        for p in [p for p in self.sizes if p.startswith(prefix)]:
+            self.discard(p)
+
+
+class ScratchUsageIndex:
+    '''
+    Tracks the disk usage of the scratch directories of containers
+    incrementally using inotify.
+
+    Each directory is walked once when added, yielding to the event loop
+    every *scan_batch_size* entries so that adding a large directory does
+    not stall the others.  Afterwards, only the files reported by inotify
+    events are re-examined when the usage is queried, so large work
+    directories are never re-walked on every tick.
+    If inotify watches cannot be added (e.g., fs.inotify.max_user_watches is
+    exhausted) or its event queue overflows, the affected directories fall back
+    to periodic full walks.
+    '''
+
+    watch_mask = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MODIFY |
+                  inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM |
+                  inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF |
+                  inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW)
+
+    scan_batch_size = 1000
+
+    def __init__(self, *, rescan_interval=60.0):
+        self.rescan_interval = rescan_interval
+        self.fd = inotify.init(inotify.IN_NONBLOCK | inotify.IN_CLOEXEC)
+        self.trees = {}    # root -> _ScratchTree
+        self.watches = {}  # watch descriptor -> (_ScratchTree, directory path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.trees.clear()
+        self.watches.clear()
+
+    async def add(self, root):
+        root = os.path.abspath(root)
+        if root in self.trees:
+            return
+        tree = _ScratchTree(root)
+        self.trees[root] = tree
+        for _ in self._walk(tree, root):
+            await asyncio.sleep(0)
+            if self.trees.get(root) is not tree:
+                # removed while walking
+                self._unwatch(tree, tree.dirs)
+                return
+
+    def remove(self, root):
+        tree = self.trees.pop(os.path.abspath(root), None)
+        if tree is None:
+            return
+        self._unwatch(tree, tree.dirs)
+
+    def get_usage(self, root):
+        tree = self.trees.get(os.path.abspath(root))
+        if tree is None:
+            return 0
+        self.read_events()
+        if tree.rescan:
+            if time.monotonic() - tree.last_scan >= self.rescan_interval:
+                self._unwatch(tree, tree.dirs)
+                tree.sizes.clear()
+                tree.dirty.clear()
+                tree.total = 0
+                tree.rescan = False
+                self._scan(tree, tree.root)
+        for path in tree.dirty:
+            try:
+                tree.set_size(path, _disk_usage(os.lstat(path)))
+            except FileNotFoundError:
+                tree.total -= tree.sizes.pop(path, 0)
+            except OSError:
+                pass
+        tree.dirty.clear()
+        return tree.total
+
+    def _unwatch(self, tree, dirs):
+        for path in list(dirs):
+            wd = tree.dirs.pop(path)
+            self.watches.pop(wd, None)
+            try:
+                inotify.rm_watch(self.fd, wd)
+            except OSError:
+                pass  # already removed by the kernel
+
+    def _watch(self, tree, path):
+        try:
+            wd = inotify.add_watch(self.fd, path, self.watch_mask)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            if not tree.rescan:
+                log.warning('cannot watch scratch directory {} ({!r}); '
+                            'falling back to periodic scans', path, e)
+            tree.rescan = True
+            return True
+        tree.dirs[path] = wd
+        self.watches[wd] = (tree, path)
+        return True
+
+    def _scan(self, tree, top):
+        for _ in self._walk(tree, top):
+            pass
+
+    def _walk(self, tree, top):
+        '''
+        Walks the directory tree adding the watches and the file sizes,
+        yielding after every *scan_batch_size* entries.
+        '''
+        tree.last_scan = time.monotonic()
+        num_entries = 0
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            # Add the watch before listing so that no new entries are missed.
+            if not self._watch(tree, path):
+                continue
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        num_entries += 1
+                        if num_entries % self.scan_batch_size == 0:
+                            yield
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            else:
+                                tree.set_size(entry.path, _disk_usage(
+                                    entry.stat(follow_symlinks=False)))
+                        except FileNotFoundError:
+                            pass
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            for wd, mask, _, name in inotify.parse_events(data):
+                self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & inotify.IN_Q_OVERFLOW:
+            for tree in self.trees.values():
+                tree.rescan = True
+                tree.last_scan = 0.0  # rescan at the next query
+            return
+        try:
+            tree, dirpath = self.watches[wd]
+        except KeyError:
+            return
+        if mask & inotify.IN_IGNORED:
+            # The watched directory is gone.
+            self.watches.pop(wd, None)
+            if tree.dirs.get(dirpath) == wd:
+                del tree.dirs[dirpath]
+            return
+        if not name:
+            return  # events on the watched directory itself
+        path = os.path.join(dirpath, name)
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self._scan(tree, path)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                tree.discard_subtree(path)
+                prefix = path + os.sep
+                self._unwatch(tree, [d for d in tree.dirs
+                                     if d == path or d.startswith(prefix)])
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            tree.discard(path)
+        else:
+            tree.dirty.add(path)
+
+
+class OOMWatcher:
+    '''
+    Notifies the OOM kills in containers as soon as they happen, using
+    the eventfd notification of cgroup v1 or inotify on memory.events
+    of cgroup v2.
+
+    Recent kernels may silently skip the deprecated v1 notifications, so the
+    OOM kill counters of the eventfd-watched containers are also polled by
+    poll() on every tick as a fallback.
+    '''
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.loop = asyncio.get_event_loop()
+        self.inotify_fd = -1
+        self.watched = {}  # cid -> (tracked, eventfd, inotify watch descriptor)
+        self.wds = {}      # inotify watch descriptor -> cid
+        self.oom_kills = {}
+
+    def close(self):
+        for cid in list(self.watched.keys()):
+            self.remove(cid)
+        if self.inotify_fd >= 0:
+            self.loop.remove_reader(self.inotify_fd)
+            os.close(self.inotify_fd)
+            self.inotify_fd = -1
+
+    def add(self, tracked):
+        sampler = tracked.sampler
+        self.oom_kills[tracked.cid] = sampler.read_oom_kills()
+        efd = sampler.open_oom_eventfd() if eventfd.is_supported() else None
+        if efd is not None:
+            self.watched[tracked.cid] = (tracked, efd, None)
+            self.loop.add_reader(efd, self._on_eventfd, tracked.cid)
+            return
+        path = sampler.get_oom_watch_path()
+        if path is None or not inotify.is_supported():
+            return
+        if self.inotify_fd < 0:
+            self.inotify_fd = inotify.init(inotify.IN_NONBLOCK | inotify.IN_CLOEXEC)
+            self.loop.add_reader(self.inotify_fd, self._on_inotify)
+        wd = inotify.add_watch(self.inotify_fd, path, inotify.IN_MODIFY)
+        self.watched[tracked.cid] = (tracked, None, wd)
+        self.wds[wd] = tracked.cid
+
+    def remove(self, cid):
+        self.oom_kills.pop(cid, None)
+        try:
+            _, efd, wd = self.watched.pop(cid)
+        except KeyError:
+            return
+        if efd is not None:
+            self.loop.remove_reader(efd)
+            os.close(efd)
+        else:
+            self.wds.pop(wd, None)
+            try:
+                inotify.rm_watch(self.inotify_fd, wd)
+            except OSError:
+                pass  # already removed along with the cgroup
+
+    def poll(self):
+        for cid, (tracked, efd, _) in list(self.watched.items()):
+            # Without the counter, we cannot tell the OOM kills by polling.
+            if efd is not None and self.oom_kills.get(cid) is not None:
+                self._check(tracked)
+
+    def _on_eventfd(self, cid):
+        tracked, efd, _ = self.watched[cid]
+        try:
+            eventfd.read(efd)
+        except BlockingIOError:
+            return
+        self._check(tracked)
+
+    def _on_inotify(self):
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 4096)
+            except BlockingIOError:
+                break
+            for wd, mask, _, _ in inotify.parse_events(data):
+                cid = self.wds.get(wd)
+                if cid is not None and mask & inotify.IN_MODIFY:
+                    self._check(self.watched[cid][0])
+
+    def _check(self, tracked):
+        try:
+            oom_kills = tracked.sampler.read_oom_kills()
+            # Without the counter, the notification itself does not tell
+            # an OOM event from the removal of the cgroup.
+            under_oom = oom_kills is None and tracked.sampler.is_under_oom()
+        except (OSError, ValueError):
+            return  # the cgroup is being removed
+        if oom_kills is None:
+            if under_oom:
+                self.callback(tracked)
+            return
+        last_oom_kills = self.oom_kills.get(tracked.cid)
+        self.oom_kills[tracked.cid] = oom_kills
+        if last_oom_kills is None or oom_kills > last_oom_kills:
+            self.callback(tracked)
+
+
+def decode_docker_stats(ret):
+    '''
+    Converts a sample of the Docker stats API into ContainerStat.
+    Returns None if the sample is empty, e.g., when the container is not running.
+    '''
+    if ret is None:
         return None
-    else:
-        # API returned successfully but actually the result may be empty!
-        if ret is None:
-            return None
-        if ret['preread'].startswith('0001-01-01'):
-            return None
-        cpu_used = nmget(ret, 'cpu_stats.cpu_usage.total_usage', 0) / 1e6
-        cpu_system_used = nmget(ret, 'cpu_stats.system_cpu_usage', 0) / 1e6
-        mem_max_bytes = nmget(ret, 'memory_stats.max_usage', 0)
-        mem_cur_bytes = nmget(ret, 'memory_stats.usage', 0)
-
-        io_read_bytes = 0
-        io_write_bytes = 0
-        for item in nmget(ret, 'blkio_stats.io_service_bytes_recursive', []):
-            if item['op'] == 'Read':
-                io_read_bytes += item['value']
-            elif item['op'] == 'Write':
-                io_write_bytes += item['value']
-        io_max_scratch_size = 0
-        io_cur_scratch_size = 0
-
-        net_rx_bytes = 0
-        net_tx_bytes = 0
-        for dev in nmget(ret, 'networks', {}).values():
-            net_rx_bytes += dev['rx_bytes']
-            net_tx_bytes += dev['tx_bytes']
+    if ret['read'].startswith('0001-01-01'):
+        return None
+    cpu_used = nmget(ret, 'cpu_stats.cpu_usage.total_usage', 0) / 1e6
+    cpu_system_used = nmget(ret, 'cpu_stats.system_cpu_usage', 0) / 1e6
+    mem_max_bytes = nmget(ret, 'memory_stats.max_usage', 0)
+    mem_cur_bytes = nmget(ret, 'memory_stats.usage', 0)
+    mem_rss_bytes = nmget(ret, 'memory_stats.stats.total_rss', 0)
+    mem_cache_bytes = nmget(ret, 'memory_stats.stats.total_cache', 0)
+    mem_mapped_file_bytes = nmget(ret, 'memory_stats.stats.total_mapped_file', 0)
+    mem_swap_bytes = nmget(ret, 'memory_stats.stats.total_swap', 0)
+
+    io_read_bytes = 0
+    io_write_bytes = 0
+    for item in nmget(ret, 'blkio_stats.io_service_bytes_recursive', []):
+        if item['op'] == 'Read':
+            io_read_bytes += item['value']
+        elif item['op'] == 'Write':
+            io_write_bytes += item['value']
+    io_max_scratch_size = 0
+    io_cur_scratch_size = 0
+
+    # The Docker API does not expose the pressure stall information.
+    cpu_nr_throttled = nmget(ret, 'cpu_stats.throttling_data.throttled_periods', 0)
+    cpu_throttled_time = \
+        nmget(ret, 'cpu_stats.throttling_data.throttled_time', 0) / 1e6
+
+    net_rx_bytes = 0
+    net_tx_bytes = 0
+    for dev in nmget(ret, 'networks', {}).values():
+        net_rx_bytes += dev['rx_bytes']
+        net_tx_bytes += dev['tx_bytes']
     return ContainerStat(
         0,  # precpu_used calculated automatically
         cpu_used,
@@ -283,20 +2024,15 @@ async def _collect_stats_api(container):
         io_write_bytes,
         io_max_scratch_size,
         io_cur_scratch_size,
+        cpu_nr_throttled,
+        cpu_throttled_time,
+        mem_rss_bytes=mem_rss_bytes,
+        mem_cache_bytes=mem_cache_bytes,
+        mem_mapped_file_bytes=mem_mapped_file_bytes,
+        mem_swap_bytes=mem_swap_bytes,
     )
 
 
-async def collect_stats(containers):
-    if check_cgroup_available():
-        results = tuple(_collect_stats_sysfs(c._id) for c in containers)
-    else:
-        tasks = []
-        for c in containers:
-            tasks.append(asyncio.ensure_future(_collect_stats_api(c)))
-        results = await asyncio.gather(*tasks)
-    return results
-
-
 def numeric_list(s):
     return [int(p) for p in s.split()]
 
@@ -305,184 +2041,372 @@ def read_sysfs(path, type_=int, default_val=0):
     return type_(Path(path).read_text().strip())
 
 
-@contextmanager
-def join_cgroup_and_namespace(cid, initial_stat, send_stat, signal_sock):
-    libc = CDLL('libc.so.6', use_errno=True)
-    libc.setns.errcheck = _errcheck
-    mypid = os.getpid()
+def get_cgroup_pids(cid):
+    try:
+        pids = Path(f'/sys/fs/cgroup/memory/docker/{cid}/cgroup.procs').read_text()
+        return numeric_list(pids)
+    except IOError:
+        return []
 
-    # The list of monitored cgroup resource types
-    cgroups = ['memory', 'cpuacct', 'blkio', 'net_cls']
 
-    try:
-        # Create the cgroups and change my membership.
-        # The reason for creating cgroups first is to keep them alive
-        # after the Docker has killed the container.
-        for cgroup in cgroups:
-            cg_path = Path(f'/sys/fs/cgroup/{cgroup}/docker/{cid}')
-            cg_path.mkdir(parents=True, exist_ok=True)
-            cgtasks_path = Path(f'/sys/fs/cgroup/{cgroup}/docker/{cid}/cgroup.procs')
-            cgtasks_path.write_text(str(mypid))
-    except PermissionError:
-        print('Cannot write cgroup filesystem due to permission error!',
-              file=sys.stderr)
-        sys.exit(1)
+def is_cgroup_running(cid):
+    return (len(get_cgroup_pids(cid)) > 0)
 
-    # Notify the agent to start the container.
-    signal_sock.send_multipart([b''])
 
-    # Wait for the container to be started.
-    signal_sock.recv_multipart()
+@dataclass(frozen=False)
+class TrackedContainer:
+    cid: str
+    handle: int = 0
+    scratch_dir: str = None
+    stat: ContainerStat = field(default_factory=ContainerStat)
+    started: bool = False
+    sampler: CgroupSampler = None
+    container: DockerContainer = None
+    stream_task: asyncio.Task = None
+    scan_task: asyncio.Task = None
 
-    try:
-        procs_path = Path(f'/sys/fs/cgroup/net_cls/docker/{cid}/cgroup.procs')
-        pids = procs_path.read_text()
-        pids = set(int(p) for p in pids.split())
-    except PermissionError:
-        print('Cannot read cgroup filesystem due to permission error!',
-              file=sys.stderr)
-        sys.exit(1)
-    except FileNotFoundError:
-        print([p.name for p in Path('/sys/fs/cgroup/memory/docker').iterdir()])
-        print('Cannot read cgroup filesystem.\n'
-              'The container did not start or may have already terminated.',
-              file=sys.stderr)
-        send_stat({
-            'cid': args.cid,
-            'status': 'terminated',
-            'data': asdict(initial_stat),
-        })
-        sys.exit(0)
 
-    try:
-        # Get non-myself pid from the current running processes.
-        pids.discard(mypid)
-        first_pid = pids.pop()
-        # Enter the container's network namespace so that we can see the exact "eth0"
-        # (which is actually "vethXXXX" in the host namespace)
-        with open(f'/proc/{first_pid}/ns/net', 'r') as f:
-            libc.setns(f.fileno(), CLONE_NEWNET)
-    except PermissionError:
-        print('This process must be started with the root privilege or have explicit'
-              'CAP_SYS_ADMIN, CAP_DAC_OVERRIDE, and CAP_SYS_PTRACE capabilities.',
-              file=sys.stderr)
-        sys.exit(1)
-    except (FileNotFoundError, KeyError):
-        print('The container has already terminated.', file=sys.stderr)
-        send_stat({
-            'cid': args.cid,
-            'status': 'terminated',
-            'data': asdict(initial_stat),
-        })
-        sys.exit(0)
+class StatCollectorDaemon:
+    '''
+    Samples the statistics of all registered containers together on each tick
+    and sends them as a single batch to the agent.
 
-    try:
-        yield
-    finally:
-        # Move to the parent cgroup and self-remove the container cgroup
-        for cgroup in cgroups:
-            Path(f'/sys/fs/cgroup/{cgroup}/cgroup.procs').write_text(str(mypid))
+    Container terminations are primarily notified by the agent, which forwards
+    Docker's "die" events.  The cgroup liveness check is only a fallback
+    for missed events and runs once per *liveness_interval* seconds.
+    '''
+
+    def __init__(self, stat_type, stats_sock, ctrl_sock, *,
+                 interval=1.0, liveness_interval=10.0):
+        self.stat_type = stat_type
+        self.stats_sock = stats_sock
+        self.ctrl_sock = ctrl_sock
+        self.interval = interval
+        self.liveness_ticks = max(1, round(liveness_interval / interval))
+        self.num_ticks = 0
+        self.containers = {}
+        self.docker = Docker() if stat_type == 'api' else None
+        self.sampler_cls = None
+        self.system_usage = None
+        if stat_type == 'cgroup':
+            # Detect the cgroup hierarchy once at startup.
+            self.sampler_cls = get_cgroup_sampler_class()
+            self.system_usage = self.sampler_cls.open_system_usage()
+            log.info('using cgroup v{} statistics', get_cgroup_version())
+        self.oom_watcher = None
+        if stat_type == 'cgroup':
+            self.oom_watcher = OOMWatcher(self.report_oom)
+        self.scratch_index = None
+        if inotify.is_supported():
+            self.scratch_index = ScratchUsageIndex()
+        self.shutdown_event = asyncio.Event()
+        self.pending_msgs = []
+
+    def send_batch(self, msgs):
+        if msgs:
+            self.stats_sock.send(encode_stat_batch(msgs), copy=False)
+
+    def flush_pending(self):
+        msgs, self.pending_msgs = self.pending_msgs, []
+        self.send_batch(msgs)
+
+    def make_msg(self, tracked, new_stat):
+        if (new_stat is not None and tracked.scratch_dir is not None and
+                self.scratch_index is not None):
+            new_stat.io_cur_scratch_size = \
+                self.scratch_index.get_usage(tracked.scratch_dir)
+        tracked.stat.update(new_stat)
+        if new_stat is not None:
+            status = STAT_STATUS_RUNNING
+        else:
+            status = STAT_STATUS_TERMINATED
+            self.forget(tracked.cid)
+        return (tracked.handle, status, tracked.stat)
+
+    def report(self, tracked, new_stat):
+        # Coalesce the samples from multiple streams arriving
+        # in the same event loop iteration into a single batch.
+        if not self.pending_msgs:
+            asyncio.get_event_loop().call_soon(self.flush_pending)
+        handle, status, stat = self.make_msg(tracked, new_stat)
+        # Take a snapshot as the stat may be updated again before flushing.
+        self.pending_msgs.append((handle, status, replace(stat)))
+
+    async def handle_ctrl(self):
+        while True:
             try:
-                os.rmdir(f'/sys/fs/cgroup/{cgroup}/docker/{cid}')
+                identity, op, cid, *args = await self.ctrl_sock.recv_multipart()
+            except ValueError:
+                log.warning('ignoring malformed control message')
+                continue
+            try:
+                if await self.handle_ctrl_msg(identity, op, cid, args):
+                    break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('error while handling control message {!r}', op)
+
+    async def handle_ctrl_msg(self, identity, op, cid, args):
+        '''
+        Handles a control message from the agent.
+        Returns True when the daemon should shut down.
+        '''
+        cid = cid.decode('ascii')
+        if op == b'register':
+            if cid in self.containers:
+                self.forget(cid)  # a duplicate registration
+            handle, = struct.unpack('!I', args[0])
+            tracked = TrackedContainer(cid, handle)
+            if self.stat_type == 'api':
+                tracked.container = DockerContainer(self.docker, id=cid)
+            self.containers[cid] = tracked
+            log.debug('registered container {}', cid[:7])
+            await self.ctrl_sock.send_multipart([identity, b'ack',
+                                                 cid.encode('ascii')])
+            if len(args) > 1 and args[1] and self.scratch_index is not None:
+                # The initial walk of the scratch directory proceeds in the
+                # background, interleaved with the sampling of the others.
+                tracked.scratch_dir = os.fsdecode(args[1])
+                tracked.scan_task = asyncio.ensure_future(
+                    self.scratch_index.add(tracked.scratch_dir))
+        elif op == b'start':
+            tracked = self.containers.get(cid)
+            if tracked is not None:
+                tracked.started = True
+                if self.stat_type == 'api':
+                    tracked.stream_task = asyncio.ensure_future(
+                        self.stream_stats_api(tracked))
+        elif op == b'unregister':
+            self.forget(cid)
+            log.debug('unregistered container {}', cid[:7])
+        elif op == b'died':
+            self.terminate(cid)
+        elif op == b'shutdown':
+            self.shutdown_event.set()
+            return True
+        return False
+
+    def forget(self, cid):
+        tracked = self.containers.pop(cid, None)
+        if tracked is None:
+            return
+        if tracked.sampler is not None:
+            self.oom_watcher.remove(cid)
+            tracked.sampler.close()
+        if tracked.scratch_dir is not None:
+            self.scratch_index.remove(tracked.scratch_dir)
+        if tracked.scan_task is not None:
+            tracked.scan_task.cancel()
+        if (tracked.stream_task is not None and
+                tracked.stream_task is not asyncio.Task.current_task()):
+            tracked.stream_task.cancel()
+
+    def terminate(self, cid):
+        '''
+        Takes the final sample of a dead container and reports its termination
+        without waiting for the next tick.
+        '''
+        tracked = self.containers.get(cid)
+        if tracked is None:
+            return
+        if tracked.sampler is not None:
+            try:
+                cpu_system_used = \
+                    self.sampler_cls.read_system_usage(self.system_usage)
+                # The cgroup stays readable until Docker removes it.
+                tracked.stat.update(tracked.sampler.sample(cpu_system_used))
+            except Exception:
+                # Report the termination with the last sample anyway.
+                log.exception('cannot take the final sample of container {}',
+                              cid[:7])
+        log.debug('container {} has died', cid[:7])
+        self.report(tracked, None)
+
+    def report_oom(self, tracked):
+        '''
+        Sends the memory stats taken right after an OOM kill in the container
+        without waiting for the next tick.
+        '''
+        try:
+            cpu_system_used = self.sampler_cls.read_system_usage(self.system_usage)
+            tracked.stat.update(tracked.sampler.sample(cpu_system_used))
+        except Exception:
+            log.exception('cannot sample container {}', tracked.cid[:7])
+        log.info('OOM kill in container {}', tracked.cid[:7])
+        msg = (tracked.handle, STAT_STATUS_RUNNING, tracked.stat)
+        self.stats_sock.send(encode_stat_batch([msg], STAT_MSG_OOM), copy=False)
+
+    async def is_container_running(self, container):
+        try:
+            info = await container.show()
+        except DockerError as e:
+            if e.status == 404:
+                return False
+            raise
+        return info['State']['Running']
+
+    async def stream_stats_api(self, tracked):
+        '''
+        Keeps a streaming stats connection for the container and reports each
+        sample at Docker's native cadence, reconnecting when the stream drops.
+        '''
+        backoff = 0.5
+        while True:
+            try:
+                stream = tracked.container.stats(stream=True)
+                if inspect.isawaitable(stream):
+                    # Older aiodocker versions return a coroutine resolving to
+                    # a stream result object instead of an async generator.
+                    stream = await stream
+                try:
+                    async for ret in stream:
+                        backoff = 0.5
+                        new_stat = decode_docker_stats(ret)
+                        if new_stat is not None:
+                            self.report(tracked, new_stat)
+                finally:
+                    # The stream is infinite, so we must close the response
+                    # explicitly instead of waiting for its end.
+                    if hasattr(stream, 'aclose'):
+                        await stream.aclose()
+                running = await self.is_container_running(tracked.container)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                if isinstance(e, (DockerError, aiohttp.ClientError)):
+                    log.warning('stats stream error for container {}: {!r}',
+                                tracked.cid[:7], e)
+                else:
+                    # Keep retrying instead of silently stopping the stats.
+                    log.exception('unexpected stats stream error for '
+                                  'container {}', tracked.cid[:7])
+                try:
+                    running = await self.is_container_running(tracked.container)
+                except asyncio.CancelledError:
+                    break
+                except (DockerError, aiohttp.ClientError):
+                    running = True  # retry later
+            if not running:
+                self.report(tracked, None)
+                break
+            log.debug('reconnecting stats stream for container {}', tracked.cid[:7])
+            try:
+                await asyncio.sleep(backoff)
+            except asyncio.CancelledError:
+                break
+            backoff = min(backoff * 2, 10.0)
+
+    def collect_cgroup(self, tracked, cpu_system_used):
+        if tracked.sampler is None:
+            sampler = self.sampler_cls(tracked.cid)
+            try:
+                sampler.open()
             except OSError:
-                pass
+                # The container has not started or has already terminated.
+                return None
+            tracked.sampler = sampler
+            try:
+                self.oom_watcher.add(tracked)
+            except OSError as e:
+                log.warning('cannot watch OOM events of container {}: {!r}',
+                            tracked.cid[:7], e)
+        elif (self.num_ticks % self.liveness_ticks == 0 and
+                not tracked.sampler.is_running()):
+            return None
+        return tracked.sampler.sample(cpu_system_used)
 
+    def sample(self):
+        if self.stat_type != 'cgroup':
+            # The api-mode samples are pushed by the stream tasks.
+            return
+        targets = [t for t in self.containers.values() if t.started]
+        cpu_system_used = self.sampler_cls.read_system_usage(self.system_usage)
+        msgs = []
+        for tracked in targets:
+            try:
+                new_stat = self.collect_cgroup(tracked, cpu_system_used)
+                msgs.append(self.make_msg(tracked, new_stat))
+            except Exception:
+                # Skip only this container in this tick.
+                log.exception('cannot sample container {}', tracked.cid[:7])
+        self.send_batch(msgs)
+        self.oom_watcher.poll()
+        self.num_ticks += 1
 
-def is_cgroup_running(cid):
-    try:
-        pids = Path(f'/sys/fs/cgroup/net_cls/docker/{cid}/cgroup.procs').read_text()
-        pids = numeric_list(pids)
-    except IOError:
-        return False
-    else:
-        return (len(pids) > 1)
+    async def run(self):
+        ppid = os.getppid()
+        ctrl_task = asyncio.ensure_future(self.handle_ctrl())
+        try:
+            while not self.shutdown_event.is_set():
+                if os.getppid() != ppid:
+                    log.warning('the agent has terminated; exiting.')
+                    break
+                try:
+                    self.sample()
+                except Exception:
+                    log.exception('unexpected error while sampling')
+                try:
+                    with timeout(self.interval):
+                        await self.shutdown_event.wait()
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if not ctrl_task.done():
+                ctrl_task.cancel()
+                await asyncio.gather(ctrl_task, return_exceptions=True)
+            tasks = [task for t in self.containers.values()
+                     for task in (t.stream_task, t.scan_task) if task is not None]
+            for cid in list(self.containers.keys()):
+                self.forget(cid)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.system_usage is not None:
+                self.system_usage.close()
+            if self.scratch_index is not None:
+                self.scratch_index.close()
+            if self.oom_watcher is not None:
+                self.oom_watcher.close()
+            if self.docker is not None:
+                await self.docker.close()
 
 
 def main(args):
-    context = zmq.Context.instance()
+    context = zmq.asyncio.Context()
     mypid = os.getpid()
 
     ipc_base_path = Path('/tmp/backend.ai/ipc')
-    signal_path = str(ipc_base_path / f'stat-start-{mypid}.sock')
-    log.debug('creating signal socket at {}', signal_path)
-    signal_sock = context.socket(zmq.PAIR)
-    signal_sock.bind('ipc://' + signal_path)
+    ctrl_path = str(ipc_base_path / f'stat-ctrl-{mypid}.sock')
+    log.debug('creating control socket at {}', ctrl_path)
+    ctrl_sock = context.socket(zmq.ROUTER)
+    ctrl_sock.bind('ipc://' + ctrl_path)
+    stats_sock = context.socket(zmq.PUSH)
+    stats_sock.setsockopt(zmq.LINGER, 2000)
+    stats_sock.connect(args.sockaddr)
+    loop = asyncio.get_event_loop()
+    log.info('started statistics collection')
     try:
-
-        stats_sock = context.socket(zmq.PUSH)
-        stats_sock.setsockopt(zmq.LINGER, 2000)
-        stats_sock.connect(args.sockaddr)
-        send_stat = functools.partial(
-            stats_sock.send_serialized,
-            serialize=lambda v: [msgpack.packb(v)])
-        stat = ContainerStat()
-        log.info('started statistics collection for {}', args.cid)
-
-        if args.type == 'cgroup':
-            with closing(stats_sock), join_cgroup_and_namespace(args.cid, stat,
-                                                                send_stat,
-                                                                signal_sock):
-                # Agent notification is done inside join_cgroup_and_namespace
-                while True:
-                    new_stat = _collect_stats_sysfs(args.cid)
-                    stat.update(new_stat)
-                    msg = {
-                        'cid': args.cid,
-                        'data': asdict(stat),
-                    }
-                    if is_cgroup_running(args.cid) and new_stat is not None:
-                        msg['status'] = 'running'
-                        send_stat(msg)
-                    else:
-                        msg['status'] = 'terminated'
-                        send_stat(msg)
-                        break
-                    time.sleep(1.0)
-        elif args.type == 'api':
-            loop = asyncio.get_event_loop()
-            docker = Docker()
-            with closing(stats_sock), closing(loop):
-                container = DockerContainer(docker, id=args.cid)
-                # Notify the agent to start the container.
-                signal_sock.send_multipart([b''])
-                # Wait for the container to be actually started.
-                signal_sock.recv_multipart()
-                while True:
-                    new_stat = loop.run_until_complete(_collect_stats_api(container))
-                    stat.update(new_stat)
-                    msg = {
-                        'cid': args.cid,
-                        'data': asdict(stat),
-                    }
-                    if new_stat is not None:
-                        msg['status'] = 'running'
-                        send_stat(msg)
-                    else:
-                        msg['status'] = 'terminated'
-                        send_stat(msg)
-                        break
-                    time.sleep(1.0)
-                loop.run_until_complete(docker.close())
-
+        with closing(stats_sock), closing(loop):
+            daemon = StatCollectorDaemon(args.type, stats_sock, ctrl_sock)
+            loop.run_until_complete(daemon.run())
     except (KeyboardInterrupt, SystemExit):
         sys.exit(1)
     else:
         sys.exit(0)
     finally:
-        signal_sock.close()
-        os.unlink(signal_path)
-        log.info('terminated statistics collection for {}', args.cid)
+        ctrl_sock.close()
+        os.unlink(ctrl_path)
+        context.term()
+        log.info('terminated statistics collection')
 
 
 if __name__ == '__main__':
     # The entry point for stat collector daemon
     parser = argparse.ArgumentParser()
     parser.add_argument('sockaddr', type=str)
-    parser.add_argument('cid', type=str)
     parser.add_argument('-t', '--type', choices=['cgroup', 'api'],
                         default='cgroup')
     args = parser.parse_args()
-    setproctitle(f'backend.ai: stat-collector {args.cid[:7]}')
+    setproctitle(f'backend.ai: stat-collector ({args.type})')
 
     log_config = argparse.Namespace()
     log_config.log_file = None
@@ -1,7 +1,11 @@
 import aiodocker
 import asyncio
+from pathlib import Path
+
 import pytest
 
+from .fakes import FakeRunnerFactory, make_stub_agent
+
 
 @pytest.fixture(scope='session')
 def prepare_docker_images():
@@ -88,3 +92,21 @@ def create_container(event_loop, docker):
             await container.delete(force=True)
 
     event_loop.run_until_complete(finalize())
+
+
+@pytest.fixture
+async def fake_runners(event_loop):
+    # Create the asyncio primitives on the test's event loop.
+    factory = FakeRunnerFactory()
+    with factory.patch():
+        yield factory
+
+
+@pytest.fixture
+def stub_agent(tmpdir):
+
+    def _create(kernel_ids=('k1',), **config):
+        config.setdefault('scratch_root', Path(tmpdir))
+        return make_stub_agent(kernel_ids=kernel_ids, **config)
+
+    return _create
@@ -0,0 +1,123 @@
+'''
+Stand-ins for running the agent's kernel runner and execution paths
+without Docker and real kernels.
+
+They are shared by the tests (via the fixtures in conftest.py) and
+scripts/bench-runner-concurrency.py.
+'''
+
+import argparse
+import asyncio
+from pathlib import Path
+import time
+from unittest import mock
+
+from ai.backend.agent.server import AgentRPCServer
+
+
+class FakeRunner:
+    '''
+    Mimics the parts of KernelRunner used by AgentRPCServer.
+    Its behavior is controlled by the FakeRunnerFactory which created it.
+    '''
+
+    def __init__(self, factory, kernel_id):
+        self.factory = factory
+        self.kernel_id = kernel_id
+        self.closed = False
+        self.ready_at = None
+
+    def restore_state(self, path):
+        self.factory.journal_ops.append(('restore', path))
+        return self.factory.has_journal
+
+    async def save_state(self, path):
+        self.factory.journal_ops.append(('save', path))
+        return True
+
+    async def start(self):
+        gate = self.factory.start_gates.get(self.kernel_id)
+        if gate is not None:
+            await gate.wait()
+        delay = self.factory.start_delays.get(self.kernel_id, 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        self.closed = True
+
+    async def wait_ready(self, timeout=None):
+        await asyncio.wait_for(self.factory.ready.wait(), timeout)
+        if self.ready_at is None:
+            self.ready_at = time.monotonic()
+
+    async def attach_output_queue(self, run_id, *, stream=False, received_at=None):
+        pass
+
+    def pop_run_timings(self, run_id):
+        return None
+
+    async def feed_code(self, text):
+        pass
+
+    async def get_next_result(self, api_ver=2, flush_timeout=None):
+        await asyncio.sleep(self.factory.exec_time)
+        return {
+            'runId': None,
+            'status': 'finished',
+            'exitCode': 0,
+            'options': {'upload_output_files': False},
+            'console': [],
+        }
+
+
+class FakeRunnerFactory:
+    '''
+    Replaces the KernelRunner class and keeps the runners it has created.
+    '''
+
+    def __init__(self):
+        self.created = []
+        self.start_gates = {}   # kernel_id -> asyncio.Event to wait in start()
+        self.start_delays = {}  # kernel_id -> seconds to sleep in start()
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.has_journal = False
+        self.journal_ops = []
+        self.exec_time = 0.0
+
+    def __call__(self, kernel_id, *args, **kwargs):
+        runner = FakeRunner(self, kernel_id)
+        self.created.append(runner)
+        return runner
+
+    def patch(self):
+        return mock.patch('ai.backend.agent.server.KernelRunner', self)
+
+
+def make_kernel_info(**kwargs):
+    kernel_info = {
+        'kernel_host': '127.0.0.1',
+        'repl_in_port': 2000,
+        'repl_out_port': 2001,
+        'exec_timeout': 0,
+        'last_used': time.monotonic(),
+        'runner_tasks': set(),
+        'runner_lock': asyncio.Lock(),
+        'kernel_features': set(),
+    }
+    kernel_info.update(kwargs)
+    return kernel_info
+
+
+def make_stub_agent(scratch_root: Path, kernel_ids=(), **config):
+    # Only the parts used by the runner and execution paths are initialized.
+    agent = AgentRPCServer.__new__(AgentRPCServer)
+    agent.config = argparse.Namespace(scratch_root=scratch_root, **config)
+    agent.stream_sock = None
+    agent.restarting_kernels = {}
+    agent.stats_monitor = mock.Mock()
+    agent.container_registry = {
+        kernel_id: make_kernel_info() for kernel_id in kernel_ids
+    }
+    return agent
@@ -0,0 +1,96 @@
+import os
+from pathlib import Path
+
+from ai.backend.agent.buildcache import BuildCache
+
+
+def make_work_dir(path, files):
+    path.mkdir()
+    for name, content in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(content)
+    return path
+
+
+def test_build_cache(tmpdir):
+    tmpdir = Path(tmpdir)
+    cache = BuildCache(tmpdir / 'cache')
+    work_dir = make_work_dir(tmpdir / 'work1', {
+        'main.c': 'int main() { return 0; }',
+        'include/util.h': '#define X 1',
+        '.env': 'CFLAGS=-O2',
+    })
+    key, file_stats = cache.compute_key('ak1', 'c:gcc', 'make', work_dir)
+    assert key is not None
+    assert set(file_stats) == {'main.c', 'include/util.h', '.env'}
+    assert cache.restore(key, work_dir) is False
+
+    # the build
+    (work_dir / 'main').write_text('binary')
+    (work_dir / 'build').mkdir()
+    (work_dir / 'build' / 'main.o').write_text('object')
+    assert cache.store(key, work_dir, file_stats) == 2
+
+    work_dir2 = make_work_dir(tmpdir / 'work2', {
+        'main.c': 'int main() { return 0; }',
+        'include/util.h': '#define X 1',
+        '.env': 'CFLAGS=-O2',
+    })
+    key2, _ = cache.compute_key('ak1', 'c:gcc', 'make', work_dir2)
+    assert key2 == key
+    assert cache.restore(key2, work_dir2)
+    assert (work_dir2 / 'main').read_text() == 'binary'
+    assert (work_dir2 / 'build' / 'main.o').read_text() == 'object'
+
+    # The owner, the image, the build command and the inputs are all in the key.
+    assert cache.compute_key('ak2', 'c:gcc', 'make', work_dir2)[0] != key
+    assert cache.compute_key('ak1', 'c:clang', 'make', work_dir2)[0] != key
+    assert cache.compute_key('ak1', 'c:gcc', 'make all', work_dir2)[0] != key
+    (work_dir2 / 'main.c').write_text('int main() { return 1; }')
+    key3, _ = cache.compute_key('ak1', 'c:gcc', 'make', work_dir2)
+    assert key3 != key
+    assert not cache.restore(key3, work_dir2)
+
+    cache.max_input_size = 10
+    assert cache.compute_key('ak1', 'c:gcc', 'make', work_dir2)[0] is None
+
+
+def test_build_cache_inputs(tmpdir):
+    tmpdir = Path(tmpdir)
+    cache = BuildCache(tmpdir / 'cache')
+    work_dir = make_work_dir(tmpdir / 'work', {
+        'main.c': '#include "config.h"',
+        'config.h.in': '#define X @X@',
+        '.env': 'X=1',
+    })
+    key1, file_stats = cache.compute_key('ak1', 'c:gcc', 'make', work_dir)
+    # A build generating a file which is also an input of the other builds
+    (work_dir / 'config.h').write_text('#define X 1')
+    cache.store(key1, work_dir, file_stats)
+
+    # Hidden files are inputs.
+    (work_dir / 'config.h').unlink()
+    (work_dir / '.env').write_text('X=2')
+    key2, _ = cache.compute_key('ak1', 'c:gcc', 'make', work_dir)
+    assert key2 != key1
+
+    # The outputs of other builds remain inputs.
+    (work_dir / '.env').write_text('X=1')
+    (work_dir / 'config.h').write_text('#define X 1')
+    key3, _ = cache.compute_key('ak1', 'c:gcc', 'make', work_dir)
+    (work_dir / 'config.h').write_text('#define X 2')
+    key4, _ = cache.compute_key('ak1', 'c:gcc', 'make', work_dir)
+    assert len({key1, key3, key4}) == 3
+
+
+def test_build_cache_eviction(tmpdir):
+    tmpdir = Path(tmpdir)
+    cache = BuildCache(tmpdir / 'cache', max_entries=1)
+    work_dir = make_work_dir(tmpdir / 'work', {'a.py': 'print(1)'})
+    key1, file_stats = cache.compute_key('ak1', 'python:3.6', 'build1', work_dir)
+    cache.store(key1, work_dir, file_stats)
+    os.utime(cache.root / key1, (0, 0))
+    key2, file_stats = cache.compute_key('ak1', 'python:3.6', 'build2', work_dir)
+    cache.store(key2, work_dir, file_stats)
+    assert not (cache.root / key1).exists()
+    assert (cache.root / key2).exists()
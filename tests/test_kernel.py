@@ -0,0 +1,675 @@
+import asyncio
+import json
+from pathlib import Path
+import time
+
+import msgpack
+import pytest
+import zmq
+import zmq.asyncio
+
+from ai.backend.agent.kernel import KernelRunner, OutputBuffer, ResultRecord
+
+
+class FakeStream:
+    '''
+    Mimics the aiozmq streams used to send messages.
+    '''
+
+    def __init__(self):
+        self.written = []
+        self.transport = object()
+        self.closed = False
+
+    def write(self, frame):
+        self.written.append(frame)
+
+    def at_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSocket:
+    '''
+    Mimics the zmq.asyncio socket receiving the kernel's outputs.
+    '''
+
+    def __init__(self):
+        self.frames = asyncio.Queue()
+        self.num_waits = 0
+        self.closed = False
+
+    def feed(self, *frames):
+        for frame in frames:
+            self.frames.put_nowait(frame)
+
+    async def recv_multipart(self, flags=0):
+        if flags & zmq.NOBLOCK:
+            try:
+                return self.frames.get_nowait()
+            except asyncio.QueueEmpty:
+                raise zmq.Again
+        self.num_waits += 1
+        return await self.frames.get()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+async def runner_factory(event_loop):
+    runners = []
+
+    def _create(**kwargs):
+        runner = KernelRunner('fake-kernel', '127.0.0.1', 2000, 2001, 0,
+                              {'input', 'continuation'}, **kwargs)
+        runner.input_stream = FakeStream()
+        runner.output_sock = FakeSocket()
+        runner.watchdog_task = None
+        runner.read_task = asyncio.ensure_future(runner.read_output())
+        runners.append(runner)
+        return runner
+
+    yield _create
+
+    for runner in runners:
+        await runner.close()
+
+
+@pytest.mark.asyncio
+async def test_run_outputs(runner_factory):
+    runner = runner_factory()
+    await runner.attach_output_queue('run1')
+    await runner.feed_code('print("hello")')
+    assert runner.input_stream.written == [[b'code', b'print("hello")']]
+    runner.output_sock.feed(
+        [b'stdout', b'hello'],
+        [b'stdout', b' world\n'],
+        [b'stderr', b'warning\n'],
+        [b'finished', json.dumps({'exitCode': 0}).encode()],
+    )
+    result = await runner.get_next_result(api_ver=2)
+    assert result['runId'] == 'run1'
+    assert result['status'] == 'finished'
+    assert result['exitCode'] == 0
+    assert result['console'] == [
+        ('stdout', 'hello world\n'),
+        ('stderr', 'warning\n'),
+    ]
+    assert runner.output_queue is None
+    assert runner.current_run_id is None
+
+
+@pytest.mark.asyncio
+async def test_run_timings(runner_factory):
+    runner = runner_factory()
+    received_at = time.monotonic()
+    await runner.attach_output_queue('run1', received_at=received_at)
+    task = asyncio.ensure_future(runner.attach_output_queue('run2'))
+    await asyncio.sleep(0.05)
+    runner.output_sock.feed([b'stdout', b'hi\n'])
+    await asyncio.sleep(0)
+    timings = runner.run_timings['run1']
+    assert timings.received_at == received_at
+    assert timings.first_output_at >= received_at
+    runner.output_sock.feed([b'finished', json.dumps({'exitCode': 0}).encode()])
+    await runner.get_next_result(api_ver=2)
+    await task
+    assert runner.pop_run_timings('run1') is timings
+    assert timings.finished_at >= timings.first_output_at
+    assert timings.queued == 0
+    # The next run has waited for the previous one to finish.
+    timings2 = runner.run_timings['run2']
+    assert timings2.queued >= 0.05
+    assert timings2.first_output_at is None
+
+
+@pytest.mark.asyncio
+async def test_run_timings_unfinished(runner_factory):
+    runner = runner_factory()
+    runner.finished_run_timings_size = 2
+    for idx in range(3):
+        await runner.attach_output_queue(f'run{idx}')
+        runner.output_sock.feed(
+            [b'finished', json.dumps({'exitCode': 0}).encode()])
+        await runner.get_next_result(api_ver=2)
+    # Only the recent ones are kept until taken.
+    assert list(runner.finished_run_timings) == ['run1', 'run2']
+    assert not runner.run_timings
+
+    # A run which never finishes and a request which gave up waiting for it
+    await runner.attach_output_queue('run3')
+    task = asyncio.ensure_future(runner.attach_output_queue('run4'))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert list(runner.run_timings) == ['run3']
+    await runner.close()
+    assert not runner.run_timings
+    assert not runner.finished_run_timings
+
+
+@pytest.mark.asyncio
+async def test_batch_phases(runner_factory):
+    runner = runner_factory()
+    await runner.attach_output_queue('run1')
+    opts = {'clean': None, 'build': 'make', 'exec': './main'}
+    await runner.feed_batch(opts, phases=('clean',))
+    assert runner.input_stream.written == [[b'clean', b'']]
+    runner.output_sock.feed([b'clean-finished', b'{"exitCode": 0}'])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'clean-finished'
+
+    runner.mark_build_cached('run1')
+    await runner.feed_batch({'build': ''}, phases=('build',))
+    await runner.attach_output_queue('run1')
+    runner.output_sock.feed([b'build-finished', b'{"exitCode": 0}'])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'build-cached'
+    assert result['exitCode'] == 0
+
+    await runner.feed_batch(opts, phases=('exec',))
+    assert runner.input_stream.written[1:] == [[b'build', b''], [b'exec', b'./main']]
+    await runner.attach_output_queue('run1')
+    runner.output_sock.feed([b'finished', b'{"exitCode": 0}'])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'finished'
+    assert not runner.cached_build_runs
+
+
+@pytest.mark.asyncio
+async def test_streamed_run_outputs(runner_factory):
+    pub = FakeStream()
+    runner = runner_factory(output_pub=pub)
+    await runner.attach_output_queue('run1', stream=True)
+    await runner.feed_code('input()')
+    runner.output_sock.feed(
+        [b'stdout', b'\xed\x95'],  # an incomplete UTF-8 sequence
+        [b'stdout', b'\x9c\n'],
+        [b'waiting-input', json.dumps({'is_password': False}).encode()],
+    )
+    # The result is returned without waiting for the flush timeout.
+    result = await asyncio.wait_for(
+        runner.get_next_result(api_ver=2, flush_timeout=10.0), 1.0)
+    assert result['status'] == 'waiting-input'
+    assert result['console'] == []
+    assert pub.written == [
+        [b'run1', b'stdout', '한\n'.encode('utf8')],
+        [b'run1', b'result', json.dumps({
+            'status': 'waiting-input',
+            'exitCode': None,
+            'options': {'is_password': False},
+        }).encode()],
+    ]
+
+    # The continuation of the run is still streamed.
+    pub.written.clear()
+    await runner.attach_output_queue('run1')
+    await runner.feed_input('x')
+    runner.output_sock.feed(
+        [b'stdout', b'done\n'],
+        [b'finished', json.dumps({'exitCode': 0}).encode()],
+    )
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'finished'
+    assert [frame[:2] for frame in pub.written] == [
+        [b'run1', b'stdout'],
+        [b'run1', b'result'],
+    ]
+    assert not runner.streaming_runs
+
+    # Other runs are not streamed.
+    pub.written.clear()
+    await runner.attach_output_queue('run2')
+    runner.output_sock.feed(
+        [b'stdout', b'hi\n'],
+        [b'finished', json.dumps({'exitCode': 0}).encode()],
+    )
+    result = await runner.get_next_result(api_ver=2)
+    assert result['console'] == [('stdout', 'hi\n')]
+    assert pub.written == []
+
+
+@pytest.mark.asyncio
+async def test_streamed_run_requirements(runner_factory):
+    runner = runner_factory()
+    with pytest.raises(RuntimeError):
+        await runner.attach_output_queue('run1', stream=True)
+    runner = runner_factory(output_pub=FakeStream())
+    with pytest.raises(ValueError):
+        await runner.attach_output_queue(None, stream=True)
+
+
+@pytest.mark.asyncio
+async def test_runner_readiness(unused_tcp_port_factory):
+    repl_in_port = unused_tcp_port_factory()
+    repl_out_port = unused_tcp_port_factory()
+    runner = KernelRunner('fake-kernel', '127.0.0.1',
+                          repl_in_port, repl_out_port, 0, set())
+    await runner.start()
+    repl_out = zmq.asyncio.Context.instance().socket(zmq.PUSH)
+    repl_out.setsockopt(zmq.LINGER, 0)
+    try:
+        # The kernel is still booting.
+        with pytest.raises(asyncio.TimeoutError):
+            await runner.wait_ready(0.2)
+        assert not runner.is_ready
+        repl_out.bind(f'tcp://127.0.0.1:{repl_out_port}')
+        await runner.wait_ready(5.0)
+        assert runner.is_ready
+        assert runner.ready_at >= runner.started_at
+        assert runner.monitor_task.done()
+    finally:
+        repl_out.close()
+        await runner.close()
+
+
+def sent_requests(runner, msg_type):
+    return [json.loads(payload) for type_, payload in runner.input_stream.written
+            if type_ == msg_type]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_completions(runner_factory):
+    runner = runner_factory()
+    t1 = asyncio.ensure_future(runner.feed_and_get_completion('a', {}))
+    t2 = asyncio.ensure_future(runner.feed_and_get_completion('b', {}))
+    t3 = asyncio.ensure_future(runner.feed_and_get_completion('b', {}))
+    await asyncio.sleep(0)
+    # The identical requests are sent only once.
+    req1, req2 = sent_requests(runner, b'complete')
+    assert req1['code'] == 'a' and req2['code'] == 'b'
+    # The replies are dispatched by the request IDs regardless of their order.
+    runner.output_sock.feed(
+        [b'completion', b'["b1", "b2"]', req2['reqId'].encode()],
+        [b'completion', b'["a1"]', req1['reqId'].encode()],
+    )
+    assert await t1 == ['a1']
+    assert await t2 == await t3 == ['b1', 'b2']
+    assert not runner.pending_completions
+
+    # The recent results are reused.
+    assert await runner.feed_and_get_completion('b', {}) == ['b1', 'b2']
+    assert len(sent_requests(runner, b'complete')) == 2
+    runner.completion_cache_ttl = 0
+    runner.completion_cache.clear()
+    t4 = asyncio.ensure_future(runner.feed_and_get_completion('b', {}))
+    await asyncio.sleep(0)
+    assert len(sent_requests(runner, b'complete')) == 3
+
+    # Old kernels without the request IDs reply in order.
+    runner.output_sock.feed([b'completion', b'["b3"]'])
+    assert await t4 == ['b3']
+
+
+@pytest.mark.asyncio
+async def test_superseded_completions(runner_factory):
+    runner = runner_factory()
+    t1 = asyncio.ensure_future(runner.feed_and_get_completion('pri', {}))
+    await asyncio.sleep(0)
+    t2 = asyncio.ensure_future(
+        runner.feed_and_get_completion('prin', {}, supersede=True))
+    await asyncio.sleep(0)
+    assert await t1 is None
+    req1, req2 = sent_requests(runner, b'complete')
+    runner.output_sock.feed(
+        [b'completion', b'["print"]', req1['reqId'].encode()],
+        [b'completion', b'["print"]', req2['reqId'].encode()],
+    )
+    assert await t2 == ['print']
+    # The result of the superseded request is still cached.
+    assert await runner.feed_and_get_completion('pri', {}) == ['print']
+    assert len(sent_requests(runner, b'complete')) == 2
+
+
+@pytest.mark.asyncio
+async def test_msgpack_payloads(runner_factory):
+    runner = runner_factory(kernel_features={'msgpack'})
+    task = asyncio.ensure_future(runner.feed_and_get_completion('a', {}))
+    await asyncio.sleep(0)
+    (msg_type, payload), = runner.input_stream.written
+    req = msgpack.unpackb(payload, raw=False)
+    assert msg_type == b'complete' and req['code'] == 'a'
+    runner.output_sock.feed([b'completion', msgpack.packb(['ab']),
+                             req['reqId'].encode()])
+    assert await task == ['ab']
+
+    await runner.attach_output_queue('run1')
+    png = b'\x89PNG\r\n\x1a\n\xff'
+    media = msgpack.packb({'type': 'image/png', 'data': png}, use_bin_type=True)
+    runner.output_sock.feed(
+        [b'media', media],
+        [b'waiting-input', msgpack.packb({'is_password': True})],
+    )
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'waiting-input'
+    assert result['options'] == {'is_password': True}
+    # The media blobs are passed through as bytes.
+    assert result['console'] == [('media', ('image/png', png))]
+    await runner.attach_output_queue('run1')
+    runner.output_sock.feed([b'finished', msgpack.packb({'exitCode': 1})])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['exitCode'] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_start_services(runner_factory):
+    runner = runner_factory()
+    t1 = asyncio.ensure_future(runner.feed_start_service({'name': 'jupyter'}))
+    t2 = asyncio.ensure_future(runner.feed_start_service({'name': 'ttyd'}))
+    await asyncio.sleep(0)
+    req1, req2 = sent_requests(runner, b'start-service')
+    assert req1['name'] == 'jupyter' and req2['name'] == 'ttyd'
+    runner.output_sock.feed(
+        [b'service-result', b'{"status": "failed"}', req2['reqId'].encode()],
+        [b'service-result', b'{"status": "started"}', req1['reqId'].encode()],
+    )
+    assert await t1 == {'status': 'started'}
+    assert await t2 == {'status': 'failed'}
+
+    # The cancellation of the caller is propagated.
+    t3 = asyncio.ensure_future(runner.feed_start_service({'name': 'ttyd'}))
+    t4 = asyncio.ensure_future(runner.feed_and_get_completion('a', {}))
+    await asyncio.sleep(0)
+    t3.cancel()
+    t4.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await t3
+    with pytest.raises(asyncio.CancelledError):
+        await t4
+
+    t5 = asyncio.ensure_future(runner.feed_start_service({'name': 'ttyd'}))
+    t6 = asyncio.ensure_future(runner.feed_and_get_completion('b', {}))
+    await asyncio.sleep(0)
+    await runner.close()
+    assert await t5 == {'status': 'failed', 'error': 'cancelled'}
+    assert await t6 == []
+
+
+def test_output_buffer_spill(tmpdir):
+    spill_path = Path(tmpdir) / 'spill' / 'run.spill'
+    buf = OutputBuffer(spill_path, memory_limit=10, max_size=1000)
+    for idx in range(5):
+        assert buf.reserve(4)
+        buf.append(ResultRecord('stdout', f'{idx:03d}\n'))
+    # Only the first two records fit in the memory limit.
+    assert len(buf.records) == 2
+    assert buf.num_spilled == 3
+    assert spill_path.exists()
+    mark = buf.end
+    buf.append(ResultRecord('html', '<b>한글</b>'))
+    buf.append(ResultRecord('media', b'\x89PNG\xff'))
+
+    records = list(buf.drain(mark))
+    assert [rec.data for rec in records] == [f'{idx:03d}\n' for idx in range(5)]
+    assert list(buf.drain()) == [
+        ResultRecord('html', '<b>한글</b>'),
+        ResultRecord('media', b'\x89PNG\xff'),
+    ]
+    assert list(buf.drain()) == []
+    # The spill file is reused from the beginning once drained.
+    assert buf.spill_woff == buf.spill_roff == 0
+
+    # The spill file grows as needed.
+    buf.memory_limit = 0
+    large = 'x' * (OutputBuffer._initial_spill_size + 100)
+    buf.max_size = len(large) * 2
+    buf.append(ResultRecord('stdout', large))
+    assert len(buf.spill_map) > OutputBuffer._initial_spill_size
+    assert list(buf.drain()) == [ResultRecord('stdout', large)]
+
+    buf.close()
+    assert not spill_path.exists()
+
+
+def test_output_buffer_truncation():
+    buf = OutputBuffer(None, memory_limit=10, max_size=10)
+    assert buf.reserve(6)
+    buf.append(ResultRecord('stdout', 'abcdef'))
+    assert not buf.reserve(6)
+    assert not buf.reserve(1)
+    assert buf.truncated
+    assert buf.dropped_size == 7
+    # Without a spill file, records are kept in memory within the budget.
+    assert list(buf.drain()) == [
+        ResultRecord('stdout', 'abcdef'),
+        ResultRecord('truncated', None),
+    ]
+    buf.close()
+
+
+def test_output_buffer_spill_failure(tmpdir):
+    blocker = Path(tmpdir) / 'blocker'
+    blocker.write_text('')
+    buf = OutputBuffer(blocker / 'run.spill', memory_limit=4, max_size=100)
+    assert buf.reserve(4)
+    buf.append(ResultRecord('stdout', 'abcd'))
+    assert buf.reserve(4)
+    buf.append(ResultRecord('stdout', 'efgh'))  # cannot create the spill file
+    assert buf.truncated
+    assert not buf.reserve(4)
+    assert list(buf.drain()) == [
+        ResultRecord('stdout', 'abcd'),
+        ResultRecord('truncated', None),
+    ]
+    buf.close()
+
+
+@pytest.mark.asyncio
+async def test_run_outputs_overflow(runner_factory, tmpdir):
+    spill_dir = Path(tmpdir) / 'output-spill'
+    runner = runner_factory(spill_dir=spill_dir)
+    runner.output_memory_limit = 100
+    runner.max_run_output_size = 1000
+    await runner.attach_output_queue('run1')
+    for idx in range(30):
+        runner.output_sock.feed([b'stdout', f'{idx:09d}\n'.encode()])
+    runner.output_sock.feed([b'waiting-input', b''])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'waiting-input'
+    assert not result['truncated']
+    assert result['console'] == [
+        ('stdout', ''.join(f'{idx:09d}\n' for idx in range(30))),
+    ]
+    assert len(list(spill_dir.iterdir())) == 1
+
+    await runner.attach_output_queue('run1')
+    for idx in range(100):
+        runner.output_sock.feed([b'stdout', f'{idx:09d}\n'.encode()])
+    runner.output_sock.feed([b'finished', json.dumps({'exitCode': 0}).encode()])
+    result = await runner.get_next_result(api_ver=2)
+    # The budget is shared by all outputs of the run.
+    assert result['truncated']
+    assert result['console'] == [
+        ('stdout', ''.join(f'{idx:09d}\n' for idx in range(70))),
+    ]
+    # The spill file is removed when the run finishes.
+    assert list(spill_dir.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_run_outputs_batching(runner_factory):
+    runner = runner_factory()
+    await runner.attach_output_queue('run1')
+    await asyncio.sleep(0)
+    num_waits = runner.output_sock.num_waits
+    for idx in range(100):
+        runner.output_sock.feed([b'stdout', f'{idx}\n'.encode()])
+    runner.output_sock.feed(
+        [b'stderr', b'oops\n'],
+        [b'stdout', b'\xed\x95'],
+        [b'stdout', b'\x9c'],
+        [b'html', b'<br>'],
+        [b'stdout', b'bye\n'],
+    )
+    for _ in range(3):
+        await asyncio.sleep(0)
+    # All frames are taken at once and the adjacent fragments are merged.
+    assert runner.output_sock.num_waits == num_waits + 1
+    assert list(runner.output_buffer.records) == [
+        ResultRecord('stdout', ''.join(f'{idx}\n' for idx in range(100))),
+        ResultRecord('stderr', 'oops\n'),
+        ResultRecord('stdout', '한'),
+        ResultRecord('html', '<br>'),
+        ResultRecord('stdout', 'bye\n'),
+    ]
+
+    runner.output_sock.feed(
+        [b'stdout', b'more\n'],
+        [b'finished', json.dumps({'exitCode': 0}).encode()],
+    )
+    result = await runner.get_next_result(api_ver=2)
+    # The fragments split across the batches are merged in the results.
+    assert result['console'] == [
+        ('stdout', ''.join(f'{idx}\n' for idx in range(100))),
+        ('stderr', 'oops\n'),
+        ('stdout', '한'),
+        ('html', '<br>'),
+        ('stdout', 'bye\nmore\n'),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_run_outputs_media(runner_factory):
+    runner = runner_factory()
+    await runner.attach_output_queue('run1')
+    await asyncio.sleep(0)
+    payload = json.dumps({'type': 'image/png', 'data': 'xx'}).encode()
+    runner.output_sock.feed(
+        [b'media', payload],
+        [b'media', b'not-a-payload'],  # dropped
+    )
+    for _ in range(3):
+        await asyncio.sleep(0)
+    # The media payloads are decoded once when read.
+    assert list(runner.output_buffer.records) == [
+        ResultRecord('media', payload, ('image/png', 'xx')),
+    ]
+    runner.output_sock.feed([b'finished', json.dumps({'exitCode': 0}).encode()])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['console'] == [('media', ('image/png', 'xx'))]
+
+
+@pytest.mark.asyncio
+async def test_runner_state_restoration(runner_factory, tmpdir):
+    spill_dir = Path(tmpdir) / 'output-spill'
+    journal_path = Path(tmpdir) / 'runner-state.msgpack'
+    runner = runner_factory(spill_dir=spill_dir)
+    runner.output_memory_limit = 20
+    await runner.attach_output_queue('run1')
+    for idx in range(5):
+        runner.output_sock.feed([b'stdout', f'{idx:09d}\n'.encode()],
+                                [b'html', f'<p>{idx}</p>'.encode()])
+    runner.output_sock.feed([b'waiting-input', b'{"is_password": true}'],
+                            [b'stdout', b'prompt: '])
+    task = asyncio.ensure_future(runner.attach_output_queue('run2'))
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert runner.output_buffer.num_spilled > 0
+    assert len(runner.output_buffer.records) > 0
+    assert await runner.save_state(journal_path)
+    task.cancel()
+    await runner.close()
+    # The spill file of run1 is kept.
+    assert len(list(spill_dir.iterdir())) == 1
+
+    # in the next agent process
+    runner = runner_factory(spill_dir=spill_dir)
+    runner.read_task.cancel()
+    assert runner.restore_state(journal_path)
+    assert not journal_path.exists()
+    runner.read_task = asyncio.ensure_future(runner.read_output())
+    await runner.attach_output_queue('run1')
+    result = await runner.get_next_result(api_ver=2)
+    assert result['runId'] == 'run1'
+    assert result['status'] == 'waiting-input'
+    assert result['options'] == {'is_password': True}
+    console = []
+    for idx in range(5):
+        console.append(('stdout', f'{idx:09d}\n'))
+        console.append(('html', f'<p>{idx}</p>'))
+    assert result['console'] == console
+
+    await runner.attach_output_queue('run1')
+    await runner.feed_input('x')
+    runner.output_sock.feed([b'finished', b'{"exitCode": 0}'])
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'finished'
+    assert result['console'] == [('stdout', 'prompt: ')]
+    # The pending run proceeds next.
+    assert runner.output_run_id == 'run2'
+    assert not runner.restore_state(journal_path)
+
+
+@pytest.mark.asyncio
+async def test_runner_state_restoration_msgpack(runner_factory, tmpdir):
+    spill_dir = Path(tmpdir) / 'output-spill'
+    journal_path = Path(tmpdir) / 'runner-state.msgpack'
+    runner = runner_factory(kernel_features={'msgpack'}, spill_dir=spill_dir)
+    await runner.attach_output_queue('run1')
+    png = b'\x89PNG\r\n\x1a\n\xff'
+    runner.output_sock.feed(
+        [b'media', msgpack.packb({'type': 'image/png', 'data': png},
+                                 use_bin_type=True)],
+        [b'waiting-input', msgpack.packb({'is_password': True, 'salt': b'\xff'},
+                                         use_bin_type=True)],
+    )
+    task = asyncio.ensure_future(runner.attach_output_queue('run2'))
+    for _ in range(3):
+        await asyncio.sleep(0)
+    # The pending status holds binary data.
+    assert await runner.save_state(journal_path)
+    task.cancel()
+    await runner.close()
+
+    runner = runner_factory(kernel_features={'msgpack'}, spill_dir=spill_dir)
+    runner.read_task.cancel()
+    assert runner.restore_state(journal_path)
+    runner.read_task = asyncio.ensure_future(runner.read_output())
+    await runner.attach_output_queue('run1')
+    result = await runner.get_next_result(api_ver=2)
+    assert result['status'] == 'waiting-input'
+    assert result['options'] == {'is_password': True, 'salt': b'\xff'}
+    assert result['console'] == [('media', ('image/png', png))]
+
+
+def test_aggregate_console():
+    records = [
+        ResultRecord('stdout', 'a'),
+        ResultRecord('stdout', 'b'),
+        ResultRecord('stderr', 'c'),
+        ResultRecord('media', json.dumps({'type': 'image/png', 'data': 'xx'})),
+        ResultRecord('stdout', 'd'),
+        ResultRecord('truncated', None),
+    ]
+    result = {}
+    KernelRunner.aggregate_console(result, records, 1)
+    assert result == {
+        'stdout': 'abd', 'stderr': 'c', 'media': [('image/png', 'xx')],
+        'html': [], 'truncated': True,
+    }
+    result = {}
+    KernelRunner.aggregate_console(result, records, 3)
+    assert result == {
+        'console': [
+            ('stdout', 'ab'),
+            ('stderr', 'c'),
+            ('media', ('image/png', 'xx')),
+            ('stdout', 'd'),
+        ],
+        'truncated': True,
+    }
+
+
+def test_aggregate_console_decoded_media():
+
+    def unpack_payload(data):
+        raise AssertionError('the media payload is decoded again')
+
+    records = [ResultRecord('media', b'raw', ('image/png', 'xx'))]
+    result = {}
+    KernelRunner.aggregate_console(result, records, 3, unpack_payload)
+    assert result['console'] == [('media', ('image/png', 'xx'))]
@@ -1,22 +1,27 @@
 import asyncio
 import os
+from pathlib import Path
+import struct
 import sys
+from unittest import mock
 
+from async_timeout import timeout
+import asynctest
 import pytest
 import zmq
 import zmq.asyncio
 
-from ai.backend.common import msgpack
 from ai.backend.agent import stats
 
 
 @pytest.fixture
-def stats_server():
+def stats_server(tmpdir):
     context = zmq.asyncio.Context()
     stats_sock = context.socket(zmq.PULL)
-    stats_port = stats_sock.bind_to_random_port('tcp://127.0.0.1')
+    stat_addr = 'ipc://' + str(tmpdir / 'stats.sock')
+    stats_sock.bind(stat_addr)
     try:
-        yield stats_sock, stats_port
+        yield stats_sock, stat_addr
     finally:
         stats_sock.close()
         context.term()
@@ -39,11 +44,6 @@ if 'TRAVIS' in os.environ:
     }
 
 
-async def recv_deserialized(sock):
-    msg = await sock.recv_multipart()
-    return [msgpack.unpackb(v) for v in msg]
-
-
 def test_numeric_list():
     s = '1 3 5 7'
     ret = stats.numeric_list(s)
@@ -67,11 +67,981 @@ def test_read_sysfs(tmpdir):
     assert ret == 1357
 
 
+def test_sysfs_file(tmpdir):
+    p = tmpdir.join('test.txt')
+    p.write('1357\n')
+    f = stats.SysfsFile(str(p))
+    try:
+        assert f.read_int() == 1357
+        # The same fd should observe the updated content.
+        p.write('2468\n')
+        assert f.read_int() == 2468
+        # Contents larger than the buffer should be read as a whole.
+        p.write('x' * 10000)
+        assert len(f.read()) == 10000
+    finally:
+        f.close()
+    assert f.fd == -1
+
+
+def test_parse_blkio_bytes():
+    data = (b'8:0 Read 13918208\n'
+            b'8:0 Write 100\n'
+            b'8:0 Sync 0\n'
+            b'8:0 Async 13918208\n'
+            b'8:0 Total 13918308\n'
+            b'8:16 Read 2\n'
+            b'Total 13918310\n')
+    assert stats.parse_blkio_bytes(data) == (13918210, 100)
+    assert stats.parse_blkio_bytes(b'') == (0, 0)
+
+
+def test_parse_net_dev():
+    data = (
+        b'Inter-|   Receive                            |  Transmit\n'
+        b' face |bytes    packets errs drop fifo frame compressed multicast|bytes\n'
+        b'    lo:    100      1    0    0    0     0          0         0'
+        b'      100       1    0    0    0     0       0          0\n'
+        b'  eth0:1296     16    0    0    0     0          0         0'
+        b'      816      10    0    0    0     0       0          0\n'
+    )
+    assert stats.parse_net_dev(data) == (1296, 816)
+
+
+def test_parse_keyed_values():
+    data = b'usage_usec 3154251\nuser_usec 2416563\nsystem_usec 737688\n'
+    assert stats.parse_keyed_values(data) == {
+        b'usage_usec': 3154251,
+        b'user_usec': 2416563,
+        b'system_usec': 737688,
+    }
+
+
+def test_parse_io_stat():
+    data = (b'8:0 rbytes=13918208 wbytes=0 rios=340 wios=0 dbytes=0 dios=0\n'
+            b'8:16 rbytes=2048 wbytes=4096 rios=1 wios=1 dbytes=0 dios=0\n')
+    assert stats.parse_io_stat(data) == (13920256, 4096)
+    assert stats.parse_io_stat(b'') == (0, 0)
+
+
+def test_parse_pressure():
+    data = (b'some avg10=1.53 avg60=0.87 avg300=0.23 total=3274187\n'
+            b'full avg10=0.25 avg60=0.00 avg300=0.00 total=1024\n')
+    assert stats.parse_pressure(data) == {b'some': 1.53, b'full': 0.25}
+    assert stats.parse_pressure(b'') == {}
+
+
+def test_parse_numa_stat():
+    v1_data = (b'total=5120 N0=4096 N1=1024\n'
+               b'hierarchical_total=6144 N0=4096 N1=2048\n')
+    assert stats.parse_numa_stat(v1_data) == {
+        b'total': {0: 4096, 1: 1024},
+        b'hierarchical_total': {0: 4096, 1: 2048},
+    }
+    v2_data = b'anon N0=16777216 N1=4194304\nfile N0=8388608 N1=0\n'
+    assert stats.parse_numa_stat(v2_data) == {
+        b'anon': {0: 16777216, 1: 4194304},
+        b'file': {0: 8388608, 1: 0},
+    }
+
+
+def test_parse_cpuset_list():
+    assert stats.parse_cpuset_list(b'0\n') == {0}
+    assert stats.parse_cpuset_list(b'0-2,5\n') == {0, 1, 2, 5}
+    assert stats.parse_cpuset_list(b'\n') == set()
+    per_node = {0: 10, 1: 20, 2: 30}
+    assert stats.split_numa_usage(per_node, {1}) == (20, 40)
+    assert stats.split_numa_usage(per_node, None) == (60, 0)
+
+
+def test_cgroup_v2_sampler(tmpdir, monkeypatch):
+    monkeypatch.setattr(stats.libnuma, 'num_nodes', lambda: 2)
+    cgroup_path = tmpdir.mkdir('cgroup')
+    cgroup_path.join('cgroup.procs').write(f'{os.getpid()}\n')
+    cgroup_path.join('cgroup.events').write('populated 1\nfrozen 0\n')
+    cgroup_path.join('cpu.stat').write(
+        'usage_usec 3154251\nuser_usec 2416563\nsystem_usec 737688\n'
+        'nr_periods 100\nnr_throttled 7\nthrottled_usec 52000\n')
+    cgroup_path.join('memory.current').write('4096\n')
+    cgroup_path.join('io.stat').write('8:0 rbytes=1024 wbytes=2048 rios=1\n')
+    cgroup_path.join('memory.stat').write(
+        'anon 1000\nfile 3000\nkernel_stack 16\nfile_mapped 500\n')
+    cgroup_path.join('memory.swap.current').write('200\n')
+    cgroup_path.join('memory.events').write(
+        'low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n')
+    cgroup_path.join('memory.numa_stat').write(
+        'anon N0=800 N1=200\nfile N0=3000 N1=0\nfile_mapped N0=500 N1=0\n')
+    cgroup_path.join('cpuset.mems.effective').write('0\n')
+    cgroup_path.join('cpu.pressure').write(
+        'some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n')
+    cgroup_path.join('memory.pressure').write(
+        'some avg10=2.00 avg60=0.00 avg300=0.00 total=10\n'
+        'full avg10=1.00 avg60=0.00 avg300=0.00 total=5\n')
+    # io.pressure does not exist.
+
+    sampler = stats.CgroupV2Sampler('a' * 64)
+    sampler.cgroup_path = Path(cgroup_path)
+    sampler.open()
+    try:
+        assert sampler.is_running()
+        assert sampler.read_oom_kills() == 1
+        stat = sampler.sample(1000.0)
+    finally:
+        sampler.close()
+    assert stat.cpu_used == 3154.251
+    assert stat.cpu_system_used == 1000.0
+    assert stat.mem_cur_bytes == stat.mem_max_bytes == 4096
+    assert (stat.io_read_bytes, stat.io_write_bytes) == (1024, 2048)
+    assert stat.cpu_nr_throttled == 7
+    assert stat.cpu_throttled_time == 52.0
+    assert stat.cpu_pressure_some == 12.5
+    assert (stat.mem_pressure_some, stat.mem_pressure_full) == (2.0, 1.0)
+    assert (stat.io_pressure_some, stat.io_pressure_full) == (0.0, 0.0)
+    assert stat.mem_rss_bytes == 1000
+    assert stat.mem_cache_bytes == 3000
+    assert stat.mem_mapped_file_bytes == 500
+    assert stat.mem_swap_bytes == 200
+    assert stat.mem_numa_local_bytes == 3800
+    assert stat.mem_numa_remote_bytes == 200
+
+
+def test_get_host_veth_names(tmpdir):
+    procfs_root = tmpdir.mkdir('proc')
+    sysfs_root = tmpdir.mkdir('sys')
+    container_net = procfs_root.join('1234', 'root', 'sys', 'class', 'net')
+    container_net.join('lo', 'iflink').write('1\n', ensure=True)
+    container_net.join('eth0', 'iflink').write('17\n', ensure=True)
+    host_net = sysfs_root.join('class', 'net')
+    host_net.join('lo', 'ifindex').write('1\n', ensure=True)
+    host_net.join('docker0', 'ifindex').write('3\n', ensure=True)
+    host_net.join('veth1a2b3c', 'ifindex').write('15\n', ensure=True)
+    host_net.join('veth4d5e6f', 'ifindex').write('17\n', ensure=True)
+
+    names = stats.get_host_veth_names(1234, procfs_root=str(procfs_root),
+                                      sysfs_root=str(sysfs_root))
+    assert names == ['veth4d5e6f']
+
+
+def make_docker_stats_sample(cpu_usage, mem_usage, read='2018-12-28T00:00:01Z'):
+    return {
+        'read': read,
+        'preread': '2018-12-28T00:00:00Z',
+        'cpu_stats': {
+            'cpu_usage': {'total_usage': cpu_usage},
+            'system_cpu_usage': 10 * cpu_usage,
+            'throttling_data': {
+                'periods': 10, 'throttled_periods': 3,
+                'throttled_time': 5_000_000,
+            },
+        },
+        'memory_stats': {
+            'usage': mem_usage, 'max_usage': mem_usage * 2,
+            'stats': {'total_rss': mem_usage // 2, 'total_cache': mem_usage // 4,
+                      'total_mapped_file': 0, 'total_swap': 0},
+        },
+        'blkio_stats': {
+            'io_service_bytes_recursive': [
+                {'op': 'Read', 'value': 100},
+                {'op': 'Write', 'value': 200},
+            ],
+        },
+        'networks': {
+            'eth0': {'rx_bytes': 10, 'tx_bytes': 20},
+        },
+    }
+
+
+def du(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+
+@pytest.mark.skipif(not stats.inotify.is_supported(),
+                    reason='requires inotify')
+@pytest.mark.asyncio
+async def test_scratch_usage_index(tmpdir):
+    root = tmpdir.mkdir('scratch')
+    root.join('a.txt').write('x' * 10000)
+    root.mkdir('work').join('b.bin').write(b'y' * 50000, mode='wb')
+    index = stats.ScratchUsageIndex()
+    try:
+        await index.add(str(root))
+        assert index.get_usage(str(root)) == du(str(root)) > 0
+
+        # appending to and creating files
+        root.join('a.txt').write('z' * 100000, mode='a')
+        root.join('work', 'c.bin').write(b'z' * 30000, mode='wb')
+        assert index.get_usage(str(root)) == du(str(root))
+
+        # new nested directories are watched as well
+        sub = root.join('work').mkdir('sub')
+        sub.join('d.bin').write(b'w' * 20000, mode='wb')
+        assert index.get_usage(str(root)) == du(str(root))
+        sub.join('d.bin').write(b'w' * 80000, mode='ab')
+        assert index.get_usage(str(root)) == du(str(root))
+
+        # removing and moving files and directories
+        root.join('a.txt').remove()
+        sub.move(root.join('moved'))
+        assert index.get_usage(str(root)) == du(str(root))
+        root.join('moved').remove()
+        assert index.get_usage(str(root)) == du(str(root))
+
+        index.remove(str(root))
+        assert index.get_usage(str(root)) == 0
+        assert not index.watches
+    finally:
+        index.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not stats.inotify.is_supported(),
+                    reason='requires inotify')
+async def test_scratch_usage_index_background_walk(tmpdir):
+    root = tmpdir.mkdir('scratch')
+    for idx in range(10):
+        root.join(f'{idx}.txt').write('x' * 100)
+    index = stats.ScratchUsageIndex()
+    index.scan_batch_size = 3
+    try:
+        # The walk yields to the event loop in the middle.
+        task = asyncio.ensure_future(index.add(str(root)))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert not task.done()
+        await task
+        assert index.get_usage(str(root)) == du(str(root))
+
+        # The directories removed while walking are not watched.
+        index.remove(str(root))
+        task = asyncio.ensure_future(index.add(str(root)))
+        await asyncio.sleep(0)
+        index.remove(str(root))
+        await task
+        assert not index.watches
+    finally:
+        index.close()
+
+
+def test_parse_proc_pid_stat():
+    data = (b'1234 (python3 (x) y) S 1 1234 1234 0 -1 4194560 2000 0 0 0 '
+            b'150 50 0 0 20 0 3 0 98765 123456789 2048 18446744073709551615\n')
+    comm, state, ppid, num_threads, cpu_ticks, starttime = \
+        stats.parse_proc_pid_stat(data)
+    assert comm == 'python3 (x) y'
+    assert state == 'S'
+    assert ppid == 1
+    assert num_threads == 3
+    assert cpu_ticks == 200
+    assert starttime == 98765
+
+
+def write_fake_proc(root, pid, name, cpu_ticks, rss_pages, starttime=1000):
+    piddir = root.join(str(pid))
+    piddir.ensure(dir=True)
+    piddir.join('stat').write(
+        f'{pid} ({name}) R 1 {pid} {pid} 0 -1 0 0 0 0 0 '
+        f'{cpu_ticks} 0 0 0 20 0 1 0 {starttime} 0 0\n')
+    piddir.join('statm').write(f'{rss_pages * 2} {rss_pages} 10 1 0 1 0\n')
+
+
+def test_process_stat_sampler(tmpdir):
+    procfs = tmpdir.mkdir('proc')
+    pids = [101, 102, 103]
+    enumerations = []
+
+    class FakeProcessStatSampler(stats.ProcessStatSampler):
+
+        def get_pids(self, cid):
+            enumerations.append(cid)
+            return list(pids)
+
+    write_fake_proc(procfs, 101, 'python', 0, 100)
+    write_fake_proc(procfs, 102, 'bash', 0, 10)
+    sampler = FakeProcessStatSampler(enum_interval=30.0,
+                                     procfs_root=str(procfs))
+    clk_tck = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    with mock.patch('ai.backend.agent.stats.time.monotonic', return_value=100.0):
+        sampler.sample(['c0'])
+    result = sampler.get_top('c0')
+    # pid 103 has no procfs entry, as if it has exited.
+    assert [p['pid'] for p in result['processes']] == [101, 102]
+    assert all(p['cpu_pct'] is None for p in result['processes'])
+    assert result['processes'][0]['mem_rss_bytes'] == 100 * page_size
+    assert result['processes'][0]['mem_shared_bytes'] == 10 * page_size
+
+    # The cached process list is reused until the enumeration interval passes,
+    # so the new pid 103 is not visible yet.
+    write_fake_proc(procfs, 101, 'python', clk_tck // 2, 100)
+    write_fake_proc(procfs, 102, 'bash', clk_tck, 10)
+    write_fake_proc(procfs, 103, 'train', clk_tck * 2, 50)
+    with mock.patch('ai.backend.agent.stats.time.monotonic', return_value=101.0):
+        sampler.sample(['c0'])
+    result = sampler.get_top('c0', limit=1)
+    assert enumerations == ['c0']
+    assert [p['pid'] for p in result['processes']] == [102]
+    assert result['processes'][0]['cpu_pct'] == 100.0
+    assert result['processes'][0]['cpu_used'] == 1000
+    assert result['processes'][0]['name'] == 'bash'
+
+    # A reused pid does not inherit the CPU time of the previous process.
+    write_fake_proc(procfs, 102, 'bash', clk_tck * 3, 10, starttime=2000)
+    with mock.patch('ai.backend.agent.stats.time.monotonic', return_value=131.0):
+        sampler.sample(['c0'])
+    result = sampler.get_top('c0')
+    assert enumerations == ['c0', 'c0']
+    # pid 103 reappears after the re-enumeration.
+    assert [p['pid'] for p in result['processes']] == [101, 103, 102]
+    assert [p['cpu_pct'] for p in result['processes']] == [0.0, None, None]
+
+    # Containers no longer given are forgotten.
+    sampler.sample([])
+    assert sampler.get_top('c0') == {'sampled_at': None, 'processes': []}
+    assert not sampler.pid_cache and not sampler.prev_ticks
+
+
+def test_decode_docker_stats():
+    stat = stats.decode_docker_stats(make_docker_stats_sample(2_000_000, 1024))
+    assert stat.cpu_used == 2.0
+    assert stat.cpu_system_used == 20.0
+    assert stat.mem_cur_bytes == 1024
+    assert stat.mem_max_bytes == 2048
+    assert (stat.io_read_bytes, stat.io_write_bytes) == (100, 200)
+    assert (stat.net_rx_bytes, stat.net_tx_bytes) == (10, 20)
+    assert stat.cpu_nr_throttled == 3
+    assert (stat.mem_rss_bytes, stat.mem_cache_bytes) == (512, 256)
+    assert stat.cpu_throttled_time == 5.0
+
+    empty = make_docker_stats_sample(0, 0, read='0001-01-01T00:00:00Z')
+    assert stats.decode_docker_stats(empty) is None
+    assert stats.decode_docker_stats(None) is None
+
+
+class FakeLegacyStatsStream:
+    # aiodocker's former stream result object without a public close method
+
+    def __init__(self, samples):
+        self.samples = list(samples)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.samples:
+            raise StopAsyncIteration
+        return self.samples.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_collector_daemon_stream_reconnect(monkeypatch):
+    monkeypatch.setattr(stats, 'Docker', mock.MagicMock)
+    stats_sock = mock.MagicMock()
+    daemon = stats.StatCollectorDaemon('api', stats_sock, mock.MagicMock())
+    closed_streams = []
+
+    async def legacy_stats(samples):
+        return FakeLegacyStatsStream(samples)
+
+    async def stats_generator(samples):
+        try:
+            for sample in samples:
+                yield sample
+        finally:
+            closed_streams.append(samples)
+
+    new_samples = [make_docker_stats_sample(3_000_000, 4096)]
+    container = mock.MagicMock()
+    container.stats = mock.Mock(side_effect=[
+        # An unexpected error does not stop the stats.
+        TypeError('object async_generator cannot be used in await expression'),
+        legacy_stats([make_docker_stats_sample(1_000_000, 1024),
+                      make_docker_stats_sample(2_000_000, 2048)]),
+        # The stream has dropped while the container is still running.
+        stats_generator(new_samples),
+    ])
+    container.show = asynctest.CoroutineMock(side_effect=[
+        {'State': {'Running': True}},
+        {'State': {'Running': True}},
+        {'State': {'Running': False}},
+    ])
+    tracked = stats.TrackedContainer('a' * 64, 1, container=container)
+    daemon.containers[tracked.cid] = tracked
+    await daemon.stream_stats_api(tracked)
+    await asyncio.sleep(0)  # let the pending batch be flushed
+
+    assert closed_streams == [new_samples]
+    assert container.stats.call_count == 3
+    sent = [m for call in stats_sock.send.call_args_list
+            for m in stats.decode_stat_batch(bytes(call[0][0]))]
+    assert [m.status for m in sent] == [stats.STAT_STATUS_RUNNING] * 3 + \
+                                       [stats.STAT_STATUS_TERMINATED]
+    assert all(m.handle == 1 for m in sent)
+    assert [m['cpu_used'] for m in sent] == [1.0, 2.0, 3.0, 3.0]
+    assert tracked.cid not in daemon.containers
+
+
+class FakeSampler:
+
+    def __init__(self):
+        self.num_liveness_checks = 0
+        self.cpu_used = 0.0
+        self.closed = False
+
+    @staticmethod
+    def open_system_usage():
+        return None
+
+    @staticmethod
+    def read_system_usage(f):
+        return 0.0
+
+    def is_running(self):
+        self.num_liveness_checks += 1
+        return True
+
+    def sample(self, cpu_system_used):
+        self.cpu_used += 10.0
+        return stats.ContainerStat(cpu_used=self.cpu_used)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_collector_daemon_died_event(monkeypatch):
+    monkeypatch.setattr(stats, 'get_cgroup_sampler_class', lambda: FakeSampler)
+    stats_sock = mock.MagicMock()
+    daemon = stats.StatCollectorDaemon('cgroup', stats_sock, mock.MagicMock(),
+                                       interval=1.0, liveness_interval=5.0)
+    sampler = FakeSampler()
+    tracked = stats.TrackedContainer('a' * 64, 1, started=True, sampler=sampler)
+    daemon.containers[tracked.cid] = tracked
+
+    for _ in range(10):
+        daemon.sample()
+    # The liveness check runs only once per liveness_interval.
+    assert sampler.num_liveness_checks == 2
+
+    daemon.terminate(tracked.cid)
+    await asyncio.sleep(0)  # let the pending batch be flushed
+    sent = stats.decode_stat_batch(bytes(stats_sock.send.call_args[0][0]))
+    assert len(sent) == 1
+    assert sent[0].terminated
+    assert sent[0]['cpu_used'] == 110.0  # includes the final sample
+    assert tracked.cid not in daemon.containers
+    assert sampler.closed
+
+    daemon.terminate(tracked.cid)  # ignores unknown containers
+    await asyncio.sleep(0)
+    assert stats_sock.send.call_count == 11
+
+
+class BrokenSampler(FakeSampler):
+
+    def sample(self, cpu_system_used):
+        raise ValueError('malformed cgroup stats')
+
+
+@pytest.mark.asyncio
+async def test_collector_daemon_isolates_errors(monkeypatch):
+    monkeypatch.setattr(stats, 'get_cgroup_sampler_class', lambda: FakeSampler)
+    stats_sock = mock.MagicMock()
+    ctrl_sock = mock.MagicMock()
+    ctrl_sock.send_multipart = asynctest.CoroutineMock()
+    daemon = stats.StatCollectorDaemon('cgroup', stats_sock, ctrl_sock)
+    good = stats.TrackedContainer('a' * 64, 1, started=True,
+                                  sampler=FakeSampler())
+    bad = stats.TrackedContainer('b' * 64, 2, started=True,
+                                 sampler=BrokenSampler())
+    daemon.containers[good.cid] = good
+    daemon.containers[bad.cid] = bad
+
+    # A container failing to be sampled does not affect the others.
+    daemon.sample()
+    sent = stats.decode_stat_batch(bytes(stats_sock.send.call_args[0][0]))
+    assert [m.handle for m in sent] == [1]
+    assert bad.cid in daemon.containers
+    # Its termination is still reported.
+    daemon.terminate(bad.cid)
+    await asyncio.sleep(0)
+    sent = stats.decode_stat_batch(bytes(stats_sock.send.call_args[0][0]))
+    assert sent[0].handle == 2 and sent[0].terminated
+
+    # A control message failing to be handled does not stop the others.
+    ctrl_sock.recv_multipart = asynctest.CoroutineMock(side_effect=[
+        [b'agent', b'register', b'c' * 64, b'\x00'],  # malformed handle
+        [b'agent', b'register', b'd' * 64, struct.pack('!I', 4), b''],
+        [b'agent', b'shutdown', b''],
+    ])
+    await daemon.handle_ctrl()
+    assert 'd' * 64 in daemon.containers
+    ctrl_sock.send_multipart.assert_called_once_with(
+        [b'agent', b'ack', b'd' * 64])
+    assert daemon.shutdown_event.is_set()
+
+
+def test_stat_wire_format():
+    stat = stats.ContainerStat(cpu_used=12.5, cpu_system_used=1000.25,
+                               mem_cur_bytes=1 << 40, net_rx_bytes=123)
+    data = stats.encode_stat_batch([
+        (7, stats.STAT_STATUS_RUNNING, stat),
+        (8, stats.STAT_STATUS_TERMINATED, stats.ContainerStat()),
+    ])
+    records = stats.decode_stat_batch(bytes(data))
+    assert [r.handle for r in records] == [7, 8]
+    assert not records[0].terminated
+    assert records[1].terminated
+    assert records[0]._data is None  # decoded lazily
+    assert records[0]['cpu_used'] == 12.5
+    assert records[0].to_dict() == {
+        'precpu_used': 0.0,
+        'cpu_used': 12.5,
+        'precpu_system_used': 0.0,
+        'cpu_system_used': 1000.25,
+        'mem_max_bytes': 0,
+        'mem_cur_bytes': 1 << 40,
+        'net_rx_bytes': 123,
+        'net_tx_bytes': 0,
+        'io_read_bytes': 0,
+        'io_write_bytes': 0,
+        'io_max_scratch_size': 0,
+        'io_cur_scratch_size': 0,
+        'cpu_nr_throttled': 0,
+        'cpu_throttled_time': 0.0,
+        'cpu_pressure_some': 0.0,
+        'mem_pressure_some': 0.0,
+        'mem_pressure_full': 0.0,
+        'io_pressure_some': 0.0,
+        'io_pressure_full': 0.0,
+        'mem_rss_bytes': 0,
+        'mem_cache_bytes': 0,
+        'mem_mapped_file_bytes': 0,
+        'mem_swap_bytes': 0,
+        'mem_numa_local_bytes': 0,
+        'mem_numa_remote_bytes': 0,
+    }
+
+    empty = stats.encode_stat_batch([])
+    assert stats.decode_stat_batch(bytes(empty)) == []
+    with pytest.raises(ValueError):
+        stats.decode_stat_batch(b'\x00' + bytes(empty)[1:])  # bad version
+    with pytest.raises(ValueError):
+        stats.decode_stat_batch(bytes(data)[:-1])  # truncated
+
+
+def make_history_sample(cpu_used, mem_cur_bytes, net_rx_bytes=0):
+    data = stats.encode_stat_batch([
+        (1, stats.STAT_STATUS_RUNNING,
+         stats.ContainerStat(cpu_used=cpu_used, mem_cur_bytes=mem_cur_bytes,
+                             net_rx_bytes=net_rx_bytes))])
+    return stats.decode_stat_batch(bytes(data))[0]
+
+
+def test_stat_history_ring():
+    history = stats.StatHistory(4)
+    ts, cols = history.snapshot()
+    assert len(ts) == 0
+    samples = [make_history_sample(i * 10, i) for i in range(6)]
+    samples[5].to_dict()  # decoded already
+    for i, sample in enumerate(samples):
+        history.append(100.0 + i, sample)
+    assert len(history) == 4
+    # The records are stored without decoding them.
+    assert all(sample._data is None for sample in samples[:5])
+    ts, cols = history.snapshot()
+    assert list(ts) == [102.0, 103.0, 104.0, 105.0]
+    assert list(cols['cpu_used']) == [20.0, 30.0, 40.0, 50.0]
+    ts, cols = history.snapshot(since=103.5)
+    assert list(ts) == [104.0, 105.0]
+    assert list(cols['mem_cur_bytes']) == [4.0, 5.0]
+
+
+def test_summarize_stat_history():
+    history = stats.StatHistory(300)
+    # 20 samples at 1 sec intervals; the CPU usage is 500 msec per sec (50%)
+    # except a burst of 1 sec per sec (100%) in the last 4 seconds.
+    cpu_used = 0
+    for i in range(20):
+        cpu_used += 1000 if i >= 16 else 500
+        history.append(1000.0 + i, make_history_sample(
+            cpu_used, 1024 * (i + 1), net_rx_bytes=100 * i))
+    now = 1019.0
+    result = stats.summarize_stat_history(history, now=now,
+                                          duration=20.0, step=5.0)
+    assert result['num_samples'] == 19
+    assert result['timestamps'] == [1004.0, 1009.0, 1014.0, 1019.0]
+    assert result['series']['cpu_pct'][:3] == [50.0, 50.0, 50.0]
+    assert result['series']['cpu_pct'][3] > 50.0
+    assert result['series']['net_rx_bytes'] == [100.0] * 4
+    assert result['series']['mem_cur_bytes'][-1] == 1024 * 20
+    summary = result['summary']
+    assert summary['cpu_pct']['p50'] == 50.0
+    assert summary['cpu_pct']['p95'] == 100.0
+    assert summary['cpu_pct']['max'] == 100.0
+    assert summary['mem_cur_bytes']['max'] == 1024 * 20
+
+    # querying only the recent part
+    result = stats.summarize_stat_history(history, now=now,
+                                          duration=3.0, step=1.0)
+    assert result['series']['cpu_pct'] == [100.0, 100.0, 100.0]
+
+    empty = stats.summarize_stat_history(stats.StatHistory(1), now=now)
+    assert empty['num_samples'] == 0
+    assert empty['summary']['cpu_pct']['max'] is None
+
+
+class FakeOOMSampler:
+
+    def __init__(self, *, efd=None, watch_path=None):
+        self.efd = efd
+        self.watch_path = watch_path
+        self.oom_kills = 0
+        self.under_oom = False
+        self.removed = False
+
+    def read_oom_kills(self):
+        if self.removed:
+            raise FileNotFoundError
+        return self.oom_kills
+
+    def is_under_oom(self):
+        if self.removed:
+            raise FileNotFoundError
+        return self.under_oom
+
+    def open_oom_eventfd(self):
+        return self.efd
+
+    def get_oom_watch_path(self):
+        return self.watch_path
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not stats.eventfd.is_supported(), reason='requires eventfd')
+async def test_oom_watcher_eventfd():
+    efd = stats.eventfd.create(0, stats.eventfd.EFD_NONBLOCK)
+    sampler = FakeOOMSampler(efd=efd)
+    tracked = stats.TrackedContainer('a' * 64, 1, sampler=sampler)
+    callback = mock.Mock()
+    watcher = stats.OOMWatcher(callback)
+    try:
+        watcher.add(tracked)
+        # The cgroup removal also signals the eventfd without OOM kills.
+        os.write(efd, struct.pack('Q', 1))
+        await asyncio.sleep(0.05)
+        assert callback.call_count == 0
+        sampler.oom_kills += 1
+        os.write(efd, struct.pack('Q', 1))
+        await asyncio.sleep(0.05)
+        callback.assert_called_once_with(tracked)
+        # The notification may be missed on recent kernels.
+        sampler.oom_kills += 1
+        watcher.poll()
+        assert callback.call_count == 2
+        watcher.poll()
+        assert callback.call_count == 2
+    finally:
+        watcher.close()  # closes the eventfd as well
+    assert not watcher.watched
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not stats.eventfd.is_supported(), reason='requires eventfd')
+async def test_oom_watcher_eventfd_without_counter():
+    efd = stats.eventfd.create(0, stats.eventfd.EFD_NONBLOCK)
+    sampler = FakeOOMSampler(efd=efd)
+    sampler.oom_kills = None  # kernels before 4.13
+    tracked = stats.TrackedContainer('a' * 64, 1, sampler=sampler)
+    callback = mock.Mock()
+    watcher = stats.OOMWatcher(callback)
+    try:
+        watcher.add(tracked)
+        sampler.under_oom = True
+        os.write(efd, struct.pack('Q', 1))
+        await asyncio.sleep(0.05)
+        callback.assert_called_once_with(tracked)
+        # The notifications upon the cgroup removal are not OOM events,
+        # whether the cgroup files are still readable or not.
+        sampler.under_oom = False
+        os.write(efd, struct.pack('Q', 1))
+        await asyncio.sleep(0.05)
+        sampler.removed = True
+        os.write(efd, struct.pack('Q', 1))
+        await asyncio.sleep(0.05)
+        watcher.poll()
+        assert callback.call_count == 1
+    finally:
+        watcher.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not stats.inotify.is_supported(), reason='requires inotify')
+async def test_oom_watcher_inotify(tmpdir):
+    events_path = tmpdir.join('memory.events')
+    events_path.write('oom 0\noom_kill 0\n')
+    sampler = FakeOOMSampler(watch_path=str(events_path))
+    tracked = stats.TrackedContainer('a' * 64, 1, sampler=sampler)
+    callback = mock.Mock()
+    watcher = stats.OOMWatcher(callback)
+    try:
+        watcher.add(tracked)
+        events_path.write('oom 1\noom_kill 0\n')
+        await asyncio.sleep(0.05)
+        assert callback.call_count == 0
+        sampler.oom_kills += 1
+        events_path.write('oom 1\noom_kill 1\n')
+        await asyncio.sleep(0.05)
+        callback.assert_called_once_with(tracked)
+        watcher.remove(tracked.cid)
+        assert not watcher.wds
+    finally:
+        watcher.close()
+
+
+def test_stat_oom_message():
+    data = stats.encode_stat_batch([
+        (3, stats.STAT_STATUS_RUNNING, stats.ContainerStat(mem_cur_bytes=1024)),
+    ], stats.STAT_MSG_OOM)
+    msg_type, records = stats.decode_stat_message(bytes(data))
+    assert msg_type == stats.STAT_MSG_OOM
+    assert records[0].handle == 3
+    assert records[0]['mem_cur_bytes'] == 1024
+    with pytest.raises(ValueError):
+        stats.decode_stat_batch(bytes(data))
+
+
+class FakeRedisPipeline:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.commands = []
+
+    def hmset_dict(self, key, data):
+        self.commands.append(('hmset_dict', key, data))
+
+    def expire(self, key, timeout):
+        self.commands.append(('expire', key, timeout))
+
+    async def execute(self):
+        self.pool.num_executions += 1
+        for cmd, key, arg in self.commands:
+            if cmd == 'hmset_dict':
+                self.pool.data.setdefault(key, {}).update(arg)
+            elif cmd == 'expire':
+                self.pool.expires[key] = arg
+
+
+class FakeRedisPool:
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.num_executions = 0
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+
+@pytest.mark.asyncio
+async def test_stat_buffer():
+    redis = FakeRedisPool()
+    stats_monitor = mock.MagicMock()
+    buf = stats.StatBuffer(redis, 30.0, stats_monitor=stats_monitor)
+
+    await buf.flush()
+    assert redis.num_executions == 0  # nothing to flush
+
+    records = stats.decode_stat_batch(stats.encode_stat_batch([
+        (1, stats.STAT_STATUS_RUNNING, stats.ContainerStat(cpu_used=1.0)),
+        (2, stats.STAT_STATUS_RUNNING, stats.ContainerStat(cpu_used=2.0)),
+        (1, stats.STAT_STATUS_RUNNING, stats.ContainerStat(cpu_used=3.0)),
+    ]))
+    buf.put('k1', records[0])
+    buf.put('k2', records[1])
+    buf.put('k1', records[2])  # supersedes the previous sample
+    assert buf.num_dropped == 1
+    await buf.flush()
+
+    assert redis.num_executions == 1
+    assert redis.data['k1']['cpu_used'] == 3.0
+    assert redis.data['k2']['cpu_used'] == 2.0
+    assert records[0]._data is None  # the superseded record is never decoded
+    assert redis.expires == {'k1': 30.0, 'k2': 30.0}
+    assert buf.num_flushes == 1
+    assert buf.last_flush_latency is not None
+    assert not buf.pending
+    stats_monitor.report_stats.assert_any_call(
+        'increment', 'ai.backend.agent.stats.dropped_samples')
+
+
+def make_stat_record(handle, **kwargs):
+    data = stats.encode_stat_batch([
+        (handle, stats.STAT_STATUS_RUNNING, stats.ContainerStat(**kwargs))])
+    return stats.decode_stat_batch(bytes(data))[0]
+
+
+@pytest.mark.asyncio
+async def test_collect_agent_live_stats(tmpdir):
+    proc_stat = tmpdir / 'stat'
+    proc_stat.write('cpu  100 0 100 700 100 0 0 0 0 0\ncpu0 1 2 3 4\n')
+    agent = mock.MagicMock()
+    agent.container_cpu_map.num_cores = 4
+    agent.config.instance_id = 'i-test'
+    agent.redis_stat_pool = FakeRedisPool()
+    agent.live_stats = stats.LiveStatAggregator()
+    agent.host_cpu_sampler = stats.HostCPUSampler(str(proc_stat))
+    for idx, (cpu_pressure, io_pressure) in enumerate([(12.0, 0.0),
+                                                       (1.0, 3.0),
+                                                       (0.0, 25.0)]):
+        agent.live_stats.update(f'c{idx}', make_stat_record(
+            idx, cpu_throttled_time=100.0, mem_cur_bytes=1024,
+            cpu_pressure_some=cpu_pressure, io_pressure_some=io_pressure))
+
+    await stats.collect_agent_live_stats(agent)
+    info = agent.redis_stat_pool.data['i-test']
+    assert info['mem_cur_bytes'] == 3072
+    assert info['cpu_throttled_time'] == 300.0
+    assert info['cpu_pressure_max'] == 12.0
+    assert info['io_pressure_max'] == 25.0
+    assert info['mem_pressure_max'] == 0.0
+    assert info['num_contended_kernels'] == 2
+    assert info['host_cpu_pct'] == 0.0
+
+    # A newer sample replaces the previous contribution of the same kernel.
+    agent.live_stats.update('c0', make_stat_record(
+        0, cpu_throttled_time=150.0, mem_cur_bytes=2048,
+        cpu_pressure_some=2.0))
+    # A terminated kernel no longer contributes.
+    agent.live_stats.remove('c2')
+    proc_stat.write('cpu  200 0 200 800 200 0 0 0 0 0\n')
+    await stats.collect_agent_live_stats(agent)
+    info = agent.redis_stat_pool.data['i-test']
+    assert info['mem_cur_bytes'] == 3072
+    assert info['cpu_throttled_time'] == 250.0
+    assert info['cpu_pressure_max'] == 2.0
+    assert info['io_pressure_max'] == 3.0
+    assert info['num_contended_kernels'] == 0
+    assert info['host_cpu_pct'] == 50.0
+    agent.host_cpu_sampler.close()
+
+
+def test_live_stat_aggregator_cpu_pct():
+    live_stats = stats.LiveStatAggregator()
+    assert live_stats.get_cpu_pct(4) == 0
+    live_stats.update('c0', make_stat_record(
+        0, cpu_used=150.0, precpu_used=100.0,
+        cpu_system_used=1100.0, precpu_system_used=1000.0))
+    record = make_stat_record(
+        1, cpu_used=130.0, precpu_used=100.0,
+        cpu_system_used=1100.0, precpu_system_used=1000.0)
+    live_stats.update('c1', record)
+    # Only the fields needed for the aggregates are unpacked.
+    assert record._data is None
+    assert live_stats.get_cpu_pct(2) == pytest.approx(80.0)
+    live_stats.remove('c0')
+    live_stats.remove('c0')
+    assert live_stats.get_cpu_pct(2) == pytest.approx(60.0)
+    live_stats.update('c1', make_stat_record(1, mem_cur_bytes=1024))
+    live_stats.remove('c1')
+    assert live_stats.contribs == {}
+    assert live_stats.mem_cur_bytes == 0
+    assert live_stats.pressure_holder == {'cpu': None, 'mem': None, 'io': None}
+
+
+def test_stat_record_pick():
+    record = make_stat_record(0, cpu_used=1.5, mem_cur_bytes=1024,
+                              io_pressure_some=2.0)
+    view = stats._stat_record_view({'mem_cur_bytes', 'io_pressure_some',
+                                     'cpu_used'})
+    expected = {'cpu_used': 1.5, 'mem_cur_bytes': 1024, 'io_pressure_some': 2.0}
+    assert record.pick(view) == expected
+    assert record._data is None
+    record.to_dict()
+    assert record.pick(view) == expected
+
+
+def test_latency_histogram():
+    hist = stats.LatencyHistogram()
+    assert hist.percentile(50) is None
+    assert hist.summarize()['count'] == 0
+    for msec in (0.5, 3, 3, 40, 120, 400000):
+        hist.observe(msec)
+    assert hist.count == 6
+    assert hist.percentile(50) == 5
+    assert hist.percentile(60) == 50
+    # The overflow bucket reports the maximum.
+    assert hist.percentile(99) == 400000
+    assert hist.percentile(1) == 1
+    item = hist.to_dict()
+    assert item['counts'][:3] == [1, 0, 2]
+    assert item['counts'][-1] == 1
+    assert len(item['bounds']) == len(item['counts'])
+    assert item['max'] == 400000
+    assert item['avg'] == pytest.approx(sum((0.5, 3, 3, 40, 120, 400000)) / 6)
+
+
+def test_run_latency_stats():
+    run_latency = stats.RunLatencyStats()
+    run_latency.record('python:3.6-ubuntu', queue=0.0, first_output=0.002,
+                       run=0.15, upload=None, total=0.16)
+    run_latency.record('python:3.6-ubuntu', queue=1.0, first_output=None,
+                       run=1.2, upload=0.01, total=1.3)
+    run_latency.record('lua:5.3-alpine', queue=0.0, run=0.01, total=0.01)
+    summary = run_latency.summarize()
+    assert set(summary) == {'python:3.6-ubuntu', 'lua:5.3-alpine'}
+    item = summary['python:3.6-ubuntu']
+    assert item['queue']['count'] == 2
+    assert item['queue']['max'] == 1000.0
+    assert item['first_output']['count'] == 1
+    assert item['upload']['count'] == 1
+    assert item['run']['p50'] == 200
+    assert summary['lua:5.3-alpine']['upload']['count'] == 0
+    detail = run_latency.summarize('lua:5.3-alpine', detail=True)
+    assert list(detail) == ['lua:5.3-alpine']
+    assert sum(detail['lua:5.3-alpine']['total']['counts']) == 1
+    assert run_latency.summarize('unknown') == {}
+
+
+@pytest.fixture
+async def stat_collector(stats_server, event_loop):
+    collectors = []
+
+    async def _create(collection_type):
+        stats_sock, stat_addr = stats_server
+        collector = stats.StatCollector(stat_addr, collection_type,
+                                        exec_opts=pipe_opts)
+        await collector.start()
+        collectors.append(collector)
+        return collector
+
+    yield _create
+
+    for collector in collectors:
+        await collector.close()
+
+
+async def recv_until_terminated(stats_sock, collector, cid):
+    handle = collector.handles[cid]
+    msg_list = []
+    while True:
+        batch = stats.decode_stat_batch(await stats_sock.recv())
+        msgs = [m for m in batch if m.handle == handle]
+        msg_list.extend(msgs)
+        if any(m.terminated for m in msgs):
+            break
+    return msg_list
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize('collection_type', active_collection_types)
 async def test_collector(event_loop,
                          create_container,
                          stats_server,
+                         stat_collector,
                          collection_type):
 
     # Create the container but don't start it.
@@ -89,38 +1059,29 @@ async def test_collector(event_loop,
     cid = container['id']
 
     # Initialize the agent-side.
-    stats_sock, stats_port = stats_server
-
-    # Spawn the collector and wait for its initialization.
-    stat_addr = f'tcp://127.0.0.1:{stats_port}'
+    stats_sock, stat_addr = stats_server
 
-    proc = None
-    async with stats.spawn_stat_collector(stat_addr, collection_type, cid,
-                                          exec_opts=pipe_opts) as p:
-        proc = p
+    # Spawn the collector daemon and register the container.
+    collector = await stat_collector(collection_type)
+    async with collector.register(cid):
         await container.start()
 
     # Proceed to receive stats.
     async def kill_after_sleep():
         await asyncio.sleep(2.0)
         await container.kill()
+        # This is what the agent does upon Docker's "die" event.
+        await collector.notify_died(cid)
 
     t = event_loop.create_task(kill_after_sleep())
-    msg_list = []
-    while True:
-        msg = (await recv_deserialized(stats_sock))[0]
-        print(msg)
-        msg_list.append(msg)
-        if msg['status'] == 'terminated':
-            break
-    await proc.wait()
+    msg_list = await recv_until_terminated(stats_sock, collector, cid)
     await t  # for explicit clean up
 
-    assert proc.returncode == 0
+    assert collector.proc.returncode is None  # the daemon keeps running
     assert len(msg_list) >= 1
-    assert msg_list[0]['cid'] == cid
-    assert msg_list[0]['status'] in ('running', 'terminated')
-    assert msg_list[0]['data'] is not None
+    assert msg_list[0].status in (stats.STAT_STATUS_RUNNING,
+                                  stats.STAT_STATUS_TERMINATED)
+    assert msg_list[0].to_dict() is not None
 
 
 @pytest.mark.asyncio
@@ -128,6 +1089,7 @@ async def test_collector(event_loop,
 async def test_collector_immediate_death(event_loop,
                                            create_container,
                                            stats_server,
+                                           stat_collector,
                                            collection_type):
     container = await create_container({
         'Cmd': ['-c', 'exit 0'],
@@ -137,32 +1099,75 @@ async def test_collector_immediate_death(event_loop,
     cid = container['id']
 
     # Initialize the agent-side.
-    stats_sock, stats_port = stats_server
+    stats_sock, stat_addr = stats_server
 
-    # Spawn the collector and wait for its initialization.
-    stat_addr = f'tcp://127.0.0.1:{stats_port}'
-
-    proc = None
-    async with stats.spawn_stat_collector(stat_addr, collection_type, cid,
-                                          exec_opts=pipe_opts) as p:
-        proc = p
+    collector = await stat_collector(collection_type)
+    async with collector.register(cid):
         await container.start()
 
     # Let it die first!
     await container.wait()
 
     # Proceed to receive stats.
-    msg_list = []
-    while True:
-        msg = (await recv_deserialized(stats_sock))[0]
-        print(msg)
-        msg_list.append(msg)
-        if msg['status'] == 'terminated':
-            break
-
-    await proc.wait()
+    msg_list = await recv_until_terminated(stats_sock, collector, cid)
 
-    assert proc.returncode == 0
     assert len(msg_list) >= 1
-    assert msg_list[0]['cid'] == cid
-    assert msg_list[0]['data'] is not None
+    assert msg_list[0].to_dict() is not None
+
+
+@pytest.mark.asyncio
+async def test_collector_shutdown(stat_collector):
+    collector = await stat_collector('cgroup')
+    await collector.close()
+    assert collector.proc.returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_collector_register_timeout(stat_collector):
+    collector = await stat_collector('cgroup')
+    collector.ack_timeout = 0.1
+    collector.ctrl_sock.send_multipart = asynctest.CoroutineMock()
+    # The registration proceeds without the acknowledgement.
+    async with collector.register('a' * 64):
+        pass
+    assert collector.handles['a' * 64] == 1
+    assert not collector.pending_acks
+
+
+@pytest.mark.asyncio
+async def test_collector_unregister():
+    collector = stats.StatCollector('ipc:///tmp/unused', 'cgroup')
+    collector.ctrl_sock = mock.Mock()
+    collector.ctrl_sock.send_multipart = asynctest.CoroutineMock()
+    collector.handles['a' * 64] = 1
+    collector.cids[1] = 'a' * 64
+    collector.started.add('a' * 64)
+    await collector.unregister('a' * 64)
+    await collector.unregister('a' * 64)  # already released
+    collector.ctrl_sock.send_multipart.assert_called_once_with(
+        [b'unregister', b'a' * 64])
+    assert not collector.handles
+    assert not collector.cids
+    assert not collector.started
+
+
+@pytest.mark.asyncio
+async def test_collector_restart(stat_collector):
+    collector = await stat_collector('cgroup')
+    collector.restart_delay = 0.0
+    async with collector.register('a' * 64, '/tmp/scratch'):
+        pass
+    old_proc = collector.proc
+    old_proc.kill()
+    for _ in range(50):
+        await asyncio.sleep(0.1)
+        if collector.proc is not old_proc:
+            break
+    assert collector.proc is not old_proc
+    assert collector.proc.returncode is None
+    assert collector.handles == {'a' * 64: 1}
+    # The new daemon acknowledges the registrations.
+    collector.ack_timeout = 10.0
+    with timeout(3.0):
+        async with collector.register('b' * 64):
+            pass